@@ -2,6 +2,10 @@ import pymysql.cursors
 from pymysql.cursors import Cursor
 from pymysql.connections import Connection
 from datetime import date
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple, Union
+import threading
+import time
 from ..get_config import get_config, ConfigScope
 from ..media.image.photo import Photo
 import logging
@@ -9,19 +13,113 @@ from .. import exceptions
 
 _logger = logging.getLogger(__name__)
 _config = get_config(ConfigScope.DB)
+# Seconds a pooled connection may be idle before it is checked again
+_POOL_PING_AFTER = 30
+
+
+def connect() -> Connection:
+    """Open a new connection to the database
+
+    Returns:
+        Connection: pymysql connection using DictCursor
+    """
+    return pymysql.connect(host=_config["host"],
+                           user=_config["username"],
+                           password=_config["password"],
+                           db=_config["db"],
+                           charset="utf8mb4",
+                           cursorclass=pymysql.cursors.DictCursor
+                           )
+
+
+def duplicate_date(photo: Photo) -> date:
+    """The date a photo is checked for duplicates on, the capture date if known
+
+    Args:
+        photo (Photo): The photo
+
+    Returns:
+        date: Capture date, export date or today
+    """
+    if photo.date_capture:
+        return photo.date_capture
+    elif photo.date_export:
+        return photo.date_export
+    return date.today()
+
+
+def duplicate_key(photo: Photo) -> Union[None, str]:
+    """Normalized filename and raw filename of a photo, stored in photos.duplicate_key.
+    Photos without a raw filename are never considered duplicates.
+
+    Args:
+        photo (Photo): The photo
+
+    Returns:
+        Union[None, str]: The key, None if the photo has no raw filename
+    """
+    if not photo.raw_filename or not photo.filename:
+        return None
+    return f"{photo.filename}/{photo.raw_filename}".lower()
+
+
+def _photo_row(handle: str, location: str, photo: Photo) -> dict:
+    row = {k: v for k, v in photo.__dict__.items(
+    ) if k not in ("data", "filepath", "source_path") and v is not None}
+    row["handle"] = handle
+    row["location"] = location
+    row["duplicate_date"] = duplicate_date(photo)
+    row["duplicate_key"] = duplicate_key(photo)
+    return row
+
+
+def _cdn_row(cdn_info: dict) -> dict:
+    return {k: v for k, v in cdn_info.items() if v is not None}
+
+
+def _tag_rows(tags: list) -> List[dict]:
+    return list(map(lambda tag: {"id": tag}, tags))
+
+
+def _obj_tag_rows(handle: str, tags: list) -> List[dict]:
+    return list(map(lambda tag: {"handle": handle, "tag_id": tag}, tags))
+
+
+def _insert_many(cursor: Cursor, table: str, rows: List[dict], ignore: bool = False) -> None:
+    """Insert rows using parameterized statements. Rows with the same columns are inserted together,
+    pymysql turns executemany of an INSERT into multi-row inserts.
+
+    Args:
+        cursor (Cursor): Cursor to execute with
+        table (str): Table name
+        rows (List[dict]): Column name and value of each row, names are not escaped and must be trusted
+        ignore (bool, optional): Use INSERT IGNORE. Defaults to False.
+    """
+    groups: Dict[Tuple[str, ...], List[tuple]] = {}
+    for row in rows:
+        groups.setdefault(tuple(row.keys()), []).append(tuple(row.values()))
+
+    for columns, values in groups.items():
+        sql = "INSERT {}INTO `{}` ({}) VALUES ({});".format(
+            "IGNORE " if ignore else "",
+            table,
+            ", ".join(map(lambda c: f"`{c}`", columns)),
+            ", ".join(["%s"] * len(columns)))
+        cursor.executemany(sql, values)
 
 
 class DB:
     _connection: Connection = None
 
-    def __init__(self):
-        self._connection = pymysql.connect(host=_config["host"],
-                                           user=_config["username"],
-                                           password=_config["password"],
-                                           db=_config["db"],
-                                           charset="utf8mb4",
-                                           cursorclass=pymysql.cursors.DictCursor
-                                           )
+    def __init__(self, connection: Connection = None):
+        """Constructor of the DB class
+
+        Args:
+            connection (Connection, optional): Use an existing connection instead of opening a new one. Defaults to None.
+        """
+        if connection is None:
+            connection = connect()
+        self._connection = connection
 
     def commit(self) -> None:
         """Commit changes
@@ -34,52 +132,34 @@ class DB:
         self._connection.commit()
         self._connection.close()
 
+    def rollback(self) -> None:
+        """Discard uncommitted changes
+        """
+        self._connection.rollback()
+
     def write_tags(self, handle: str, tags: list):
-        """Associate a objet with given tags
+        """Associate a objet with given tags, in the transaction of the caller like write_photo and write_cdn
 
         Args:
             handle (str): handle
             tags (list): List of Tags containing tag id
         """
-
-        # Create new tag if not already exist
-        values = ""
-        for i, tag in enumerate(tags):
-            if i != len(tags) - 1:
-                values += f'("{tag}"), '
-            else:
-                values += f'("{tag}")'
-
-        sql = f'INSERT IGNORE INTO `tags` (`id`) VALUES {values};'
         cursor: Cursor = self._connection.cursor()
-        cursor.execute(sql)
-        self.commit()
-        cursor.close()
-
-        values = ""
-        for i, tag in enumerate(tags):
-            if i != len(tags) - 1:
-                values += f'("{handle}", "{tag}"), '
-            else:
-                values += f'("{handle}", "{tag}")'
-        cursor: Cursor = self._connection.cursor()
-        sql = f'INSERT INTO `obj_tag` (`handle`, `tag_id`) VALUES {values};'
-        cursor.execute(sql)
-        self.commit()
+        # Create new tag if not already exist
+        _insert_many(cursor, "tags", _tag_rows(tags), ignore=True)
+        _insert_many(cursor, "obj_tag", _obj_tag_rows(handle, tags))
         cursor.close()
 
     # Photos
 
     def count_handle(self, date: date, hdl_prefix: str):
         cursor: Cursor = self._connection.cursor()
-        sql = f'SELECT count(handle) FROM handles WHERE handle LIKE "{hdl_prefix}/P{date.isoformat()}%" AND idx = 1;'
-        cursor.execute(sql)
+        sql = 'SELECT count(handle) FROM handles WHERE handle LIKE %s AND idx = 1;'
+        cursor.execute(sql, (f"{hdl_prefix}/P{date.isoformat()}%",))
         res = cursor.fetchone()
         cursor.close()
         return res["count(handle)"]
 
-    # Cambile thest 2 functions ??
-
     def photo_has_duplicate(self, photo: Photo) -> bool:
         """Checks if a photo has possible duplicates using date and filenames.
 
@@ -89,68 +169,244 @@ class DB:
         Returns:
             bool: True if possible duplicates exists, False if otherwise
         """
-        if photo.date_capture:
-            handle_date = photo.date_capture
-        elif photo.date_export:
-            handle_date = photo.date_export
-        else:
-            handle_date = date.today()
+        return self.photos_have_duplicates([photo])[0]
+
+    def photos_have_duplicates(self, photos: List[Photo]) -> List[bool]:
+        """Checks a batch of photos for possible duplicates in a single query,
+        using the indexed duplicate_date and duplicate_key columns.
+
+        Args:
+            photos (List[Photo]): The Photo classes to check, metadata only photos are sufficient
+
+        Returns:
+            List[bool]: For each photo, True if possible duplicates exists, False if otherwise
+        """
+        keys = list(map(lambda photo: (duplicate_date(photo),
+                    duplicate_key(photo)), photos))
+        candidates = list(set(filter(lambda key: key[1] is not None, keys)))
+        if not candidates:
+            return [False] * len(photos)
 
         cursor: Cursor = self._connection.cursor()
-        duplicate_sql = f"""
-            SELECT IF(
-            (
-                SELECT Count(handle)
-                FROM photos
-                WHERE (
-                        handle like "%P{handle_date.isoformat()}%"
-                        AND (
-                            raw_filename = "{photo.raw_filename}"
-                            AND filename = "{photo.filename}"
-                        )
-                    ) = 1
-            ),
-            1,
-            0
-            ) AS result;"""
-        cursor.execute(duplicate_sql)
+        sql = "SELECT DISTINCT duplicate_date, duplicate_key FROM photos WHERE (duplicate_date, duplicate_key) IN ({});".format(
+            ", ".join(["(%s, %s)"] * len(candidates)))
+        cursor.execute(sql, [v for key in candidates for v in key])
+        found = set(map(lambda row: (
+            row["duplicate_date"], row["duplicate_key"]), cursor.fetchall()))
         cursor.close()
-        return bool(cursor.fetchone()["result"])
+        return list(map(lambda key: key in found, keys))
 
     def write_photo(self, handle: str, location: str, photo: Photo, check_duplicate: bool = True):
         # Checking for possible duplication
-        if self.photo_has_duplicate(photo):
+        if check_duplicate and self.photo_has_duplicate(photo):
             _logger.warn(f'Possible duplicate for file {photo.filename}!')
-            if check_duplicate:
-                raise exceptions.ObjectDuplicateException
+            raise exceptions.ObjectDuplicateException
         # Inserting data
         cursor: Cursor = self._connection.cursor()
-        # Making column values
-        val = ""
-        for k, v in photo.__dict__.items():
-            if k == "data" or k == "filepath":
-                continue
-            if v is not None:
-                val += f'{k} = "{v}", '
-        val += f'handle = "{handle}", location = "{location}"'
-
-        sql = f'INSERT INTO photos SET {val};'
         _logger.info(f'Inserting photo {handle} to DB')
-        cursor.execute(sql)
+        _insert_many(cursor, "photos", [_photo_row(handle, location, photo)])
         cursor.close()
 
     def write_cdn(self, cdn_info: dict):
         cursor: Cursor = self._connection.cursor()
+        _logger.debug("Writing {} to database".format(cdn_info["cdn_key"]))
+        _insert_many(cursor, "cdn", [_cdn_row(cdn_info)])
+        cursor.close()
 
-        val = ""
-        for k, v in cdn_info.items():
-            if v is not None:
-                val += f'{k} = "{v}", '
 
-        val = val[0:-2]  # Remove last comma
-        val += ";"
+class WriteBuffer:
+    """Write-behind buffer for the rows of many photos.
+    Collects photos, tags and CDN versions and writes them with parameterized multi-row inserts
+    in a single transaction on flush, instead of several statements and commits per photo.
+    """
 
-        _logger.debug("Writing {} to database".format(cdn_info["cdn_key"]))
-        sql = f"INSERT INTO cdn SET {val}"
-        cursor.execute(sql)
-        cursor.close()
+    def __init__(self):
+        self._photos: List[dict] = []
+        self._tags: List[dict] = []
+        self._obj_tags: List[dict] = []
+        self._cdn: List[dict] = []
+        self._outbox: List[dict] = []
+
+    def __len__(self) -> int:
+        """Number of buffered photos
+        """
+        return len(self._photos)
+
+    def add_photo(self, handle: str, location: str, photo: Photo, tags: list = None, cdn: List[dict] = None, handle_location: str = None) -> None:
+        """Buffer a photo with its tags and CDN versions
+
+        Args:
+            handle (str): Handle of the photo
+            location (str): Location of the original
+            photo (Photo): The photo
+            tags (list, optional): List of tag ids. Defaults to None.
+            cdn (List[dict], optional): Information of the CDN versions as written by write_cdn. Defaults to None.
+            handle_location (str, optional): Queue the registration of the reserved handle pointing here
+                in handle_outbox, committed together with the photo. Defaults to None.
+        """
+        self._photos.append(_photo_row(handle, location, photo))
+        if handle_location:
+            self._outbox.append(
+                {"handle": handle, "location": handle_location})
+        if tags:
+            self._tags += _tag_rows(tags)
+            self._obj_tags += _obj_tag_rows(handle, tags)
+        if cdn:
+            self._cdn += list(map(_cdn_row, cdn))
+
+    def _written(self, cursor: Cursor) -> set:
+        handles = list(map(lambda row: row["handle"], self._photos))
+        if not handles:
+            return set()
+        cursor.execute("SELECT handle FROM photos WHERE handle IN ({});".format(
+            ", ".join(["%s"] * len(handles))), handles)
+        return set(map(lambda row: row["handle"], cursor.fetchall()))
+
+    def flush(self, db: DB) -> None:
+        """Write and commit all buffered rows in one transaction, rolled back if any insert fails.
+        Photos whose handle is already in the database are skipped with their tags and CDN versions,
+        so writing a batch again is harmless. The buffer is empty afterwards either way.
+
+        Args:
+            db (DB): Database to write to
+        """
+        if not self._photos and not self._tags and not self._cdn:
+            return
+
+        _logger.info(
+            f"Writing {len(self._photos)} photos and {len(self._cdn)} CDN versions to DB")
+        if self._outbox:
+            _logger.info(
+                f"Queueing {len(self._outbox)} handles for registration")
+        cursor: Cursor = db._connection.cursor()
+        try:
+            # A batch replayed by --resume after its commit was not recorded in the journal is already written,
+            # the rows of a photo are committed together, so skipping its handle skips all of them
+            written = self._written(cursor)
+            if written:
+                _logger.info(
+                    f"{len(written)} photos already written, skipping them")
+                self._photos = [row for row in self._photos
+                                if row["handle"] not in written]
+                self._obj_tags = [row for row in self._obj_tags
+                                  if row["handle"] not in written]
+                self._cdn = [row for row in self._cdn
+                             if row.get("source_handle") not in written]
+            _insert_many(cursor, "photos", self._photos)
+            # Photos of a batch usually share their tags
+            _insert_many(cursor, "tags", list(
+                {row["id"]: row for row in self._tags}.values()), ignore=True)
+            _insert_many(cursor, "obj_tag", self._obj_tags)
+            _insert_many(cursor, "cdn", self._cdn)
+            # A resumed photo may already be queued
+            _insert_many(cursor, "handle_outbox", self._outbox, ignore=True)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            cursor.close()
+            self.__init__()
+
+
+class ConnectionPool:
+    """A fixed size pool of database connections shared by all threads of a run.
+    Connections are opened lazily and checked before being handed out again.
+    """
+
+    def __init__(self, size: int = 4):
+        """Constructor of the ConnectionPool class
+
+        Args:
+            size (int, optional): Maximum number of open connections. Defaults to 4.
+        """
+        self._size = size
+        self._opened = 0
+        self._idle: List[Tuple[DB, float]] = []
+        self._all: List[DB] = []
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def acquire(self) -> DB:
+        """Take a connection from the pool, blocks until one is available
+
+        Returns:
+            DB: DB using a pooled connection
+        """
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                if self._idle:
+                    db, released_at = self._idle.pop()
+                    break
+                if self._opened < self._size:
+                    self._opened += 1
+                    db = None
+                    break
+                self._condition.wait()
+
+        if db is None:
+            _logger.debug("Opening pooled database connection")
+            try:
+                db = DB()
+            except Exception:
+                with self._condition:
+                    self._opened -= 1
+                    self._condition.notify()
+                raise
+            with self._condition:
+                self._all.append(db)
+        elif time.monotonic() - released_at > _POOL_PING_AFTER:
+            # Connections idle for a while may have been dropped by the server
+            db._connection.ping(reconnect=True)
+        return db
+
+    def release(self, db: DB) -> None:
+        """Return a connection to the pool, uncommitted changes are rolled back
+
+        Args:
+            db (DB): DB returned by acquire
+        """
+        try:
+            db.rollback()
+        except pymysql.err.Error:
+            _logger.warning("Discarding broken pooled database connection")
+            with self._condition:
+                self._all.remove(db)
+                self._opened -= 1
+                self._condition.notify()
+            return
+
+        with self._condition:
+            self._idle.append((db, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self) -> Iterator[DB]:
+        """Context manager around acquire and release
+
+        Yields:
+            DB: DB using a pooled connection
+        """
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def close(self) -> None:
+        """Close all connections of the pool
+        """
+        with self._condition:
+            self._closed = True
+            dbs = self._all
+            self._all = []
+            self._idle = []
+            self._condition.notify_all()
+
+        for db in dbs:
+            try:
+                db._connection.close()
+            except pymysql.err.Error:
+                pass
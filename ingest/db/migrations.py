@@ -0,0 +1,99 @@
+import argparse
+import logging
+import sys
+from typing import Callable, List, Tuple
+from pymysql.cursors import Cursor
+from .db import DB
+
+_logger = logging.getLogger(__name__)
+
+
+def _photo_duplicate_index(cursor: Cursor) -> None:
+    """Indexed columns for duplicate checks, replacing the leading wildcard LIKE on photos.handle
+    """
+    cursor.execute("""ALTER TABLE photos
+        ADD COLUMN duplicate_date DATE NULL,
+        ADD COLUMN duplicate_key VARCHAR(255) NULL,
+        ADD INDEX photos_duplicate (duplicate_date, duplicate_key);""")
+    # Existing rows take the date from the handle suffix P<DATE>.I<ID>
+    cursor.execute("""UPDATE photos
+        SET duplicate_date = STR_TO_DATE(SUBSTRING(handle, LOCATE('/P', handle) + 2, 10), '%Y-%m-%d'),
+            duplicate_key = LOWER(CONCAT(filename, '/', raw_filename))
+        WHERE raw_filename IS NOT NULL AND filename IS NOT NULL;""")
+
+
+def _handle_sequences(cursor: Cursor) -> None:
+    """Next free handle ID per prefix and date, see handle.sequence.HandleSequence
+    """
+    cursor.execute("""CREATE TABLE IF NOT EXISTS handle_sequences (
+        prefix VARCHAR(255) NOT NULL,
+        seq_date DATE NOT NULL,
+        next_id INT UNSIGNED NOT NULL,
+        PRIMARY KEY (prefix, seq_date));""")
+
+
+def _handle_outbox(cursor: Cursor) -> None:
+    """Handles reserved by ingest and waiting to be registered, see handle.outbox
+    """
+    cursor.execute("""CREATE TABLE IF NOT EXISTS handle_outbox (
+        handle VARCHAR(255) NOT NULL PRIMARY KEY,
+        location VARCHAR(2048) NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        attempts INT UNSIGNED NOT NULL DEFAULT 0,
+        next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        last_error TEXT NULL,
+        registered_at TIMESTAMP NULL,
+        INDEX handle_outbox_pending (registered_at, next_attempt_at));""")
+
+
+# Applied in order, names must never change once released
+_MIGRATIONS: List[Tuple[str, Callable[[Cursor], None]]] = [
+    ("001_photo_duplicate_index", _photo_duplicate_index),
+    ("002_handle_sequences", _handle_sequences),
+    ("003_handle_outbox", _handle_outbox),
+]
+
+
+def migrate(db: DB) -> List[str]:
+    """Apply all migrations not yet recorded in the schema_migrations table
+
+    Args:
+        db (DB): Database to migrate
+
+    Returns:
+        List[str]: Names of the applied migrations
+    """
+    connection = db._connection
+    cursor: Cursor = connection.cursor()
+    cursor.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+        name VARCHAR(255) PRIMARY KEY,
+        applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP);""")
+    cursor.execute("SELECT name FROM schema_migrations;")
+    applied = set(map(lambda row: row["name"], cursor.fetchall()))
+
+    done = []
+    for name, migration in _MIGRATIONS:
+        if name in applied:
+            continue
+        _logger.info(f"Applying migration {name}")
+        migration(cursor)
+        cursor.execute(
+            "INSERT INTO schema_migrations (name) VALUES (%s);", (name,))
+        db.commit()
+        done.append(name)
+    cursor.close()
+    return done
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Apply pending database migrations")
+    parser.parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    db = DB()
+    try:
+        applied = migrate(db)
+    finally:
+        db.close()
+    print(f"Applied {len(applied)} migrations")
@@ -1,3 +1,8 @@
 class ObjectDuplicateException(Exception):
     # TODO maby check for filehash??
     pass
+
+
+class ConfigError(Exception):
+    """The config file is missing or incomplete"""
+    pass
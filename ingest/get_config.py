@@ -2,6 +2,8 @@ from configparser import ConfigParser
 from enum import Enum
 import logging
 import os
+import threading
+from .exceptions import ConfigError
 
 _logger = logging.getLogger(__name__)
 
@@ -15,7 +17,21 @@ class ConfigScope(Enum):
     SANITY = 6
 
 
+_config_file_path: str = None
+_config: ConfigParser = None
+_config_lock = threading.Lock()
+
+_SECTIONS = {
+    ConfigScope.DB: "DB",
+    ConfigScope.HANDLE: "HANDLE",
+    ConfigScope.S3: "S3",
+    ConfigScope.S3_CDN: "S3_CDN",
+    ConfigScope.SANITY: "SANITY"
+}
+
+
 def _parse_config():
+    global _config_file_path
     config = ConfigParser()
 
     _logger.debug("Reading config file")
@@ -25,9 +41,10 @@ def _parse_config():
     elif os.path.isfile("./config.ini"):
         config_file_path = os.path.abspath("./config.ini")
     else:
-        _logger.critical(
-            f"No config file found.")
+        raise ConfigError(
+            "No config file found, expected ~/.ingest.ini or ./config.ini")
     config.read(config_file_path)
+    _config_file_path = config_file_path
     # TODO Valid sections
     if not config.sections():
         _logger.critical(
@@ -38,7 +55,8 @@ def _parse_config():
             "username": "Handle Server Username",
             "password": "Handle Server Password",
             "prefix": "Handle Prefix",
-            "httpsverify": True
+            "httpsverify": True,
+            "sequenceblock": 20
         }
         config["DB"] = {
             "host": "Database location",
@@ -51,7 +69,13 @@ def _parse_config():
             "accessKeyID": "AWS Access Key ID",
             "accessKeySecret": "AWS Access Key Secret",
             "bucketname": "Main Bucket Name",
-            "cdnseperateKey": False
+            "cdnseperateKey": False,
+            "uploadconcurrency": 10,
+            "uploadmaxbytes": 64 * 1024 * 1024,
+            "multipartthreshold": 16 * 1024 * 1024,
+            "multipartchunksize": 16 * 1024 * 1024,
+            "transferconcurrency": 4,
+            "skipunchanged": False
         }
         config["S3_CDN"] = {
             "endpoint": "AWS Endpoint",
@@ -62,30 +86,112 @@ def _parse_config():
         }
         config["SANITY"] = {
             "token": "Sanity token",
-            "project_id": "Project id"
+            "project_id": "Project id",
+            "dataset": "Dataset",
+            "imagewidth": 2000
         }
         with open(config_file_path, "w") as config_file:
             config.write(config_file)
-            exit()
+        raise ConfigError(
+            f"Config file not valid, example file generated at {config_file_path}")
 
     return config
 
 
-_config: ConfigParser = _parse_config()
+def _load() -> ConfigParser:
+    global _config
+    with _config_lock:
+        if _config is None:
+            _config = _parse_config()
+        return _config
+
+
+class _LazyConfig:
+    """Stand-in for the config or one of its sections, the config file is only read on first access.
+    Modules keep their config as a module variable without reading the file when they are imported
+    """
+
+    def __init__(self, section: str = None):
+        self._section = section
+
+    def _resolve(self):
+        config = _load()
+        if self._section is None:
+            return config
+        if self._section not in config:
+            raise ConfigError(f'Section "{self._section}" not in config file')
+        return config[self._section]
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __getitem__(self, key):
+        return self._resolve()[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._resolve()
+
+    def __iter__(self):
+        return iter(self._resolve())
 
 
 def get_config(scope: ConfigScope = ConfigScope.FULL) -> ConfigParser:
-    if scope == ConfigScope.FULL:
-        return _config
-    elif scope == ConfigScope.DB:
-        return _config["DB"]
-    elif scope == ConfigScope.HANDLE:
-        return _config["HANDLE"]
-    elif scope == ConfigScope.S3:
-        return _config["S3"]
-    elif scope == ConfigScope.S3_CDN:
-        return _config["S3_CDN"]
-    elif scope == ConfigScope.SANITY:
-        return _config["SANITY"]
+    """The config or one of its sections. The config file is read on first access of the returned object,
+    not by this function, so it can be called at import time
+
+    Args:
+        scope (ConfigScope, optional): Section to return. Defaults to ConfigScope.FULL.
 
+    Raises:
+        ConfigError: On first access, if the config file or the section is missing
+
+    Returns:
+        ConfigParser: The config, or the SectionProxy of the section
+    """
+    if scope == ConfigScope.FULL:
+        return _LazyConfig()
+    if scope in _SECTIONS:
+        return _LazyConfig(_SECTIONS[scope])
     return None
+
+
+def get_config_path() -> str:
+    """Location of the config file in use
+
+    Raises:
+        ConfigError: If the config file is missing
+
+    Returns:
+        str: Absolute path of the config file
+    """
+    _load()
+    return _config_file_path
+
+
+def get_state_path(name: str) -> str:
+    """Location of a local state file or directory such as the ingest journal.
+    State is kept in the directory set as dir in the STATE section of the config file,
+    by default in the directory .ingest next to the config file, which is created if missing
+
+    Args:
+        name (str): Name of the file or directory
+
+    Raises:
+        ConfigError: If the config file is missing
+
+    Returns:
+        str: Absolute path of the file or directory
+    """
+    config = _load()
+    config_dir = os.path.dirname(_config_file_path)
+    state_dir = config.get("STATE", "dir", fallback=None)
+    state_dir = os.path.abspath(os.path.expanduser(state_dir)) if state_dir else os.path.join(config_dir, ".ingest")
+    os.makedirs(state_dir, exist_ok=True)
+
+    path = os.path.join(state_dir, name)
+    # Earlier versions kept the state directly next to the config file, it is not moved as the name may be taken by something else
+    legacy_path = os.path.join(config_dir, name)
+    if not os.path.exists(path) and os.path.exists(legacy_path):
+        _logger.warning(
+            f"Found {legacy_path} of an earlier version, move it to {path} to keep using it")
+    return path
@@ -0,0 +1,177 @@
+import argparse
+import json
+import logging
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from urllib.parse import parse_qs, urlsplit
+from ..media.image.photo import Photo
+from .handle import Handle
+from .rest import RestClient
+
+_logger = logging.getLogger(__name__)
+
+_HANDLES_PATH = "/api/handles/"
+
+
+class FakeHandleServer(ThreadingHTTPServer):
+    """Local stand-in for the handle server REST API, for measuring registration throughput.
+    Only creating handles with PUT /api/handles/<handle> and reading them with GET is supported, every request is answered
+    after latency seconds to simulate the round trip to a remote server. Connections are kept alive.
+
+    Attributes:
+        handles (Dict[str, list]): Values of the created handles
+        requests (int): Number of received requests
+        connections (int): Number of accepted connections
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple = ("127.0.0.1", 0), latency: float = 0.05):
+        """Constructor of the FakeHandleServer class
+
+        Args:
+            address (tuple, optional): Address to listen on. Defaults to a free port on localhost.
+            latency (float, optional): Seconds each request takes. Defaults to 0.05.
+        """
+        super().__init__(address, _RequestHandler)
+        self.latency = latency
+        self.handles: Dict[str, list] = {}
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    def start(self) -> "FakeHandleServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are sent separately, with Nagle's algorithm the body waits for the delayed ACK of the client
+    disable_nagle_algorithm = True
+    server: FakeHandleServer
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server._lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args) -> None:
+        _logger.debug(format % args)
+
+    def _respond(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        time.sleep(self.server.latency)
+
+        handle = url.path[len(_HANDLES_PATH):]
+        with self.server._lock:
+            self.server.requests += 1
+            values = self.server.handles.get(handle)
+        if not url.path.startswith(_HANDLES_PATH) or values is None:
+            self._respond(404, {"responseCode": 100, "handle": handle})
+            return
+        self._respond(200, {"responseCode": 1, "handle": handle, "values": values})
+
+    def do_PUT(self) -> None:
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.latency)
+
+        if not url.path.startswith(_HANDLES_PATH):
+            self._respond(404, {"responseCode": 102})
+            return
+        if not self.headers.get("Authorization"):
+            self._respond(401, {"responseCode": 402})
+            return
+
+        handle = url.path[len(_HANDLES_PATH):]
+        overwrite = parse_qs(url.query).get("overwrite", ["true"])[0] == "true"
+        with self.server._lock:
+            self.server.requests += 1
+            if handle in self.server.handles and not overwrite:
+                self._respond(409, {"responseCode": 101, "handle": handle})
+                return
+            self.server.handles[handle] = json.loads(body)["values"]
+        self._respond(201, {"responseCode": 1, "handle": handle})
+
+
+class _FakeSequence:
+    def __init__(self):
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def next(self, day: date) -> int:
+        with self._lock:
+            self._next += 1
+            return self._next
+
+    def close(self) -> None:
+        pass
+
+
+def benchmark(count: int = 500, latency: float = 0.05, workers: int = 8) -> float:
+    """Register count handles with Handle.register_batch against a local FakeHandleServer
+
+    Args:
+        count (int, optional): Number of handles to register. Defaults to 500.
+        latency (float, optional): Seconds each request takes. Defaults to 0.05.
+        workers (int, optional): Maximum number of concurrent requests. Defaults to 8.
+
+    Returns:
+        float: Registrations per second
+    """
+    server = FakeHandleServer(latency=latency).start()
+    rest_client = RestClient(server.url, "300:prefix/admin",
+                             "password", "prefix", pool_size=workers)
+    try:
+        # No database is needed as IDs come from the sequence and duplicates are not checked
+        handle = Handle(None, sequence=_FakeSequence(),
+                        rest_client=rest_client)
+        photo = Photo.from_metadata(
+            "benchmark.jpg", {"date_capture": date(2000, 1, 1)})
+        start = time.perf_counter()
+        results = handle.register_batch(
+            [photo] * count, check_duplicates=False, max_workers=workers)
+        elapsed = time.perf_counter() - start
+    finally:
+        rest_client.close()
+        server.stop()
+
+    failed = len(list(filter(lambda result: not result.ok, results)))
+    print(f"{count} handles, {workers} workers, {latency * 1000:.0f} ms latency: "
+          f"{elapsed:.2f} s, {count / elapsed:.1f} handles/s, "
+          f"{server.connections} connections, {failed} failed")
+    return count / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure handle registration throughput against a local fake handle server")
+    parser.add_argument("-n", "--count", type=int, default=500,
+                        help="Number of handles to register")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds each request takes")
+    parser.add_argument("-w", "--workers", type=int, nargs="+", default=[1, 4, 8, 16],
+                        help="Numbers of concurrent requests to compare")
+    args = parser.parse_args()
+
+    for workers in args.workers:
+        benchmark(args.count, args.latency, workers)
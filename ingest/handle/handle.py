@@ -1,9 +1,11 @@
 import re
 from ..media.image.photo import Photo
 from ..db.db import DB
+from .sequence import HandleSequence
+from .rest import RestClient
 from ..get_config import get_config, ConfigScope
-from typing import Union
-from pyhandle.handleclient import PyHandleClient
+from typing import List, Union
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from datetime import date
 from .. import util, exceptions
@@ -12,24 +14,51 @@ _logger = logging.getLogger(__name__)
 _config = get_config(ConfigScope.HANDLE)
 
 
+class Registration:
+    """Result of registering one handle of a batch
+
+    Attributes:
+        obj (Photo): The registered object
+        handle (str): The handle, None if it could not be made
+        location (str): The location the handle is pointing to
+        error (Exception): The reason the registration failed, None if it succeeded
+    """
+    obj: Photo = None
+    handle: str = None
+    location: str = None
+    error: Exception = None
+
+    def __init__(self, obj: Photo):
+        self.obj = obj
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
 class Handle():
 
     _db: DB = None
-    _handle_client: PyHandleClient = None
+    _rest_client: RestClient = None
+    _sequence: HandleSequence = None
+
+    def __init__(self, db: DB, sequence: HandleSequence = None, rest_client: RestClient = None):
+        """Constructor of the Handle class
 
-    def __init__(self, db: DB):
+        Args:
+            db (DB): Database used to check for duplicates and count existing handles
+            sequence (HandleSequence, optional): Allocate handle IDs from the sequence table instead of counting existing handles. Defaults to None.
+            rest_client (RestClient, optional): Keep-alive client all handles are registered with,
+                a new one is created on first use if None. Defaults to None.
+        """
         self._db = db
-        https_verify = _config.get("httpsverify")
-        try:
-            https_verify = bool(https_verify)
-        except ValueError:
-            pass
-
-        self._handle_client: PyHandleClient = PyHandleClient(
-            "rest").instantiate_with_username_and_password(_config["host"],
-                                                           _config["username"],
-                                                           _config["password"],
-                                                           HTTPS_verify=https_verify)
+        self._sequence = sequence
+        self._rest_client = rest_client
+
+    def _client(self, pool_size: int = 8) -> RestClient:
+        if self._rest_client is None:
+            self._rest_client = RestClient(pool_size=pool_size)
+        return self._rest_client
 
     def _make_handle(self, obj: Photo, check_duplicates: bool = True) -> str:
         """Make a handle string using default definition based on requirement
@@ -46,7 +75,7 @@ class Handle():
         """
         if isinstance(obj, Photo):
             obj: Photo
-            db = DB()
+            db = self._db
 
             # Format "P<DATE>.I<ID>"
             if obj.date_capture:
@@ -55,7 +84,9 @@ class Handle():
                 obj_date = obj.date_export
             elif hasattr(obj, "filepath"):
                 date_regex = r"(\d\d\d\d)-(\d\d)-(\d\d)"
-                res = re.search(date_regex, obj.filepath)
+                # Spooled photos are read from a copy, their date folder is in the path they were spooled from
+                res = re.search(date_regex, getattr(
+                    obj, "source_path", obj.filepath))
                 if res:
                     try:
                         obj_date = date(
@@ -67,15 +98,34 @@ class Handle():
             else:
                 obj_date = date.today()
 
-            if db.photo_has_duplicate(obj):
+            if check_duplicates and db.photo_has_duplicate(obj):
                 _logger.warn(f'Possibe duplicates for "{obj.filename}"')
-                if check_duplicates:
-                    raise exceptions.ObjectDuplicateException
+                raise exceptions.ObjectDuplicateException
 
             prefix = _config["prefix"]
-            handle = f"{prefix}/P{obj_date.isoformat()}.I{db.count_handle(obj_date, prefix) + 1}"
+            if self._sequence:
+                handle_id = self._sequence.next(obj_date)
+            else:
+                handle_id = db.count_handle(obj_date, prefix) + 1
+            handle = f"{prefix}/P{obj_date.isoformat()}.I{handle_id}"
             return handle
 
+    def _prepare(self, obj: Photo, location: str = None, name: str = None, check_duplicates: bool = True) -> Union[None, tuple]:
+        if name:
+            _logger.debug("Using custom name for suffix")
+            handle = f'{_config["prefix"]}/{name}'
+        else:
+            _logger.debug("Making suffix from object")
+            handle = self._make_handle(obj, check_duplicates)
+
+        if handle is None:
+            return None
+
+        if location is None:
+            location = "{}/view/{}".format(util.get_endpoint(obj),
+                                           handle.split("/")[1])
+        return (handle, location)
+
     def register(self, obj: Photo, location: str = None, name: str = None, check_duplicates: bool = True) -> tuple:
         """Register a new handle using an object and it's corrisponding suffix schema.
         The default schema can be overwritten using the name argument.
@@ -90,23 +140,91 @@ class Handle():
             tuple: A tuple containing two values, First element is the newly created handle,
             Second element is the location of which the handle is pointing to
         """
-        if name:
-            _logger.debug("Using custom name for suffix")
-            handle = f'{_config["prefix"]}/{name}'
-        else:
-            _logger.debug("Making suffix from object")
-            handle = self._make_handle(obj, check_duplicates)
-
-        if handle is None:
+        prepared = self._prepare(obj, location, name, check_duplicates)
+        if prepared is None:
             return
+        handle, location = prepared
 
         _logger.info(f'Creating Handle "{handle}"')
-        if location is None:
-            location = "{}/view/{}".format(util.get_endpoint(obj),
-                                           handle.split("/")[1])
-
-        self._handle_client.register_handle(handle, location)
+        # Same request as register_batch, retried by the RestClient while the handle server is throttling
+        self._client().register(handle, location)
         _logger.info(f'Handle "{handle}" created! Pointing to "{location}"')
-        # TODO Error handling
 
         return (handle, location)
+
+    def register_batch(self, objs: List[Photo], check_duplicates: bool = True, max_workers: int = 8) -> List[Registration]:
+        """Register the handles of many objects concurrently.
+        Handles are made one after another, so IDs are allocated in the order of objs,
+        the REST calls then run on up to max_workers threads sharing the keep-alive connections of the RestClient.
+        Failures do not stop the batch, they are reported in the result of the failed object.
+
+        Args:
+            objs (List[Photo]): Photo Objects
+            check_duplicates (bool, optional): Fail the registration of possible duplicates. Defaults to True.
+            max_workers (int, optional): Maximum number of concurrent requests. Defaults to 8.
+
+        Returns:
+            List[Registration]: One result per object, in the order of objs
+        """
+        results = list(map(Registration, objs))
+        for result in results:
+            try:
+                prepared = self._prepare(
+                    result.obj, check_duplicates=check_duplicates)
+                if prepared is None:
+                    raise ValueError(
+                        f"Can not make a handle for {type(result.obj).__name__}")
+                result.handle, result.location = prepared
+            except Exception as e:
+                result.error = e
+
+        self.register_reserved(
+            [result for result in results if result.ok], max_workers)
+        return results
+
+    def reserve(self, obj: Photo, location: str = None, name: str = None, check_duplicates: bool = True) -> tuple:
+        """Make the handle of an object without registering it, for registration through the handle outbox.
+        The handle ID is taken from the sequence, so the handle is unique even if it is never registered.
+
+        Args:
+            obj (Photo): Photo Object
+            location (str, optional): The target location the handle will point to. A location will be created based on the specificationif is None. Defaults to None
+            name (str, optional): Custom Name. Defaults to None.
+            check_duplicates (bool, optional): Skip handle creation if possible duplicates exist. Defaults to True.
+
+        Returns:
+            tuple: A tuple containing two values, First element is the reserved handle,
+            Second element is the location of which the handle will point to
+        """
+        prepared = self._prepare(obj, location, name, check_duplicates)
+        if prepared:
+            _logger.info(f'Reserved Handle "{prepared[0]}"')
+        return prepared
+
+    def register_reserved(self, registrations: List[Registration], max_workers: int = 8, exists_ok: bool = False) -> None:
+        """Register handles that were already made, concurrently over the keep-alive connections of the RestClient.
+        The error of each failed registration is set on its Registration.
+
+        Args:
+            registrations (List[Registration]): Registrations with handle and location set
+            max_workers (int, optional): Maximum number of concurrent requests. Defaults to 8.
+            exists_ok (bool, optional): Treat handles already pointing to their location as registered. Defaults to False.
+        """
+        if not registrations:
+            return
+        rest_client = self._client(max_workers)
+
+        def register(result: Registration) -> None:
+            try:
+                rest_client.register(
+                    result.handle, result.location, exists_ok)
+                result.error = None
+                _logger.info(
+                    f'Handle "{result.handle}" created! Pointing to "{result.location}"')
+            except Exception as e:
+                _logger.warn(f'Failed to create handle "{result.handle}": {e}')
+                result.error = e
+
+        _logger.info(f"Creating {len(registrations)} handles")
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(registrations))) as executor:
+            list(executor.map(register, registrations))
@@ -0,0 +1,131 @@
+import argparse
+import logging
+import sys
+import time
+from typing import List, Tuple
+from pymysql.cursors import Cursor
+from ..db.db import DB
+from .handle import Handle, Registration
+from .rest import RestClient
+
+_logger = logging.getLogger(__name__)
+
+# Seconds until a failed registration is retried, doubled per attempt up to _MAX_BACKOFF
+_BACKOFF = 30
+_MAX_BACKOFF = 3600
+
+
+def pending(db: DB, limit: int = 100, max_attempts: int = 10) -> List[Registration]:
+    """Handles in the outbox that are due for registration, oldest first
+
+    Args:
+        db (DB): Database to read from
+        limit (int, optional): Maximum number of handles. Defaults to 100.
+        max_attempts (int, optional): Leave handles that failed this often for inspection. Defaults to 10.
+
+    Returns:
+        List[Registration]: Registrations with handle and location set
+    """
+    cursor: Cursor = db._connection.cursor()
+    try:
+        cursor.execute("""SELECT handle, location FROM handle_outbox
+            WHERE registered_at IS NULL AND next_attempt_at <= CURRENT_TIMESTAMP AND attempts < %s
+            ORDER BY created_at LIMIT %s;""", (max_attempts, limit))
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    # Do not keep the snapshot of a repeatable read transaction between batches
+    db.commit()
+
+    results = []
+    for row in rows:
+        result = Registration(None)
+        result.handle, result.location = row["handle"], row["location"]
+        results.append(result)
+    return results
+
+
+def _record(db: DB, results: List[Registration]) -> None:
+    cursor: Cursor = db._connection.cursor()
+    try:
+        registered = [(result.handle,) for result in results if result.ok]
+        if registered:
+            cursor.executemany("""UPDATE handle_outbox SET registered_at = CURRENT_TIMESTAMP, last_error = NULL
+                WHERE handle = %s;""", registered)
+        failed = [(str(result.error), result.handle)
+                  for result in results if not result.ok]
+        if failed:
+            cursor.executemany("""UPDATE handle_outbox SET attempts = attempts + 1, last_error = %s,
+                next_attempt_at = CURRENT_TIMESTAMP + INTERVAL LEAST({}, {} * POW(2, attempts)) SECOND
+                WHERE handle = %s;""".format(_MAX_BACKOFF, _BACKOFF), failed)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def drain(db: DB, handle_client: Handle, batch_size: int = 100, max_workers: int = 8, max_attempts: int = 10) -> Tuple[int, int]:
+    """Register all due handles of the outbox in batches.
+    Registration is idempotent, a handle that already points to its location counts as registered,
+    so a handle is never lost or registered twice even if the drainer stops between registering and recording.
+    Failed handles are retried with exponential backoff by later runs.
+
+    Args:
+        db (DB): Database of the outbox
+        handle_client (Handle): Handle client to register with
+        batch_size (int, optional): Number of handles read and registered at once. Defaults to 100.
+        max_workers (int, optional): Maximum number of concurrent requests. Defaults to 8.
+        max_attempts (int, optional): Stop retrying a handle after this many failures. Defaults to 10.
+
+    Returns:
+        Tuple[int, int]: Number of registered and failed handles
+    """
+    registered = 0
+    failed = 0
+    while True:
+        results = pending(db, batch_size, max_attempts)
+        if not results:
+            break
+        handle_client.register_reserved(
+            results, max_workers, exists_ok=True)
+        _record(db, results)
+
+        batch_failed = len(list(filter(lambda result: not result.ok, results)))
+        registered += len(results) - batch_failed
+        failed += batch_failed
+        # Failed handles are not due again yet, a batch of only failures means the server is down
+        if batch_failed == len(results):
+            break
+    return registered, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Register the handles queued by ingest --defer-handles")
+    parser.add_argument("-n", "--batch-size", type=int, default=100,
+                        help="Number of handles registered at once")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="Number of concurrent requests")
+    parser.add_argument("--max-attempts", type=int, default=10,
+                        help="Stop retrying a handle after this many failures")
+    parser.add_argument("--loop", type=float, metavar="SECONDS",
+                        help="Keep draining, checking the outbox every SECONDS")
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    db = DB()
+    rest_client = RestClient(pool_size=args.workers)
+    handle_client = Handle(db, rest_client=rest_client)
+    try:
+        while True:
+            registered, failed = drain(db, handle_client, args.batch_size,
+                                       args.workers, args.max_attempts)
+            print(f"Registered {registered} handles, {failed} failed")
+            if args.loop is None:
+                break
+            time.sleep(args.loop)
+    finally:
+        rest_client.close()
+        db.close()
@@ -0,0 +1,139 @@
+import base64
+import json
+import logging
+from typing import Union
+from urllib.parse import quote
+from ..get_config import get_config, ConfigScope
+from .. import ratelimit
+
+_logger = logging.getLogger(__name__)
+_config = get_config(ConfigScope.HANDLE)
+
+# Same HS_ADMIN entry pyhandle added to new handles by default, when it was used to register handles
+_ADMIN_INDEX = 200
+_ADMIN_PERMISSIONS = "011111110011"
+
+
+class HandleRegistrationError(Exception):
+    """Registering a handle was rejected by the handle server
+
+    Attributes:
+        handle (str): The handle
+        status_code (int): HTTP status of the response, None if the request failed
+    """
+
+    def __init__(self, handle: str, status_code: int = None, message: str = None):
+        self.handle = handle
+        self.status_code = status_code
+        super().__init__(f'Failed to register "{handle}": {status_code} {message}')
+
+
+class RestClient:
+    """Minimal client of the handle server REST API for creating handles.
+    All requests share one requests.Session, so connections (and TLS sessions) are kept alive
+    and reused, the connection pool holds up to pool_size connections for concurrent use.
+    Each registration is a single PUT, unlike PyHandleClient which first reads the handle.
+    """
+
+    def __init__(self, host: str = None, username: str = None, password: str = None, prefix: str = None, https_verify=None, pool_size: int = 8):
+        """Constructor of the RestClient class, all arguments default to the HANDLE section of the config
+
+        Args:
+            host (str, optional): Handle server URL. Defaults to None.
+            username (str, optional): Username in the form index:prefix/suffix. Defaults to None.
+            password (str, optional): Password. Defaults to None.
+            prefix (str, optional): Handle prefix, used for the admin entry. Defaults to None.
+            https_verify (bool | str, optional): Passed to requests as verify. Defaults to None.
+            pool_size (int, optional): Maximum number of kept-alive connections. Defaults to 8.
+        """
+        self._host = (host or _config["host"]).rstrip("/")
+        self._prefix = prefix or _config["prefix"]
+        if https_verify is None:
+            https_verify = _config.get("httpsverify", "True")
+            if https_verify.lower() in ("true", "false"):
+                https_verify = https_verify.lower() == "true"
+
+        credentials = "{}:{}".format(quote(username or _config["username"]),
+                                     password or _config["password"])
+        # requests is imported by the first client, not when the module is imported
+        import requests
+        from requests.adapters import HTTPAdapter
+        self._session = requests.Session()
+        self._session.verify = https_verify
+        self._session.headers.update({
+            "Authorization": "Basic " + base64.b64encode(credentials.encode("utf-8")).decode("ascii"),
+            "Content-Type": "application/json",
+            "Accept": "application/json"
+        })
+        self._limiter = ratelimit.limiter(
+            "handle", _config.getfloat("ratelimit", fallback=None))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def _values(self, location: str) -> dict:
+        return {"values": [
+            {"index": 1, "type": "URL",
+             "data": {"format": "string", "value": location}},
+            {"index": 100, "type": "HS_ADMIN",
+             "data": {"format": "admin", "value": {"handle": f"0.NA/{self._prefix}",
+                                                   "index": _ADMIN_INDEX,
+                                                   "permissions": _ADMIN_PERMISSIONS}}}
+        ]}
+
+    def location(self, handle: str) -> Union[None, str]:
+        """The URL an existing handle is pointing to
+
+        Args:
+            handle (str): Handle in the format of prefix/suffix
+
+        Raises:
+            HandleRegistrationError: If the server did not answer the request
+
+        Returns:
+            Union[None, str]: The URL, None if the handle does not exist or has no URL
+        """
+        response = self._limiter.call(lambda: ratelimit.check_response(self._session.get(
+            f"{self._host}/api/handles/{handle}", params={"type": "URL"})))
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise HandleRegistrationError(
+                handle, response.status_code, response.text)
+        for value in response.json().get("values", []):
+            if value.get("type") == "URL":
+                return value["data"]["value"]
+        return None
+
+    def register(self, handle: str, location: str, exists_ok: bool = False) -> None:
+        """Create a handle pointing to location, an existing handle is not overwritten
+
+        Args:
+            handle (str): Handle in the format of prefix/suffix
+            location (str): The URL the handle will point to
+            exists_ok (bool, optional): Succeed if the handle already exists and points to location,
+                makes retrying a registration safe. Defaults to False.
+
+        Raises:
+            HandleRegistrationError: If the server did not create the handle
+        """
+        attempts = []
+
+        def put():
+            attempts.append(None)
+            return ratelimit.check_response(self._session.put(
+                f"{self._host}/api/handles/{handle}", params={"overwrite": "false"},
+                data=json.dumps(self._values(location))))
+
+        response = self._limiter.call(put)
+        # A retry answered with 409 may find the handle created by the attempt that timed out
+        if response.status_code == 409 and (exists_ok or len(attempts) > 1) and self.location(handle) == location:
+            _logger.debug(f'Handle "{handle}" already registered')
+            return
+        if response.status_code not in (200, 201):
+            raise HandleRegistrationError(
+                handle, response.status_code, response.text)
+        _logger.debug(f'Handle "{handle}" registered')
+
+    def close(self) -> None:
+        self._session.close()
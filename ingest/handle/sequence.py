@@ -0,0 +1,116 @@
+import logging
+import threading
+from datetime import date
+from typing import Dict, Tuple
+from pymysql.cursors import Cursor
+from ..db.db import DB
+
+_logger = logging.getLogger(__name__)
+
+
+class HandleSequence:
+    """Allocates the <ID> of handle suffixes P<DATE>.I<ID> from the handle_sequences table.
+    IDs are reserved in blocks per date with a single atomic increment, after which
+    allocation is local. Safe to share between threads, and between processes and machines
+    as every block is reserved in its own transaction.
+    Unused IDs of a block are given back on close, unless another run reserved IDs of the same date
+    after the block, only then the numbering has gaps.
+    """
+
+    def __init__(self, prefix: str, block_size: int = 20):
+        """Constructor of the HandleSequence class
+
+        Args:
+            prefix (str): Handle prefix the sequence is for
+            block_size (int, optional): Number of IDs reserved at once. Defaults to 20.
+        """
+        self._prefix = prefix
+        self._block_size = block_size
+        self._blocks: Dict[date, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+        # Reservations are committed on their own, independent of the callers transactions
+        self._db: DB = None
+
+    def next(self, day: date) -> int:
+        """Allocate the next ID of a date
+
+        Args:
+            day (date): Date of the handle
+
+        Returns:
+            int: The ID
+        """
+        with self._lock:
+            next_id, end = self._blocks.get(day, (0, 0))
+            if next_id >= end:
+                next_id, end = self._reserve(day)
+            self._blocks[day] = (next_id + 1, end)
+            return next_id
+
+    def _reserve(self, day: date) -> Tuple[int, int]:
+        if self._db is None:
+            self._db = DB()
+        connection = self._db._connection
+        cursor: Cursor = connection.cursor()
+        size = self._block_size
+        try:
+            # Each statement increments the row atomically and commits at once, so no lock is held
+            # between statements and concurrent runs can not deadlock
+            cursor.execute("UPDATE handle_sequences SET next_id = LAST_INSERT_ID(next_id + %s) WHERE prefix = %s AND seq_date = %s;",
+                           (size, self._prefix, day))
+            connection.commit()
+            if cursor.rowcount == 0:
+                # First use of the date, continue after handles created before the sequence existed.
+                # Another run may create the row meanwhile, then its next_id is incremented instead
+                first = self._db.count_handle(day, self._prefix) + 1
+                cursor.execute("""INSERT INTO handle_sequences (prefix, seq_date, next_id) VALUES (%s, %s, LAST_INSERT_ID(%s))
+                    ON DUPLICATE KEY UPDATE next_id = LAST_INSERT_ID(next_id + %s);""",
+                               (self._prefix, day, first + size, size))
+                connection.commit()
+            cursor.execute("SELECT LAST_INSERT_ID() AS end;")
+            end = cursor.fetchone()["end"]
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+        start = end - size
+        _logger.debug(f"Reserved handle IDs {start} to {end - 1} for {day}")
+        return start, end
+
+    def _release(self, day: date, next_id: int, end: int) -> None:
+        connection = self._db._connection
+        cursor: Cursor = connection.cursor()
+        try:
+            # Only possible while no other run reserved IDs of the date after this block
+            cursor.execute("UPDATE handle_sequences SET next_id = %s WHERE prefix = %s AND seq_date = %s AND next_id = %s;",
+                           (next_id, self._prefix, day, end))
+            connection.commit()
+            if cursor.rowcount:
+                _logger.debug(
+                    f"Released handle IDs {next_id} to {end - 1} for {day}")
+            else:
+                _logger.debug(
+                    f"Handle IDs {next_id} to {end - 1} for {day} are lost, the sequence moved on")
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def close(self) -> None:
+        """Give the unused IDs of the last reserved blocks back, then close the connection
+        """
+        with self._lock:
+            if self._db:
+                for day, (next_id, end) in self._blocks.items():
+                    if next_id < end:
+                        try:
+                            self._release(day, next_id, end)
+                        except Exception:
+                            _logger.exception(
+                                f"Failed to release handle IDs of {day}")
+                self._db.close()
+                self._db = None
+            self._blocks = {}
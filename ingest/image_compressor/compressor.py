@@ -5,6 +5,8 @@ from ..util import convert_to_mime
 from typing import List, Tuple
 
 _logger = logging.getLogger(__name__)
+# Image.reduce keeps the image at least this many times larger than the output before resampling
+_REDUCING_GAP = 2
 _compress_default_options = {
     "file_format": "jpg",
     "outputs": [
@@ -41,6 +43,26 @@ _compress_default_options = {
 }
 
 
+def _target_size(size: Tuple[int, int], width: int = None, height: int = None) -> Tuple[int, int]:
+    """Calculate the output size of resize
+
+    Args:
+        size (Tuple[int, int]): Size of the source image
+        width (int, optional): Desired width. Defaults to None.
+        height (int, optional): Desired height. Defaults to None.
+
+    Returns:
+        Tuple[int, int]: The size resize would produce
+    """
+    if width:
+        if height:
+            return (width, height)
+        return (width, int(size[1] * (width / size[0])))
+    elif height:
+        return (int(size[0] * (height / size[1])), height)
+    return size
+
+
 def resize(image: Image.Image, width: int = None, height: int = None) -> Image.Image:
     """Resize an PIL Image object proportionally based on a given values
     If only either width or height is given, scales image proportionally.
@@ -54,26 +76,84 @@ def resize(image: Image.Image, width: int = None, height: int = None) -> Image.I
     Returns:
         Image: Image.Image
     """
-    old_size = image.size
-    if width:
-        if height:
-            new_size = (width, height)
-        else:
-            new_size = (width, int(old_size[1] * (width / old_size[0])))
-    elif height:
-        if width:
-            new_size = (width, height)
-        else:
-            new_size = (int(old_size[0] * (height / old_size[1])), height)
-    else:
+    if not width and not height:
         return image
 
+    new_size = _target_size(image.size, width, height)
     _logger.debug(f"Resizing image to {new_size}")
 
     image = image.resize(new_size)
     return image
 
 
+def _downscale(image: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    """Resize an image to exactly size, using Image.reduce first for large integer factors.
+    The reduced image is kept at least _REDUCING_GAP times larger than size before the final resample.
+
+    Args:
+        image (Image.Image): Source image, upscaled by a plain resize if smaller than size
+        size (Tuple[int, int]): Output size
+
+    Returns:
+        Image.Image: The resized image, image itself if it already has the size
+    """
+    if image.size == size:
+        return image
+
+    factor = min(image.size[0] // size[0],
+                 image.size[1] // size[1]) // _REDUCING_GAP
+    if factor >= 2:
+        _logger.debug(f"Reducing image by {factor}")
+        image = image.reduce(factor)
+
+    _logger.debug(f"Resizing image to {size}")
+    return image.resize(size)
+
+
+def _open_draft(image: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    """Open a not yet loaded JPEG again with DCT scaling, so it is decoded at the smallest scale
+    (1/2 to 1/8) still at least as large as size. The given image itself is left untouched.
+
+    Args:
+        image (Image.Image): Source image opened from a file
+        size (Tuple[int, int]): The largest size needed
+
+    Returns:
+        Image.Image: The loaded draft image, or image if a reduced decode is not possible
+    """
+    if image.format != "JPEG" or not getattr(image, "tile", None) or not getattr(image, "filename", None):
+        return image
+
+    # Decoded within the with block, the file is closed once the pixels are loaded
+    with Image.open(image.filename) as draft:
+        if draft.draft(image.mode, size) is None:
+            return image
+
+        _logger.debug(f"Decoding {image.filename} at {draft.size}")
+        draft.load()
+    return draft
+
+
+def limit_options(max_width: int, options: dict = None) -> dict:
+    """Compress options containing only the outputs up to max_width wide.
+    Without a full size output, compress can decode JPEGs at reduced resolution.
+
+    Args:
+        max_width (int): Widest output to keep
+        options (dict, optional): Options to limit, see _compress_default_option. Uses default options if None is given
+
+    Returns:
+        dict: Limited copy of options
+    """
+    if options is None:
+        options = _compress_default_options
+
+    limited = dict(options)
+    limited["outputs"] = [
+        o for o in options["outputs"] if "w" in o.keys() and o["w"] <= max_width]
+    return limited
+
+
 def save_io(image: Image.Image, img_format: str = "JPEG", quality: int = 85) -> io.BytesIO:
     """Saves an PIL Image to BytesIO
 
@@ -115,20 +195,37 @@ def compress(image: Image.Image, options: dict = None) -> List[Tuple[io.BytesIO,
         options = _compress_default_options
 
     out_format = options["file_format"]
-    out = []
-    for out_options in options["outputs"]:
-        out_img = image.copy()
-
-        out_w = None
-        out_h = None
-
-        if "w" in out_options.keys():
-            out_w = out_options["w"]
 
-        if "h" in out_options.keys():
-            out_h = out_options["h"]
+    # Plan the output sizes from the source, then produce the largest first and derive
+    # each smaller version from the smallest intermediate that is still large enough
+    plans = []
+    for index, out_options in enumerate(options["outputs"]):
+        size = _target_size(image.size, out_options.get("w"),
+                            out_options.get("h"))
+        plans.append((size, index, out_options))
+    plans.sort(key=lambda plan: plan[0][0] * plan[0][1], reverse=True)
+
+    # Without a full size output, JPEGs only need to be decoded at about the largest output size
+    if plans:
+        max_size = (max(map(lambda plan: plan[0][0], plans)),
+                    max(map(lambda plan: plan[0][1], plans)))
+        if max_size[0] < image.size[0] and max_size[1] < image.size[1]:
+            image = _open_draft(image, max_size)
+
+    out = [None] * len(plans)
+    # Only downscaled versions are reused, an upscaled output must not become the source of any other output
+    intermediates = [image]
+    for size, index, out_options in plans:
+        source = image
+        for intermediate in intermediates:
+            if intermediate.size[0] >= size[0] and intermediate.size[1] >= size[1] \
+                    and intermediate.size[0] * intermediate.size[1] < source.size[0] * source.size[1]:
+                source = intermediate
+
+        out_img = _downscale(source, size)
+        if out_img is not source and out_img.size[0] <= image.size[0] and out_img.size[1] <= image.size[1]:
+            intermediates.append(out_img)
 
-        out_img = resize(out_img, out_w, out_h)
         out_b = save_io(out_img, out_format, out_options["quality"])
         out_info = {
             "width": out_img.size[0],
@@ -137,7 +234,7 @@ def compress(image: Image.Image, options: dict = None) -> List[Tuple[io.BytesIO,
             "size_kilobytes": int(out_b.getbuffer().nbytes / 1024),
             "purpose": out_options["purpose"]
         }
-        out.append((out_b, out_info))
+        out[index] = (out_b, out_info)
 
     return out
 
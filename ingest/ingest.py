@@ -1,19 +1,21 @@
-from io import TextIOWrapper
+from io import BytesIO, TextIOWrapper
 import os
 import sys
 import argparse
 import logging
 import itertools
-from .get_config import get_config
-from . import s3io
+from typing import Iterator, List, Tuple
+from .get_config import get_config, get_config_path
+from .exceptions import ConfigError
 from .media.image.photo import Photo
-from .handle.handle import Handle
-from .db.db import DB
-from .image_compressor.compressor import compress
+from .session import Session
+from . import s3io, sanity_ingest
+from .journal import Journal
+from .metadata_cache import MetadataCache
+from .image_compressor.compressor import limit_options
+from .pipeline import Pipeline, PhotoTask, prepare_photo, register_photo, upload_photo, write_photos, finish_photo, spooled_tasks
+from .spool import Spool
 import re
-from uuid import uuid1
-from . import util, exceptions
-from . import sanity_ingest
 
 
 _HIDDEN_FILE_PATTERN = re.compile(r".+[\.].+")
@@ -23,72 +25,103 @@ logging.basicConfig(stream=sys.stdout)
 _logger = logging.getLogger("ingest")
 
 
-def process_photo(path: str, tags: list = None, offline: bool = False, no_compress: bool = False, xmp_file: TextIOWrapper = None, check_duplicates: bool = True, use_sanity: bool = False) -> None:
-    """Process a Photo object
+def publish_photo(photo: Photo, compress_results: List[Tuple[BytesIO, dict]] = None, tags: list = None, offline: bool = False, check_duplicates: bool = True, use_sanity: bool = False, session: Session = None, defer_handles: bool = False) -> None:
+    """Register, upload and write a prepared photo to the database
 
     Args:
-        path (str): Path of the photo object on the machine
+        photo (Photo): The photo returned by prepare_photo
+        compress_results (List[Tuple[BytesIO, dict]], optional): The CDN versions returned by prepare_photo. Defaults to None.
         tags (list, optional): tags to associate with the photo, automatically transform all letters to upper case. Defaults to None.
         offline (bool, optional): disable file upload and database insert. Defaults to False.
-        no_compress (bool, optional): disable compress image. Defaults to False.
-        xmp_file (TextIOWrapper, optional): read metadata from a xmp file. Defaults to None.
         check_duplicates (bool, optional): check for possible duplications in the system. Defaults to True.
         use_sanity (bool, optional): upload the photo to sanity,io. Defaults to False.
+        session (Session, optional): Backends to use, a new session is used for this photo only if None. Defaults to None.
+        defer_handles (bool, optional): Reserve the handle and queue its registration in the handle outbox. Defaults to False.
     """
-    # TODO add support for non local photo source (Ingest by passing bytes or Buffer)
-    _logger.info(f"Start processing {path}")
-    photo = Photo(path, xmp_file=xmp_file)
-    file_extension = photo.data.format.lower()
+    if offline:
+        _logger.info('"offline" selected, skipping upload"')
+        return
 
-    db = DB()
-    handle_client = Handle(db)
+    if session is None:
+        with Session(db_pool_size=1) as session:
+            publish_photo(photo, compress_results, tags, offline,
+                          check_duplicates, use_sanity, session, defer_handles)
+        return
 
     if tags:
         tags = list(map(lambda tag: tag.upper(), tags))
 
-    if not offline:
-        handle, location = handle_client.register(
-            photo, check_duplicates=check_duplicates)
+    task = PhotoTask(getattr(photo, "filepath", photo.filename))
+    task.photo = photo
+    task.compress_results = compress_results
+    if use_sanity:
+        task.sanity_image = sanity_ingest.select_variant(compress_results)
 
-        s3_location = s3io.upload_image(
-            f"{handle}.{file_extension}", photo)
+    with session.db_pool.connection() as db:
+        register_photo(task, session.handle(db), check_duplicates,
+                       defer=defer_handles)
+        upload_photo(task)
+        write_photos([task], db, tags, defer_handles=defer_handles)
+    finish_photo(task, tags, use_sanity)
 
-        db.write_photo(handle, s3_location, photo,
-                       check_duplicate=check_duplicates)
 
-        if tags:
-            db.write_tags(handle, tags)
+def process_photo(path: str, tags: list = None, offline: bool = False, no_compress: bool = False, xmp_file: TextIOWrapper = None, check_duplicates: bool = True, use_sanity: bool = False, session: Session = None, defer_handles: bool = False) -> None:
+    """Process a Photo object
 
-        if use_sanity:
-            sanity_ingest.create_photo_from_object(
-                handle, photo, tags, photo.artist)
-    else:
-        _logger.info('"offline" selected, skipping upload"')
+    Args:
+        path (str): Path of the photo object on the machine
+        tags (list, optional): tags to associate with the photo, automatically transform all letters to upper case. Defaults to None.
+        offline (bool, optional): disable file upload and database insert. Defaults to False.
+        no_compress (bool, optional): disable compress image. Defaults to False.
+        xmp_file (TextIOWrapper, optional): read metadata from a xmp file. Defaults to None.
+        check_duplicates (bool, optional): check for possible duplications in the system. Defaults to True.
+        use_sanity (bool, optional): upload the photo to sanity,io. Defaults to False.
+        session (Session, optional): Backends to use, a new session is used for this photo only if None. Defaults to None.
+        defer_handles (bool, optional): Reserve the handle and queue its registration in the handle outbox. Defaults to False.
+    """
+    # TODO add support for non local photo source (Ingest by passing bytes or Buffer)
+    photo, compress_results = prepare_photo(
+        path, xmp_file.name if xmp_file else None, no_compress)
+    publish_photo(photo, compress_results, tags, offline,
+                  check_duplicates, use_sanity, session, defer_handles)
+
+
+def walk_files(path: str, recursive: bool = False, allow_hidden: bool = False) -> Iterator[str]:
+    """Lazily list the files to process
+
+    Args:
+        path (str): A file or a directory
+        recursive (bool, optional): Walk through all sub directories. Defaults to False.
+        allow_hidden (bool, optional): Include hidden files. Defaults to False.
 
-    if not no_compress:
-        compress_results = compress(photo.data)
-        u = str(uuid1()).split("-")[0]
-        for item in compress_results:
-
-            if not offline:
-                cdn_key = "{}_w{}.{}".format(
-                    handle, item[1]["width"], item[1]["content_type"].split("/")[1])
-                s3io.upload_cdn(cdn_key, item[0], item[1]["content_type"])
-                item[1]["source_handle"] = handle
-            else:
-                cdn_key = "{}_w{}.{}".format(
-                    u, item[1]["width"], item[1]["content_type"].split("/")[1])
-
-            item[1]["cdn_key"] = str(cdn_key)
-            item[1]["location"] = "{}/{}".format(
-                _config["S3_CDN"]["cdn_endpoint"], cdn_key)
-            
-            if not offline:
-                db.write_cdn(item[1])
+    Yields:
+        str: Full path of each file
+    """
+    if os.path.isfile(path):
+        _logger.debug(f"Adding file {path} to queue")
+        yield path
+        return
+
+    # Get all files within the directory
+    if recursive:
+        _logger.debug(
+            f"Recursive, walking through all sub directories of {path}")
+        walk = os.walk(path)
     else:
-        _logger.info('"nocompress" selected, skipping compress')
+        _logger.debug(f"Walking through directory {path}")
+        walk = itertools.islice(os.walk(path), 1)
 
-    db.close()
+    for batch in walk:
+        # Get full path of files
+        files_in_directory = batch[2]
+
+        # Remove hidden files if not specified
+        if not allow_hidden:
+            files_in_directory = [
+                n for n in files_in_directory if _HIDDEN_FILE_PATTERN.match(n)]
+
+        for f in files_in_directory:
+            yield f"{batch[0]}/{f}"
 
 
 if __name__ == "__main__":
@@ -114,8 +147,26 @@ if __name__ == "__main__":
     # TODO add artist and title options
     parser.add_argument("--xmp", metavar="XMP FILE",
                         help="Read metadata from XMP file")
-    parser.add_argument("mode", help="Media type", choices=["photo", "photos"])
-    parser.add_argument("object", help="The Object to process and upload")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="Decode and compress photos using N worker processes")
+    parser.add_argument("--upload-workers", type=int, default=4, metavar="N",
+                        help="Upload N photos at the same time, see uploadconcurrency in the S3 config for the number of concurrent requests")
+    parser.add_argument("--handle-workers", type=int, default=8, metavar="N",
+                        help="Register up to N handles concurrently")
+    parser.add_argument("--defer-handles", action=argparse.BooleanOptionalAction, default=False,
+                        help="Only reserve handles, they are registered later by python -m ingest.handle.outbox")
+    parser.add_argument("--max-width", type=int, metavar="WIDTH",
+                        help="Only create CDN versions up to WIDTH pixels wide, JPEGs are then decoded at reduced resolution")
+    parser.add_argument("--resume", action=argparse.BooleanOptionalAction, default=False,
+                        help="Continue files where the journal says a previous run stopped")
+    parser.add_argument("--spool", action=argparse.BooleanOptionalAction, default=False,
+                        help="Keep the photos prepared by --offline in the spool, to be published later by the sync mode")
+    parser.add_argument("--spool-dir", metavar="DIR",
+                        help="Location of the spool, defaults to a directory in the state directory, see the STATE section of the config file")
+    parser.add_argument("mode", help="Media type, or sync to publish the spooled photos",
+                        choices=["photo", "photos", "sync"])
+    parser.add_argument("object", nargs="?",
+                        help="The Object to process and upload, not used by sync")
 
     _args = parser.parse_args()
 
@@ -123,6 +174,9 @@ if __name__ == "__main__":
         if True in list(map(lambda x: len(x) > 25, _args.tags)):
             raise KeyError("Length of tag id can not exceed 25")
 
+    if _args.jobs < 1 or _args.upload_workers < 1 or _args.handle_workers < 1:
+        raise KeyError("Number of jobs, upload and handle workers must be at least 1")
+
     # Toggle logging mode
     if _args.debug:
         _logger.setLevel(logging.DEBUG)
@@ -131,6 +185,11 @@ if __name__ == "__main__":
         _logger.setLevel(logging.INFO)
 
     # Validate config and arguments
+    try:
+        get_config_path()
+    except ConfigError as e:
+        _logger.critical(e)
+        exit()
     if "HANDLE" not in _config:
         _logger.critical('Section "HANDLE" not in config file')
         exit()
@@ -146,67 +205,80 @@ if __name__ == "__main__":
 
     # Run
 
+    if _args.mode is None:
+        raise NameError("No mode given")
+
+    if _args.mode == "sync":
+        if _args.offline:
+            raise KeyError("Can not sync offline")
+
+        spool = Spool(_args.spool_dir)
+        entries = spool.entries()
+        _logger.info(f"Syncing {len(entries)} spooled photos")
+        journal = Journal()
+        skipped_files = []
+        with Session(handle_pool_size=_args.handle_workers) as session:
+            try:
+                # Tags and sanity were chosen per offline run
+                for (tags, use_sanity), group in itertools.groupby(
+                        entries, key=lambda e: (tuple(e[1]["tags"] or ()), e[1]["sanity"])):
+                    pipeline = Pipeline(list(tags), check_duplicates=not _args.allow_duplicates, use_sanity=use_sanity,
+                                        upload_workers=_args.upload_workers, handle_workers=_args.handle_workers,
+                                        journal=journal, resume=_args.resume, session=session,
+                                        defer_handles=_args.defer_handles, spool=spool)
+                    pipeline.run(spooled_tasks(spool, list(group)))
+                    skipped_files += pipeline.skipped_files
+            finally:
+                journal.close()
+
+        stats = s3io.upload_stats()
+        if stats["skipped"]:
+            _logger.info(
+                f"Skipped {stats['skipped']} unchanged uploads, {stats['skipped_bytes'] / 1024 / 1024:.1f} MiB")
+        if skipped_files:
+            _logger.warn(
+                f"Skipped {len(skipped_files)} files, {str(skipped_files)}")
+        exit()
+
     # Get files to process
+    if _args.object is None:
+        raise KeyError("No object given")
     path = os.path.abspath(_args.object)
-    files_to_process = []
 
     if not os.path.exists(path):
         raise KeyError(f"Path {path} does not exist")
 
-    if os.path.isfile(path):
-        _logger.debug(f"Adding file {path} to queue")
-        files_to_process.append(path)
-    else:
-        # Get all files within the directory
-        if _args.recursive:
-            _logger.debug(
-                f"Recursive, walking through all sub directories of {path}")
-            walk = os.walk(path)
-        else:
-            _logger.debug(f"Walking through directory {path}")
-            walk = [next(os.walk(path))]
-
-        for batch in walk:
-            # Get full path of files
-            files_in_directory = batch[2]
-
-            # Remove hidden files if not specified
-            if not _args.allow_hidden:
-                files_in_directory = [
-                    n for n in files_in_directory if _HIDDEN_FILE_PATTERN.match(n)]
-
-            # Convert filenames to full path
-            files_in_directory = list(map(
-                lambda f, p: f"{p}/{f}", files_in_directory, itertools.repeat(batch[0], len(files_in_directory))))
-
-            files_to_process += files_in_directory
-
-    _logger.info(f"Counted {len(files_to_process)} files, start processing")
-
-    if _args.mode is None:
-        raise NameError("No mode given")
+    if _args.xmp:
+        if not os.path.isfile(path):
+            raise KeyError(
+                "Only one photo allowed if using custom XMP file.")
+        _logger.debug(f"Using external XMP file {_args.xmp}")
 
-    skipped_files = []
     # Start processing
-    for file in files_to_process:
-        try:
-            if _args.mode == "photo" or _args.mode == "photos":
-                xmp_file = None
-                if _args.xmp:
-                    if len(files_to_process) > 1:
-                        raise KeyError(
-                            "Only one photo allowed if using custom XMP file.")
-                    _logger.debug(f"Using external XMP file {_args.xmp}")
-                    xmp_file = open(_args.xmp, "r")
-                    process_photo(file, _args.tags, _args.offline,
-                                  _args.nocompress, xmp_file, check_duplicates=not _args.allow_duplicates, use_sanity=_args.sanity)
-                else:
-                    process_photo(file, _args.tags,
-                                  _args.offline, _args.nocompress, check_duplicates=not _args.allow_duplicates, use_sanity=_args.sanity)
-        except exceptions.ObjectDuplicateException:
-            _logger.info(f"Skipping {file}")
-            skipped_files.append(file)
-            continue
-    if skipped_files:
-        _logger.warn(
-            f"Skipped {len(skipped_files)} files, {str(skipped_files)}")
+    if _args.mode == "photo" or _args.mode == "photos":
+        journal = Journal() if not _args.offline else None
+        metadata_cache = MetadataCache() if not _args.offline else None
+        with Session(handle_pool_size=_args.handle_workers) as session:
+            pipeline = Pipeline(_args.tags, _args.offline, _args.nocompress, _args.xmp,
+                                check_duplicates=not _args.allow_duplicates, use_sanity=_args.sanity,
+                                jobs=_args.jobs, upload_workers=_args.upload_workers, handle_workers=_args.handle_workers,
+                                journal=journal, resume=_args.resume, session=session,
+                                compress_options=limit_options(_args.max_width) if _args.max_width else None,
+                                metadata_cache=metadata_cache, defer_handles=_args.defer_handles,
+                                spool=Spool(_args.spool_dir) if _args.offline and _args.spool else None)
+            try:
+                pipeline.run(walk_files(
+                    path, _args.recursive, _args.allow_hidden))
+            finally:
+                if journal:
+                    journal.close()
+                if metadata_cache:
+                    metadata_cache.close()
+
+        stats = s3io.upload_stats()
+        if stats["skipped"]:
+            _logger.info(
+                f"Skipped {stats['skipped']} unchanged uploads, {stats['skipped_bytes'] / 1024 / 1024:.1f} MiB")
+        if pipeline.skipped_files:
+            _logger.warn(
+                f"Skipped {len(pipeline.skipped_files)} files, {str(pipeline.skipped_files)}")
@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from .get_config import get_state_path
+
+_logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    handle TEXT,
+    location TEXT,
+    s3_location TEXT,
+    cdn_complete INTEGER NOT NULL DEFAULT 0,
+    written INTEGER NOT NULL DEFAULT 0,
+    sanity INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS cdn (
+    path TEXT NOT NULL,
+    cdn_key TEXT NOT NULL,
+    info TEXT NOT NULL,
+    PRIMARY KEY (path, cdn_key)
+);
+"""
+
+
+def default_journal_path() -> str:
+    """The journal is kept in the state directory, see get_state_path
+
+    Returns:
+        str: Path of the journal database
+    """
+    return get_state_path("ingest-journal.db")
+
+
+class Journal:
+    """Crash-safe record of each file's progress through the ingest stages
+    handle -> original upload -> CDN versions -> database -> sanity.
+
+    Every stage is committed to a local SQLite database as soon as it completes,
+    so a resumed run can continue exactly where each file stopped.
+    A single Journal can be shared by all pipeline threads.
+    """
+
+    def __init__(self, path: str = None):
+        """Constructor of the Journal class
+
+        Args:
+            path (str, optional): Location of the journal database. Defaults to default_journal_path().
+        """
+        if path is None:
+            path = default_journal_path()
+        _logger.debug(f"Using ingest journal {path}")
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _execute(self, sql: str, params: tuple = ()) -> None:
+        with self._lock:
+            with self._connection:
+                self._connection.execute(sql, params)
+
+    def begin(self, task, resume: bool = False) -> None:
+        """Start tracking a file. If resume is set and the unchanged file was seen before,
+        the progress of the previous run is restored into the task, otherwise the progress is reset.
+
+        Args:
+            task (PhotoTask): The task of the file
+            resume (bool, optional): Restore progress of a previous run. Defaults to False.
+        """
+        stat = os.stat(task.path)
+        with self._lock:
+            with self._connection:
+                row = self._connection.execute(
+                    "SELECT * FROM files WHERE path = ?", (task.path,)).fetchone()
+
+                if resume and row and row["size"] == stat.st_size and row["mtime"] == stat.st_mtime:
+                    _logger.debug(f"Resuming {task.path} from journal")
+                    task.handle = row["handle"]
+                    task.location = row["location"]
+                    task.s3_location = row["s3_location"]
+                    task.cdn_complete = bool(row["cdn_complete"])
+                    task.written = bool(row["written"])
+                    task.sanity_done = bool(row["sanity"])
+                    task.done = bool(row["done"])
+                    task.cdn = list(map(lambda r: json.loads(r["info"]), self._connection.execute(
+                        "SELECT info FROM cdn WHERE path = ?", (task.path,)).fetchall()))
+                    return
+
+                self._connection.execute(
+                    "DELETE FROM cdn WHERE path = ?", (task.path,))
+                self._connection.execute(
+                    "REPLACE INTO files (path, size, mtime) VALUES (?, ?, ?)", (task.path, stat.st_size, stat.st_mtime))
+
+    def record_handle(self, task) -> None:
+        self._execute("UPDATE files SET handle = ?, location = ? WHERE path = ?",
+                      (task.handle, task.location, task.path))
+
+    def record_original(self, task) -> None:
+        self._execute("UPDATE files SET s3_location = ? WHERE path = ?",
+                      (task.s3_location, task.path))
+
+    def record_cdn(self, task, info: dict) -> None:
+        self._execute("REPLACE INTO cdn (path, cdn_key, info) VALUES (?, ?, ?)",
+                      (task.path, info["cdn_key"], json.dumps(info)))
+
+    def record_cdn_complete(self, task) -> None:
+        self._execute(
+            "UPDATE files SET cdn_complete = 1 WHERE path = ?", (task.path,))
+
+    def record_written(self, task) -> None:
+        self._execute(
+            "UPDATE files SET written = 1 WHERE path = ?", (task.path,))
+
+    def record_sanity(self, task) -> None:
+        self._execute(
+            "UPDATE files SET sanity = 1 WHERE path = ?", (task.path,))
+
+    def record_done(self, task) -> None:
+        self._execute(
+            "UPDATE files SET done = 1 WHERE path = ?", (task.path,))
@@ -0,0 +1,162 @@
+from datetime import datetime
+from PIL import Image, ExifTags
+from typing import Tuple, Union
+import html
+import logging
+import re
+import struct
+import zlib
+
+_logger = logging.getLogger(__name__)
+
+_JPEG_SOI = b"\xff\xd8"
+_JPEG_EXIF = b"Exif\x00\x00"
+_JPEG_XMP = b"http://ns.adobe.com/xap/1.0/\x00"
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_XMP_KEYWORD = b"XML:com.adobe.xmp"
+
+_xmp_date_pattern = r"\b\w+:{}(?:\s*=\s*\"|>)(\d\d\d\d-\d\d-\d\dT\d\d:\d\d:\d\d)"
+_xmp_create_date_pattern = re.compile(_xmp_date_pattern.format("CreateDate"))
+_xmp_modify_date_pattern = re.compile(_xmp_date_pattern.format("ModifyDate"))
+_xmp_raw_filename_pattern = re.compile(
+    r"\b\w+:RawFileName(?:\s*=\s*\"|>)([^\"<]+)")
+
+_EXIF_DATETIME = next(k for k, v in ExifTags.TAGS.items() if v == "DateTime")
+_EXIF_DATETIME_ORIGINAL = next(
+    k for k, v in ExifTags.TAGS.items() if v == "DateTimeOriginal")
+_EXIF_IFD = 0x8769
+
+
+def _read_jpeg_segments(f) -> Tuple[bytes, bytes]:
+    exif = None
+    xmp = None
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            break
+        # Markers without a length
+        if marker[1] in (0x01, 0xD8) or 0xD0 <= marker[1] <= 0xD7:
+            continue
+        # Pixel data starts after start of scan
+        if marker[1] in (0xDA, 0xD9):
+            break
+
+        length = f.read(2)
+        if len(length) < 2:
+            break
+        length = struct.unpack(">H", length)[0] - 2
+
+        if marker[1] == 0xE1:
+            segment = f.read(length)
+            if segment.startswith(_JPEG_EXIF):
+                exif = segment
+            elif segment.startswith(_JPEG_XMP):
+                xmp = segment[len(_JPEG_XMP):]
+        else:
+            f.seek(length, 1)
+    return exif, xmp
+
+
+def _read_png_chunks(f) -> Tuple[bytes, bytes]:
+    exif = None
+    xmp = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack(">I4s", header)
+        # Pixel data starts with the first IDAT chunk
+        if chunk_type in (b"IDAT", b"IEND"):
+            break
+
+        if chunk_type == b"eXIf":
+            exif = f.read(length)
+        elif chunk_type == b"iTXt":
+            chunk = f.read(length)
+            keyword, _, rest = chunk.partition(b"\x00")
+            if keyword == _PNG_XMP_KEYWORD:
+                compressed = rest[0] == 1
+                # Skip compression flag and method, language tag and translated keyword
+                text = rest[2:].split(b"\x00", 2)[2]
+                xmp = zlib.decompress(text) if compressed else text
+        else:
+            f.seek(length, 1)
+        # CRC
+        f.seek(4, 1)
+    return exif, xmp
+
+
+def read_header(path: str) -> Union[None, Tuple[bytes, bytes]]:
+    """Read the raw EXIF and XMP packets from the header of a JPEG or PNG file,
+    stopping before the pixel data.
+
+    Args:
+        path (str): Location of the file
+
+    Returns:
+        Union[None, Tuple[bytes, bytes]]: (exif, xmp), each None if missing. None if the format is not supported
+    """
+    with open(path, "rb") as f:
+        signature = f.read(8)
+        if signature.startswith(_JPEG_SOI):
+            f.seek(2)
+            return _read_jpeg_segments(f)
+        if signature == _PNG_SIGNATURE:
+            return _read_png_chunks(f)
+    return None
+
+
+def read_metadata(path: str) -> Union[None, dict]:
+    """Read the metadata needed for duplicate checks and handle generation from the file header only.
+    The XMP packet is searched with regular expressions instead of being parsed,
+    values found in EXIF take precedence as they do in Photo.
+
+    Args:
+        path (str): Location of the file
+
+    Returns:
+        Union[None, dict]: Photo attributes date_capture, time_capture, date_export, time_export and raw_filename if found.
+        None if the format is not supported
+    """
+    header = read_header(path)
+    if header is None:
+        return None
+    exif_data, xmp = header
+
+    metadata = {}
+    if xmp:
+        xmp = xmp.decode("utf-8", errors="replace")
+        match = _xmp_create_date_pattern.search(xmp)
+        if match:
+            dt = datetime.strptime(match.group(1), "%Y-%m-%dT%H:%M:%S")
+            metadata["date_capture"] = dt.date()
+            metadata["time_capture"] = dt.time()
+        match = _xmp_modify_date_pattern.search(xmp)
+        if match:
+            dt = datetime.strptime(match.group(1), "%Y-%m-%dT%H:%M:%S")
+            metadata["date_export"] = dt.date()
+            metadata["time_export"] = dt.time()
+        match = _xmp_raw_filename_pattern.search(xmp)
+        if match:
+            # The value is still XML escaped, Photo gets it unescaped from the parsed packet.
+            # html.unescape also covers numeric character references, unlike xml.sax.saxutils.unescape
+            metadata["raw_filename"] = html.unescape(match.group(1))
+
+    if exif_data:
+        exif = Image.Exif()
+        exif.load(exif_data)
+        try:
+            if _EXIF_DATETIME in exif:
+                dt = datetime.strptime(exif[_EXIF_DATETIME], "%Y:%m:%d %H:%M:%S")
+                metadata["date_export"] = dt.date()
+                metadata["time_export"] = dt.time()
+            ifd = exif.get_ifd(_EXIF_IFD)
+            if _EXIF_DATETIME_ORIGINAL in ifd:
+                dt = datetime.strptime(
+                    ifd[_EXIF_DATETIME_ORIGINAL], "%Y:%m:%d %H:%M:%S")
+                metadata["date_capture"] = dt.date()
+                metadata["time_capture"] = dt.time()
+        except ValueError:
+            _logger.debug(f"Invalid EXIF date in {path}")
+
+    return metadata
@@ -6,6 +6,7 @@ import re
 import logging
 import os
 from .image import StaticImage
+from .metadata import read_metadata
 import sys
 
 
@@ -66,7 +67,7 @@ class Photo(StaticImage):
     raw_filename: str = None
     filename: str = None
 
-    def __init__(self, data: Union[str, Image.Image, BytesIO], title: str = None, filename: str = None, xmp_file: TextIOWrapper = None):
+    def __init__(self, data: Union[str, Image.Image, BytesIO], title: str = None, filename: str = None, xmp_file: TextIOWrapper = None, metadata_only: bool = False):
         """Constructor of a Photo class
 
         Args:
@@ -74,8 +75,18 @@ class Photo(StaticImage):
             title (str, optional): The optional title for the photo. Defaults to None.
             filename (str, optional): Filename of the photo, required for duplication check if data is of type BytesIO or Image. Defaults to None.
             xmp_file (TextIOWrapper, optional): Custom XMP file to read metadata from. Defaults to None.
+            metadata_only (bool, optional): Only read the dates and raw filename from the header of a JPEG or PNG file given by location,
+                enough for duplicate checks and handle generation. data stays None. Defaults to False.
         """
 
+        if metadata_only and isinstance(data, str):
+            metadata = read_metadata(data)
+            if metadata is not None:
+                self._init_metadata(data, metadata, title)
+                return
+            _logger.debug(
+                f"No header reader for {data}, reading metadata using PIL")
+
         if isinstance(data, str) or isinstance(data, BytesIO):
             _logger.debug(
                 f"data is of type {type(data)}, attempting to open as PIL.Image.Image")
@@ -196,3 +207,87 @@ class Photo(StaticImage):
                         self.artist = v
 
         _logger.debug(self.__dict__)
+
+    def _init_metadata(self, path: str, metadata: dict, title: str = None) -> None:
+        self.filename = os.path.basename(path)
+        self.filepath = os.path.abspath(path)
+        super(Photo, self).__init__(None, title)
+        for k, v in metadata.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def from_metadata(cls, path: str, metadata: dict, title: str = None) -> "Photo":
+        """Create a metadata only Photo from previously read attributes, without opening the file
+
+        Args:
+            path (str): Location of the file
+            metadata (dict): Attributes as returned by Photo.metadata
+            title (str, optional): The optional title for the photo. Defaults to None.
+
+        Returns:
+            Photo: Photo with data set to None
+        """
+        photo = cls.__new__(cls)
+        photo._init_metadata(path, metadata, title)
+        return photo
+
+    def metadata(self) -> dict:
+        """The metadata attributes of the photo which are set
+
+        Returns:
+            dict: Attribute name and value
+        """
+        return {k: v for k, v in self.__dict__.items() if k in Photo.__annotations__ and v is not None}
+
+    def release_data(self) -> None:
+        """Free the decoded pixel data of a photo opened from a path.
+        The image is opened again without decoding it, the pixels are only read from disk if needed again
+        """
+        if self.data is None or "filepath" not in self.__dict__:
+            return
+        self.data.close()
+        self.data = Image.open(self.filepath)
+
+    def __getstate__(self) -> dict:
+        # Photos opened from a path are sent between processes without their pixel data,
+        # the image is lazily re-opened from disk on the receiving side
+        state = self.__dict__.copy()
+        if "filepath" in state:
+            state["data"] = None
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        if self.data is None and "filepath" in state:
+            self.data = Image.open(self.filepath)
+
+
+def serialize_metadata(metadata: dict) -> dict:
+    """Make attributes returned by Photo.metadata JSON serializable, dates and times become ISO strings
+
+    Args:
+        metadata (dict): Attributes as returned by Photo.metadata
+
+    Returns:
+        dict: JSON serializable attributes
+    """
+    return {k: v.isoformat() if isinstance(v, (date, time)) else v for k, v in metadata.items()}
+
+
+def deserialize_metadata(metadata: dict) -> dict:
+    """Reverse of serialize_metadata
+
+    Args:
+        metadata (dict): Attributes as returned by serialize_metadata
+
+    Returns:
+        dict: Attributes as returned by Photo.metadata, usable with Photo.from_metadata
+    """
+    metadata = dict(metadata)
+    for k, v in metadata.items():
+        attr_type = Photo.__annotations__.get(k)
+        if attr_type is date:
+            metadata[k] = date.fromisoformat(v)
+        elif attr_type is time:
+            metadata[k] = time.fromisoformat(v)
+    return metadata
@@ -0,0 +1,200 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Union
+from .get_config import get_state_path
+from .media.image.photo import Photo, serialize_metadata, deserialize_metadata
+
+_logger = logging.getLogger(__name__)
+
+# Number of bytes from the start of the file hashed when content hashes are used, metadata lives in the header
+_HASH_BYTES = 64 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    hash TEXT,
+    metadata TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS metadata_last_used ON metadata (last_used);
+"""
+# Version 1 caches all attributes of Photo, earlier caches only held the dates and raw filename from the header
+_SCHEMA_VERSION = 1
+
+
+def default_cache_path() -> str:
+    """The cache is kept in the state directory, see get_state_path
+
+    Returns:
+        str: Path of the cache database
+    """
+    return get_state_path("metadata-cache.db")
+
+
+def _header_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read(_HASH_BYTES)).hexdigest()
+
+
+def _encode(metadata: dict) -> str:
+    return json.dumps(serialize_metadata(metadata))
+
+
+def _decode(data: str) -> dict:
+    return deserialize_metadata(json.loads(data))
+
+
+class MetadataCache:
+    """On-disk cache of the metadata of photos, keyed by path, size and modification time.
+    Holds all attributes of Photo, so both the duplicate check and the decode stage can skip parsing EXIF and XMP,
+    rescanning an unchanged file costs a single stat() instead of reading its header.
+    The least recently used entries are evicted once max_entries is exceeded.
+    """
+
+    def __init__(self, path: str = None, max_entries: int = 100000, use_hash: bool = False):
+        """Constructor of the MetadataCache class
+
+        Args:
+            path (str, optional): Location of the cache database. Defaults to default_cache_path().
+            max_entries (int, optional): Maximum number of cached files. Defaults to 100000.
+            use_hash (bool, optional): Also compare a hash of the file header, costs a read per lookup. Defaults to False.
+        """
+        if path is None:
+            path = default_cache_path()
+        _logger.debug(f"Using metadata cache {path}")
+
+        self._max_entries = max_entries
+        self._use_hash = use_hash
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+        if self._connection.execute("PRAGMA user_version").fetchone()[0] < _SCHEMA_VERSION:
+            with self._connection:
+                self._connection.execute("DELETE FROM metadata")
+            self._connection.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        self._count = self._connection.execute(
+            "SELECT count(*) FROM metadata").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def get(self, path: str) -> Union[None, dict]:
+        """Cached metadata of an unchanged file
+
+        Args:
+            path (str): Location of the file
+
+        Returns:
+            Union[None, dict]: Attributes as returned by Photo.metadata, None if not cached or the file changed
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT size, mtime, hash, metadata FROM metadata WHERE path = ?", (path,)).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime:
+            return None
+        if self._use_hash and row[2] != _header_hash(path):
+            return None
+
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    "UPDATE metadata SET last_used = ? WHERE path = ?", (time.time(), path))
+        return _decode(row[3])
+
+    def put(self, path: str, metadata: dict) -> None:
+        """Cache the metadata of a file
+
+        Args:
+            path (str): Location of the file
+            metadata (dict): Attributes as returned by Photo.metadata
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        file_hash = _header_hash(path) if self._use_hash else None
+        with self._lock:
+            with self._connection:
+                inserted = self._connection.execute("INSERT OR IGNORE INTO metadata (path, size, mtime, hash, metadata, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                                                    (path, stat.st_size, stat.st_mtime, file_hash, _encode(metadata), time.time())).rowcount
+                if not inserted:
+                    self._connection.execute("UPDATE metadata SET size = ?, mtime = ?, hash = ?, metadata = ?, last_used = ? WHERE path = ?",
+                                             (stat.st_size, stat.st_mtime, file_hash, _encode(metadata), time.time(), path))
+                self._count += inserted
+                if self._count > self._max_entries:
+                    self._evict()
+
+    def _evict(self) -> None:
+        # Evict down to 90% to avoid evicting on every insert
+        keep = int(self._max_entries * 0.9)
+        _logger.debug(f"Evicting metadata cache to {keep} entries")
+        self._connection.execute(
+            "DELETE FROM metadata WHERE path NOT IN (SELECT path FROM metadata ORDER BY last_used DESC LIMIT ?)", (keep,))
+        self._count = self._connection.execute(
+            "SELECT count(*) FROM metadata").fetchone()[0]
+
+    def invalidate(self, path: str = None) -> int:
+        """Remove cached entries
+
+        Args:
+            path (str, optional): Only remove this file or files within this directory. Defaults to None, removing everything.
+
+        Returns:
+            int: Number of removed entries
+        """
+        with self._lock:
+            with self._connection:
+                if path is None:
+                    removed = self._connection.execute(
+                        "DELETE FROM metadata").rowcount
+                else:
+                    path = os.path.abspath(path)
+                    prefix = path.rstrip(os.sep) + os.sep
+                    removed = self._connection.execute("DELETE FROM metadata WHERE path = ? OR substr(path, 1, ?) = ?",
+                                                       (path, len(prefix), prefix)).rowcount
+                self._count -= removed
+        return removed
+
+    def photo(self, path: str) -> Photo:
+        """Metadata only Photo of a file, read from the cache if the file is unchanged.
+        Otherwise all metadata is parsed and cached, which only reads the header of the file, not the pixel data
+
+        Args:
+            path (str): Location of the file
+
+        Returns:
+            Photo: Photo with data set to None, see Photo.from_metadata
+        """
+        metadata = self.get(path)
+        if metadata is not None:
+            _logger.debug(f"Metadata cache hit for {path}")
+            return Photo.from_metadata(path, metadata)
+
+        photo = Photo(path)
+        photo.data.close()
+        metadata = photo.metadata()
+        self.put(path, metadata)
+        return Photo.from_metadata(path, metadata)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Invalidate the photo metadata cache")
+    parser.add_argument("path", nargs="?",
+                        help="Only invalidate this file or directory, invalidates everything if not given")
+    args = parser.parse_args()
+
+    cache = MetadataCache()
+    print(f"Removed {cache.invalidate(args.path)} entries")
+    cache.close()
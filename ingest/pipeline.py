@@ -0,0 +1,702 @@
+from io import BytesIO
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Iterable, List, Tuple, Union
+from PIL import Image
+from .get_config import get_config
+from . import s3io
+from .media.image.photo import Photo
+from .handle.handle import Handle
+from .db.db import DB, WriteBuffer, duplicate_date, duplicate_key
+from .session import Session
+from .image_compressor.compressor import compress
+from . import exceptions
+from . import sanity_ingest
+from .journal import Journal
+from .metadata_cache import MetadataCache
+from .spool import Spool
+
+_logger = logging.getLogger("ingest")
+_config = get_config()
+
+# Marks the end of a stage queue
+_DONE = object()
+# Number of files checked for duplicates with a single query
+_CHECK_BATCH_SIZE = 100
+# Handles are registered concurrently in batches of up to this many photos or seconds
+_REGISTER_BATCH_SIZE = 32
+_REGISTER_BATCH_DELAY = 0.1
+# Photos are written to the database in one transaction per this many photos or seconds
+_WRITE_BATCH_SIZE = 50
+_WRITE_BATCH_DELAY = 0.5
+# Sanity documents are created in one request per this many photos or seconds
+_FINISH_BATCH_SIZE = 50
+_FINISH_BATCH_DELAY = 1
+
+
+class PhotoTask:
+    """A single photo on its way through the ingest pipeline
+
+    Attributes:
+        path (str): Path of the photo object on the machine
+        photo (Photo): The decoded photo, set by the decode stage
+        compress_results (List[Tuple[BytesIO, dict]]): The CDN versions, released once uploaded
+        cdn (List[dict]): Information of the uploaded CDN versions, used to write the cdn table
+        handle (str): The registered handle
+        location (str): The location the handle is pointing to
+        s3_location (str): The location of the original in the main bucket
+        cdn_complete (bool): All CDN versions are uploaded
+        written (bool): The photo is written to the database
+        sanity_done (bool): The photo is uploaded to sanity
+        done (bool): All stages are done
+        prepared (bool): photo and compress_results were set when the task was created, the decode stage is skipped
+        spool_entry (str): The spool entry the task was loaded from, removed once the task is done
+        sanity_image (Tuple[BytesIO, dict]): The CDN version uploaded to sanity, kept after the others are released
+    """
+    path: str = None
+    photo: Photo = None
+    compress_results: List[Tuple[BytesIO, dict]] = None
+    cdn: List[dict] = None
+    handle: str = None
+    location: str = None
+    s3_location: str = None
+    cdn_complete: bool = False
+    written: bool = False
+    sanity_done: bool = False
+    done: bool = False
+    prepared: bool = False
+    spool_entry: str = None
+    sanity_image: Tuple[BytesIO, dict] = None
+
+    def __init__(self, path: str):
+        self.path = path
+
+
+def prepare_photo(path: str, xmp_path: str = None, no_compress: bool = False, compress_options: dict = None, metadata: dict = None) -> Tuple[Photo, List[Tuple[BytesIO, dict]]]:
+    """Decode a photo, parse its metadata and create the CDN versions, the decoded pixels are released afterwards.
+    Does not touch the network or the database, so it is safe to run in a worker process.
+
+    Args:
+        path (str): Path of the photo object on the machine
+        xmp_path (str, optional): read metadata from a xmp file. Defaults to None.
+        no_compress (bool, optional): disable compress image. Defaults to False.
+        compress_options (dict, optional): Options passed to compress. Defaults to None.
+        metadata (dict, optional): Attributes as returned by Photo.metadata, e.g. from the MetadataCache,
+            the metadata of the file is not parsed again if given. Defaults to None.
+
+    Returns:
+        Tuple[Photo, List[Tuple[BytesIO, dict]]]: The photo and the output of compress, None if no_compress is set
+    """
+    _logger.info(f"Start processing {path}")
+    if metadata is not None:
+        photo = Photo.from_metadata(path, metadata)
+        photo.data = Image.open(path)
+    else:
+        xmp_file = open(xmp_path, "r") if xmp_path else None
+        try:
+            photo = Photo(path, xmp_file=xmp_file)
+        finally:
+            if xmp_file:
+                xmp_file.close()
+
+    compress_results = None
+    if not no_compress:
+        compress_results = compress(photo.data, compress_options)
+        # The photo waits in the queues of the later stages, which only need the original file
+        photo.release_data()
+    return photo, compress_results
+
+
+def register_photo(task: PhotoTask, handle_client: Handle, check_duplicates: bool = True, journal: Journal = None, defer: bool = False) -> None:
+    """Register the handle of a prepared photo, does nothing if the task already has a handle
+
+    Args:
+        task (PhotoTask): The task to register
+        handle_client (Handle): Handle client to register with
+        check_duplicates (bool, optional): check for possible duplications in the system. Defaults to True.
+        journal (Journal, optional): Journal to record the progress in. Defaults to None.
+        defer (bool, optional): Only reserve the handle, write_photos queues the registration in the handle outbox. Defaults to False.
+    """
+    if task.handle:
+        _logger.info(f'Reusing handle "{task.handle}" for {task.path}')
+        return
+
+    if defer:
+        task.handle, task.location = handle_client.reserve(
+            task.photo, check_duplicates=check_duplicates)
+    else:
+        task.handle, task.location = handle_client.register(
+            task.photo, check_duplicates=check_duplicates)
+    if journal:
+        journal.record_handle(task)
+
+
+def register_photos(tasks: List[PhotoTask], handle_client: Handle, check_duplicates: bool = True, max_workers: int = 8, journal: Journal = None) -> List[PhotoTask]:
+    """Register the handles of many prepared photos concurrently, skips tasks that already have a handle
+
+    Args:
+        tasks (List[PhotoTask]): The tasks to register
+        handle_client (Handle): Handle client to register with
+        check_duplicates (bool, optional): check for possible duplications in the system. Defaults to True.
+        max_workers (int, optional): Maximum number of concurrent registrations. Defaults to 8.
+        journal (Journal, optional): Journal to record the progress in. Defaults to None.
+
+    Returns:
+        List[PhotoTask]: The tasks that failed, each with the reason logged
+    """
+    for task in tasks:
+        if task.handle:
+            _logger.info(f'Reusing handle "{task.handle}" for {task.path}')
+    tasks = [task for task in tasks if not task.handle]
+    if not tasks:
+        return []
+
+    failed = []
+    results = handle_client.register_batch(
+        list(map(lambda task: task.photo, tasks)), check_duplicates, max_workers)
+    for task, result in zip(tasks, results):
+        if not result.ok:
+            _logger.error(
+                f"Failed to register handle for {task.path}: {result.error}")
+            failed.append(task)
+            continue
+        task.handle, task.location = result.handle, result.location
+        if journal:
+            journal.record_handle(task)
+    return failed
+
+
+def upload_photo(task: PhotoTask, journal: Journal = None, pool: s3io.UploadPool = None, skip_unchanged: bool = False) -> None:
+    """Upload the original and the CDN versions of a registered photo concurrently,
+    skips everything that was already uploaded. Returns once all uploads are done,
+    an upload that failed is raised after the others were recorded.
+
+    Args:
+        task (PhotoTask): The task to upload
+        journal (Journal, optional): Journal to record the progress in. Defaults to None.
+        pool (s3io.UploadPool, optional): Pool to upload in. Defaults to s3io.upload_pool().
+        skip_unchanged (bool, optional): Check for identical objects uploaded by an earlier run, see s3io.upload_image. Defaults to False.
+    """
+    if pool is None:
+        pool = s3io.upload_pool()
+
+    # Future and the CDN key and information of the version, None for the original
+    futures = {}
+    if not task.s3_location:
+        file_extension = task.photo.data.format.lower()
+        filepath = getattr(task.photo, "filepath", None)
+        size = os.path.getsize(filepath) if filepath else 0
+        futures[pool.submit(size, s3io.upload_image,
+                            f"{task.handle}.{file_extension}", task.photo,
+                            skip_unchanged=skip_unchanged)] = None
+
+    if task.compress_results is not None:
+        if task.cdn is None:
+            task.cdn = []
+        uploaded = set(map(lambda info: info["cdn_key"], task.cdn))
+        for data, info in task.compress_results:
+            cdn_key = "{}_w{}.{}".format(
+                task.handle, info["width"], info["content_type"].split("/")[1])
+            if cdn_key in uploaded:
+                continue
+            futures[pool.submit(data.getbuffer().nbytes, s3io.upload_cdn,
+                                cdn_key, data, info["content_type"],
+                                skip_unchanged=skip_unchanged)] = (cdn_key, info)
+
+    error = None
+    for future in as_completed(futures):
+        try:
+            result = future.result()
+        except Exception as e:
+            error = error or e
+            continue
+
+        if futures[future] is None:
+            task.s3_location = result
+            if journal:
+                journal.record_original(task)
+            continue
+
+        cdn_key, info = futures[future]
+        info["source_handle"] = task.handle
+        info["cdn_key"] = str(cdn_key)
+        info["location"] = "{}/{}".format(
+            _config["S3_CDN"]["cdn_endpoint"], cdn_key)
+        task.cdn.append(info)
+        if journal:
+            journal.record_cdn(task, info)
+
+    if error:
+        raise error
+    if task.compress_results is None:
+        return
+
+    task.cdn_complete = True
+    if journal:
+        journal.record_cdn_complete(task)
+    # The encoded versions are not needed anymore
+    task.compress_results = None
+
+
+def write_photos(tasks: List[PhotoTask], db: DB, tags: list = None, journal: Journal = None, defer_handles: bool = False) -> None:
+    """Write uploaded photos, their tags and CDN versions to the database in one transaction,
+    skips photos that were already written
+
+    Args:
+        tasks (List[PhotoTask]): The tasks to write
+        db (DB): Database to write to
+        tags (list, optional): tags to associate with the photos. Defaults to None.
+        journal (Journal, optional): Journal to record the progress in. Defaults to None.
+        defer_handles (bool, optional): Queue the registration of the handles in the handle outbox,
+            in the same transaction. Defaults to False.
+    """
+    tasks = [task for task in tasks if not task.written]
+    buffer = WriteBuffer()
+    for task in tasks:
+        buffer.add_photo(task.handle, task.s3_location, task.photo, tags, task.cdn,
+                         task.location if defer_handles else None)
+    buffer.flush(db)
+
+    for task in tasks:
+        task.written = True
+        if journal:
+            journal.record_written(task)
+
+
+def finish_photo(task: PhotoTask, tags: list = None, use_sanity: bool = False, journal: Journal = None) -> None:
+    """Optionally upload a written photo to sanity and mark it as done
+
+    Args:
+        task (PhotoTask): The task to finish
+        tags (list, optional): tags to associate with the photo. Defaults to None.
+        use_sanity (bool, optional): upload the photo to sanity,io. Defaults to False.
+        journal (Journal, optional): Journal to record the progress in. Defaults to None.
+    """
+    if use_sanity and not task.sanity_done:
+        sanity_ingest.create_photo_from_object(
+            task.handle, task.photo, tags, task.photo.artist, variant=task.sanity_image)
+        task.sanity_done = True
+        if journal:
+            journal.record_sanity(task)
+    task.sanity_image = None
+
+    task.done = True
+    if journal:
+        journal.record_done(task)
+
+
+def finish_photos(tasks: List[PhotoTask], tags: list = None, use_sanity: bool = False, journal: Journal = None) -> List[PhotoTask]:
+    """Optionally upload written photos to sanity and mark them as done.
+    The images are looked up together and only those not yet in sanity are uploaded, one by one,
+    the documents are created together by sanity_ingest.create_photos
+
+    Args:
+        tasks (List[PhotoTask]): The tasks to finish
+        tags (list, optional): tags to associate with the photos. Defaults to None.
+        use_sanity (bool, optional): upload the photos to sanity,io. Defaults to False.
+        journal (Journal, optional): Journal to record the progress in. Defaults to None.
+
+    Returns:
+        List[PhotoTask]: The tasks of which the image upload failed, each with the reason logged
+    """
+    failed = []
+    if use_sanity:
+        pending = [task for task in tasks if not task.sanity_done]
+        try:
+            hashes = sanity_ingest.find_photo_assets(
+                list(map(lambda task: (task.photo, task.sanity_image), pending)))
+        except Exception:
+            _logger.exception(
+                "Failed to look up existing sanity assets, uploading all images")
+            hashes = [None] * len(pending)
+
+        uploaded = []
+        for task, sha1hash in zip(pending, hashes):
+            try:
+                uploaded.append((task, sanity_ingest.upload_photo_asset(
+                    task.photo, task.sanity_image, sha1hash)))
+            except Exception:
+                _logger.exception(
+                    f"Failed to upload {task.path} to sanity, skipping")
+                failed.append(task)
+
+        if uploaded:
+            sanity_ingest.create_photos(list(map(
+                lambda u: (u[0].handle, u[1], tags, u[0].photo.artist, None), uploaded)))
+            for task, _ in uploaded:
+                task.sanity_done = True
+                if journal:
+                    journal.record_sanity(task)
+
+    for task in tasks:
+        task.sanity_image = None
+        if task in failed:
+            continue
+        task.done = True
+        if journal:
+            journal.record_done(task)
+    return failed
+
+
+def spooled_tasks(spool: Spool, entries: List[Tuple[str, dict]]) -> Iterable[PhotoTask]:
+    """Tasks of spooled photos, loaded lazily
+
+    Args:
+        spool (Spool): The spool
+        entries (List[Tuple[str, dict]]): Entries as returned by Spool.entries
+
+    Yields:
+        PhotoTask: Prepared task of each entry
+    """
+    for entry, manifest in entries:
+        try:
+            photo, compress_results = spool.load(entry, manifest)
+        except Exception:
+            _logger.exception(f"Failed to load spool entry {entry}, skipping")
+            continue
+        task = PhotoTask(photo.filepath)
+        task.photo = photo
+        task.compress_results = compress_results
+        task.prepared = True
+        task.spool_entry = entry
+        yield task
+
+
+class Pipeline:
+    """Streaming ingest pipeline.
+    Files flow through bounded queues between the stages check -> decode -> register -> upload -> write -> finish,
+    so processing starts with the first file and memory stays flat regardless of the number of files.
+    Possible duplicates are rejected by the check stage using only the file headers, before any pixel data is decoded.
+    Handles are allocated by a single worker and registered concurrently per batch, decoding runs concurrently.
+    Decoding and encoding the CDN versions share one worker group, so the full resolution pixels are never handed
+    between workers or processes and are released as soon as the CDN versions are encoded.
+    The original and CDN versions of all photos being uploaded share the thread pool of s3io.upload_pool.
+    With defer_handles, handles are only reserved and queued in the handle outbox, to be registered by python -m ingest.handle.outbox.
+    Offline runs with a spool only decode and compress, storing the results in the spool, from where a later run publishes them.
+    Database writes are grouped into one transaction per batch of photos, as are the sanity documents.
+
+    Attributes:
+        skipped_files (List[str]): Files skipped as possible duplicates or because they failed in any stage
+    """
+
+    def __init__(self, tags: list = None, offline: bool = False, no_compress: bool = False, xmp_path: str = None, check_duplicates: bool = True, use_sanity: bool = False, jobs: int = 1, upload_workers: int = 4, handle_workers: int = 8, queue_size: int = None, journal: Journal = None, resume: bool = False, session: Session = None, compress_options: dict = None, metadata_cache: MetadataCache = None, defer_handles: bool = False, spool: Spool = None):
+        """Constructor of the Pipeline class
+
+        Args:
+            tags (list, optional): tags to associate with the photos, automatically transform all letters to upper case. Defaults to None.
+            offline (bool, optional): disable file upload and database insert. Defaults to False.
+            no_compress (bool, optional): disable compress image. Defaults to False.
+            xmp_path (str, optional): read metadata from a xmp file. Defaults to None.
+            check_duplicates (bool, optional): check for possible duplications in the system. Defaults to True.
+            use_sanity (bool, optional): upload the photos to sanity,io. Defaults to False.
+            jobs (int, optional): Number of processes decoding and compressing photos. Defaults to 1.
+            upload_workers (int, optional): Number of photos uploaded at the same time, their files share the s3io upload pool. Defaults to 4.
+            handle_workers (int, optional): Number of concurrent requests registering handles. Defaults to 8.
+            queue_size (int, optional): Maximum number of photos waiting between two stages. Defaults to 2 * jobs.
+            journal (Journal, optional): Journal to record the progress of each file in. Defaults to None.
+            resume (bool, optional): Continue files from where the journal says a previous run stopped. Defaults to False.
+            session (Session, optional): Backends to use, a session is created and closed by run if None. Defaults to None.
+            compress_options (dict, optional): Options passed to compress. Defaults to None.
+            metadata_cache (MetadataCache, optional): Cache of the metadata used by the duplicate check and the decode stage. Defaults to None.
+            defer_handles (bool, optional): Reserve handles and queue their registration in the handle outbox. Defaults to False.
+            spool (Spool, optional): Offline runs store the prepared photos here, otherwise spooled tasks are removed once done
+                or skipped as duplicates. Defaults to None.
+        """
+        self._tags = list(map(lambda tag: tag.upper(), tags)) if tags else None
+        self._offline = offline
+        self._no_compress = no_compress
+        self._xmp_path = xmp_path
+        self._check_duplicates = check_duplicates
+        self._use_sanity = use_sanity
+        self._jobs = jobs
+        self._upload_workers = upload_workers
+        self._handle_workers = handle_workers
+        self._queue_size = queue_size if queue_size else jobs * 2
+        self._executor: ProcessPoolExecutor = None
+        self._journal = journal
+        self._resume = resume
+        self._session = session
+        self._compress_options = compress_options
+        self._metadata_cache = metadata_cache
+        self._defer_handles = defer_handles
+        self._spool = spool
+
+        # Duplicate key and date of each checked file, mapped to its path
+        self._seen_keys = {}
+
+        self.skipped_files = []
+
+    def _drop_spooled(self, task: PhotoTask) -> None:
+        # A spooled photo that is never going to be published would otherwise stay in the spool forever
+        if self._spool and task.spool_entry:
+            _logger.info(f"Removing {task.path} from the spool")
+            self._spool.remove(task.spool_entry)
+
+    def _begin(self, task: PhotoTask) -> bool:
+        if self._journal:
+            self._journal.begin(task, self._resume)
+            if task.done:
+                _logger.info(f"{task.path} already ingested, skipping")
+                self._drop_spooled(task)
+                return False
+        return True
+
+    def _read_header(self, task: PhotoTask) -> None:
+        if task.prepared:
+            return
+        if self._metadata_cache:
+            task.photo = self._metadata_cache.photo(task.path)
+        else:
+            task.photo = Photo(task.path, metadata_only=True)
+
+    def _check(self, tasks: List[PhotoTask]) -> List[PhotoTask]:
+        tasks = [task for task in tasks if self._run_task(self._begin, task)]
+        if not self._check_duplicates:
+            return tasks
+
+        # Files resumed after registration were already checked by the previous run
+        passed = set(filter(lambda task: task.handle, tasks))
+        to_check = [task for task in tasks if not task.handle and self._run_task(
+            self._read_header, task)]
+
+        if to_check:
+            headers = list(map(lambda task: task.photo, to_check))
+            with self._session.db_pool.connection() as db:
+                duplicates = db.photos_have_duplicates(headers)
+
+            for task, header, duplicate in zip(to_check, headers, duplicates):
+                # The header photo is replaced by the decode stage
+                if not task.prepared:
+                    task.photo = None
+                key = (duplicate_date(header), duplicate_key(header))
+                if not duplicate and key[1] is not None:
+                    # Also catch duplicates within this run, which are not written yet
+                    # A file checked again after its batch failed is no duplicate of itself
+                    duplicate = self._seen_keys.setdefault(
+                        key, task.path) != task.path
+
+                if duplicate:
+                    _logger.warn(f'Possibe duplicates for "{header.filename}"')
+                    _logger.info(f"Skipping {task.path}")
+                    self.skipped_files.append(task.path)
+                    self._drop_spooled(task)
+                else:
+                    passed.add(task)
+
+        # Keep the order of the batch
+        return [task for task in tasks if task in passed]
+
+    def _decode(self, task: PhotoTask) -> bool:
+        if task.prepared:
+            return True
+        no_compress = self._no_compress
+        compress_options = self._compress_options
+        if task.cdn_complete:
+            # All CDN versions were uploaded by a previous run, only the one sent to sanity may still be needed
+            compress_options = None
+            if self._use_sanity and not task.sanity_done:
+                compress_options = sanity_ingest.variant_options(
+                    self._compress_options)
+            no_compress = no_compress or compress_options is None
+        # Metadata from a custom XMP file is not cached
+        cache = self._metadata_cache if not self._xmp_path else None
+        # Usually cached by the check stage just before
+        metadata = cache.get(task.path) if cache else None
+        if self._executor:
+            future = self._executor.submit(
+                prepare_photo, task.path, self._xmp_path, no_compress, compress_options, metadata)
+            task.photo, task.compress_results = future.result()
+        else:
+            task.photo, task.compress_results = prepare_photo(
+                task.path, self._xmp_path, no_compress, compress_options, metadata)
+        if cache and metadata is None:
+            cache.put(task.path, task.photo.metadata())
+
+        if self._offline:
+            if self._spool:
+                self._spool.add(task.path, task.photo, task.compress_results,
+                                self._tags, self._use_sanity)
+                task.compress_results = None
+            else:
+                _logger.info(
+                    f'"offline" selected, skipping upload of {task.path}')
+        return True
+
+    def _register(self, tasks: List[PhotoTask]) -> List[PhotoTask]:
+        with self._session.db_pool.connection() as db:
+            handle_client = self._session.handle(db)
+            # Duplicates were already checked by the check stage
+            if self._defer_handles:
+                return [task for task in tasks if self._run_task(
+                    lambda task: register_photo(task, handle_client, False, self._journal, defer=True), task)]
+            failed = register_photos(tasks, handle_client, False,
+                                     self._handle_workers, self._journal)
+        self.skipped_files += list(map(lambda task: task.path, failed))
+        return [task for task in tasks if task not in failed]
+
+    def _upload(self, task: PhotoTask) -> None:
+        if self._use_sanity:
+            task.sanity_image = sanity_ingest.select_variant(
+                task.compress_results)
+        # Only a resumed run may find objects uploaded without being recorded in the journal
+        upload_photo(task, self._journal, skip_unchanged=self._resume)
+
+    def _finish(self, tasks: List[PhotoTask]) -> List[PhotoTask]:
+        failed = finish_photos(tasks, self._tags,
+                               self._use_sanity, self._journal)
+        self.skipped_files += list(map(lambda task: task.path, failed))
+        tasks = [task for task in tasks if task not in failed]
+        if self._spool:
+            for task in tasks:
+                if task.spool_entry:
+                    self._spool.remove(task.spool_entry)
+        return tasks
+
+    def _write(self, tasks: List[PhotoTask]) -> List[PhotoTask]:
+        with self._session.db_pool.connection() as db:
+            write_photos(tasks, db, self._tags,
+                         self._journal, self._defer_handles)
+        return tasks
+
+    def _run_batch(self, func: Callable[[List[PhotoTask]], List[PhotoTask]], tasks: List[PhotoTask]) -> List[PhotoTask]:
+        try:
+            return func(tasks)
+        except Exception:
+            if len(tasks) == 1:
+                _logger.exception(
+                    f"Failed to process {tasks[0].path}, skipping")
+                self.skipped_files.append(tasks[0].path)
+                return []
+            _logger.exception(
+                f"Failed to process {len(tasks)} files, retrying them one by one")
+
+        # Every stage skips the work already done for a task, so only the files that fail on their own are skipped
+        passed = []
+        for task in tasks:
+            passed += self._run_batch(func, [task])
+        return passed
+
+    def _run_task(self, func: Callable[[PhotoTask], bool], task: PhotoTask) -> bool:
+        try:
+            return func(task) is not False
+        except exceptions.ObjectDuplicateException:
+            _logger.info(f"Skipping {task.path}")
+            self.skipped_files.append(task.path)
+            self._drop_spooled(task)
+        except Exception:
+            _logger.exception(f"Failed to process {task.path}, skipping")
+            self.skipped_files.append(task.path)
+        return False
+
+    def _start_stage(self, name: str, func: Callable, inbox: queue.Queue, outbox: queue.Queue = None, workers: int = 1, batch_size: int = 1, batch_delay: float = 0) -> List[threading.Thread]:
+        remaining = [workers]
+        lock = threading.Lock()
+
+        def work():
+            done = False
+            while not done:
+                # Batches take up to batch_size tasks, waiting at most batch_delay seconds for more
+                batch = [inbox.get()]
+                deadline = time.monotonic() + batch_delay
+                while len(batch) < batch_size and batch[-1] is not _DONE:
+                    timeout = deadline - time.monotonic()
+                    try:
+                        if timeout > 0:
+                            batch.append(inbox.get(timeout=timeout))
+                        else:
+                            batch.append(inbox.get_nowait())
+                    except queue.Empty:
+                        break
+                if batch[-1] is _DONE:
+                    # Let the other workers of this stage see the end as well
+                    inbox.put(_DONE)
+                    batch.pop()
+                    done = True
+
+                if batch_size > 1:
+                    passed = self._run_batch(func, batch) if batch else []
+                else:
+                    passed = [task for task in batch if self._run_task(func, task)]
+
+                if outbox is not None:
+                    for task in passed:
+                        outbox.put(task)
+
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0 and outbox is not None:
+                    outbox.put(_DONE)
+
+        threads = [threading.Thread(target=work, name=f"{name}-{i}", daemon=True)
+                   for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def run(self, files: Iterable[Union[str, PhotoTask]]) -> None:
+        """Run all files through the pipeline, returns after the last file is done
+
+        Args:
+            files (Iterable[Union[str, PhotoTask]]): Paths of the photos or tasks created by the caller, consumed lazily
+        """
+        decode_queue = queue.Queue(self._queue_size)
+        inbox = decode_queue
+        threads = []
+        owns_session = False
+
+        if self._jobs > 1:
+            self._executor = ProcessPoolExecutor(max_workers=self._jobs)
+
+        try:
+            if self._offline:
+                threads += self._start_stage("decode", self._decode,
+                                             decode_queue, workers=self._jobs)
+            else:
+                check_queue = queue.Queue(
+                    max(self._queue_size, _CHECK_BATCH_SIZE))
+                inbox = check_queue
+                register_queue = queue.Queue(
+                    max(self._queue_size, _REGISTER_BATCH_SIZE))
+                upload_queue = queue.Queue(self._queue_size)
+                write_queue = queue.Queue(
+                    max(self._queue_size, _WRITE_BATCH_SIZE))
+                finish_queue = queue.Queue(
+                    max(self._queue_size, _FINISH_BATCH_SIZE))
+
+                if self._session is None:
+                    self._session = Session(
+                        handle_pool_size=self._handle_workers)
+                    owns_session = True
+
+                threads += self._start_stage("check", self._check, check_queue,
+                                             decode_queue, batch_size=_CHECK_BATCH_SIZE)
+                threads += self._start_stage("decode", self._decode, decode_queue,
+                                             register_queue, self._jobs)
+                threads += self._start_stage("register", self._register, register_queue, upload_queue,
+                                             batch_size=_REGISTER_BATCH_SIZE, batch_delay=_REGISTER_BATCH_DELAY)
+                threads += self._start_stage("upload", self._upload, upload_queue,
+                                             write_queue, self._upload_workers)
+                threads += self._start_stage("write", self._write, write_queue, finish_queue,
+                                             batch_size=_WRITE_BATCH_SIZE, batch_delay=_WRITE_BATCH_DELAY)
+                threads += self._start_stage("finish", self._finish, finish_queue,
+                                             batch_size=_FINISH_BATCH_SIZE, batch_delay=_FINISH_BATCH_DELAY)
+
+            try:
+                for path in files:
+                    inbox.put(path if isinstance(
+                        path, PhotoTask) else PhotoTask(path))
+            finally:
+                inbox.put(_DONE)
+                for thread in threads:
+                    thread.join()
+        finally:
+            if self._executor:
+                self._executor.shutdown()
+                self._executor = None
+            if owns_session:
+                self._session.close()
+                self._session = None
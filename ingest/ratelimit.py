@@ -0,0 +1,230 @@
+import logging
+import random
+import threading
+import time
+import sys
+from collections import deque
+from typing import TYPE_CHECKING, Callable, Dict, TypeVar
+
+if TYPE_CHECKING:
+    import requests
+
+_logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# HTTP status codes and S3 error codes of a backend asking to slow down
+_THROTTLE_STATUS = {429, 502, 503, 504}
+# Statuses of requests the backend refused without applying them
+_REFUSED_STATUS = {429, 503}
+_THROTTLE_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded",
+                   "TooManyRequests", "ServiceUnavailable", "RequestTimeout"}
+
+_limiters: Dict[str, "RateLimiter"] = {}
+_limiters_lock = threading.Lock()
+
+
+class ThrottledError(Exception):
+    """A backend answered with a status asking the client to slow down
+
+    Attributes:
+        status_code (int): HTTP status of the response
+        retry_after (float): Seconds the backend asked to wait, None if not given
+    """
+
+    def __init__(self, status_code: int, retry_after: float = None, message: str = None):
+        self.status_code = status_code
+        self.retry_after = retry_after
+        super().__init__(f"Throttled with status {status_code}: {message}")
+
+
+def check_response(response: "requests.Response") -> "requests.Response":
+    """Raise ThrottledError if a response asks to slow down
+
+    Args:
+        response (requests.Response): The response
+
+    Raises:
+        ThrottledError: If the status is 429 or a temporary server error
+
+    Returns:
+        requests.Response: The response
+    """
+    if response.status_code in _THROTTLE_STATUS:
+        retry_after = response.headers.get("Retry-After")
+        try:
+            retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            retry_after = None
+        raise ThrottledError(response.status_code,
+                             retry_after, response.text[:200])
+    return response
+
+
+def is_throttled(e: Exception, idempotent: bool = True) -> bool:
+    """Whether an exception is worth retrying after slowing down.
+    Understands ThrottledError, connection errors of requests, botocore ClientError
+    and exceptions carrying the requests.Response they failed with, like requests.HTTPError.
+    A call that is not idempotent is only retried if the backend can not have applied it,
+    when it refused the request with 429 or 503 or the connection could not be established.
+
+    Args:
+        e (Exception): The exception
+        idempotent (bool, optional): Repeating the call has the same effect as making it once. Defaults to True.
+
+    Returns:
+        bool: True if the call should be retried
+    """
+    if isinstance(e, ThrottledError):
+        return idempotent or e.status_code in _REFUSED_STATUS
+    # requests is not imported here, an exception of requests can only occur once it is loaded
+    requests = sys.modules.get("requests")
+    if requests and isinstance(e, requests.ConnectTimeout):
+        return True
+    if requests and isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return idempotent
+    response = getattr(e, "response", None)
+    if isinstance(response, dict):
+        # botocore ClientError
+        error = response.get("Error", {})
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        if idempotent:
+            return error.get("Code") in _THROTTLE_CODES or status in _THROTTLE_STATUS
+        return status in _REFUSED_STATUS
+    status = getattr(response, "status_code", None)
+    return status in (_THROTTLE_STATUS if idempotent else _REFUSED_STATUS)
+
+
+class RateLimiter:
+    """Adaptive rate limiter of the calls to one backend, shared by all threads.
+    Calls are not paced at all until the backend throttles for the first time,
+    the rate then starts at decrease times the rate of the calls made during the second before.
+    While paced, the rate grows additively by about increase calls per second each second while calls
+    succeed and is multiplied by decrease when the backend throttles again (AIMD), so it settles around
+    the rate the backend can sustain. Pacing stops again once the backend has not throttled for recovery seconds
+    or the rate reached max_rate.
+    Throttled calls are retried after an exponential backoff with full jitter.
+    """
+
+    def __init__(self, name: str, max_rate: float = None, min_rate: float = 0.5, increase: float = 1, decrease: float = 0.5, recovery: float = 30, max_retries: int = 6, base_delay: float = 0.5, max_delay: float = 30):
+        """Constructor of the RateLimiter class
+
+        Args:
+            name (str): Name of the backend, used in log messages
+            max_rate (float, optional): Calls per second never exceeded, the calls are always paced if set. Defaults to None.
+            min_rate (float, optional): Lowest calls per second. Defaults to 0.5.
+            increase (float, optional): Calls per second added per second of successful calls. Defaults to 1.
+            decrease (float, optional): Factor applied to the rate when throttled. Defaults to 0.5.
+            recovery (float, optional): Seconds without throttling after which calls are no longer paced. Defaults to 30.
+            max_retries (int, optional): Retries of a throttled call before its error is raised. Defaults to 6.
+            base_delay (float, optional): Backoff before the first retry in seconds. Defaults to 0.5.
+            max_delay (float, optional): Longest backoff in seconds. Defaults to 30.
+        """
+        self.name = name
+        # None while calls are not paced
+        self.rate = max_rate
+        self._max_rate = max_rate
+        self._min_rate = min_rate
+        self._increase = increase
+        self._decrease = decrease
+        self._recovery = recovery
+        self._max_retries = max_retries
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+        self._last_decrease = 0
+        # Start times of the calls of the last second while not paced
+        self._recent = deque()
+
+    def acquire(self) -> None:
+        """Wait for the next free slot at the current rate, returns at once while calls are not paced
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.rate is None:
+                self._recent.append(now)
+                while self._recent[0] < now - 1:
+                    self._recent.popleft()
+                return
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def success(self) -> None:
+        with self._lock:
+            if self.rate is None or (self._max_rate is not None and self._last_decrease == 0):
+                return
+            # A successful call adds increase / rate, summing up to increase per second
+            self.rate = self.rate + self._increase / self.rate
+            recovered = time.monotonic() - self._last_decrease > self._recovery
+            if self._max_rate is not None:
+                self.rate = min(self._max_rate, self.rate)
+            elif recovered:
+                self.rate = None
+                self._recent.clear()
+                _logger.info(
+                    f"{self.name} stopped throttling, no longer limiting the rate")
+
+    def throttled(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            # Calls in flight when the backend started throttling only count once
+            if now - self._last_decrease < 1:
+                return
+            self._last_decrease = now
+            if self.rate is None:
+                self.rate = len(self._recent)
+                self._next_slot = now
+            self.rate = max(self._min_rate, self.rate * self._decrease)
+            _logger.info(
+                f"{self.name} is throttling, reducing rate to {self.rate:.1f}/s")
+
+    def call(self, func: Callable[..., T], *args, idempotent: bool = True, **kwargs) -> T:
+        """Call func at the limited rate, retrying while it is throttled
+
+        Args:
+            func (Callable[..., T]): The call to the backend, raising on failure
+            idempotent (bool, optional): func may be repeated after it failed in a way that leaves open
+                whether the backend applied it, see is_throttled. Defaults to True.
+
+        Returns:
+            T: The return value of func
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self._max_retries or not is_throttled(e, idempotent):
+                    raise
+                self.throttled()
+                delay = random.uniform(0, min(self._max_delay,
+                                              self._base_delay * 2 ** attempt))
+                delay = max(delay, getattr(e, "retry_after", None) or 0)
+                attempt += 1
+                _logger.debug(
+                    f"{self.name} call failed ({e}), retry {attempt} in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            self.success()
+            return result
+
+
+def limiter(name: str, max_rate: float = None) -> RateLimiter:
+    """The rate limiter of a backend, shared by the whole process
+
+    Args:
+        name (str): Name of the backend
+        max_rate (float, optional): Calls per second never exceeded, if the limiter is created. Defaults to None.
+
+    Returns:
+        RateLimiter: The limiter, created on first use
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = RateLimiter(name, max_rate)
+        return _limiters[name]
@@ -0,0 +1,67 @@
+import logging
+import threading
+from typing import Any, Callable, Dict
+
+_logger = logging.getLogger(__name__)
+
+_factories: Dict[str, Callable[[], Any]] = {}
+_instances: Dict[str, Any] = {}
+# Reentrant, a factory may get the backends it depends on
+_lock = threading.RLock()
+
+
+def register(name: str, factory: Callable[[], Any]) -> None:
+    """Declare how a backend is built, without building it
+
+    Args:
+        name (str): Name of the backend
+        factory (Callable[[], Any]): Builds the backend, called once on first use
+    """
+    with _lock:
+        _factories[name] = factory
+
+
+def get(name: str) -> Any:
+    """The backend of the process, built by its factory on first use
+
+    Args:
+        name (str): Name of the backend
+
+    Raises:
+        KeyError: If no factory is registered under name
+
+    Returns:
+        Any: The backend
+    """
+    instance = _instances.get(name)
+    if instance is not None:
+        return instance
+    with _lock:
+        if name not in _instances:
+            _logger.debug(f"Creating {name}")
+            _instances[name] = _factories[name]()
+        return _instances[name]
+
+
+def override(name: str, instance: Any) -> None:
+    """Use instance as backend instead of building it, e.g. a fake in tests
+
+    Args:
+        name (str): Name of the backend
+        instance (Any): The backend to return from get
+    """
+    with _lock:
+        _instances[name] = instance
+
+
+def reset(name: str = None) -> None:
+    """Forget built backends, the next get builds them again
+
+    Args:
+        name (str, optional): Backend to forget, all if None. Defaults to None.
+    """
+    with _lock:
+        if name is None:
+            _instances.clear()
+        else:
+            _instances.pop(name, None)
@@ -1,9 +1,12 @@
 from io import BytesIO
-import boto3
-from typing import Union
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Union
 from PIL import Image
 from .media.image.photo import Photo
 from .get_config import get_config, ConfigScope
+from . import ratelimit, registry
 import logging
 
 _logger = logging.getLogger(f"{__name__}")
@@ -11,29 +14,239 @@ _logger = logging.getLogger(f"{__name__}")
 _config = get_config(ConfigScope.S3)
 _config_cdn = get_config(ConfigScope.S3_CDN)
 
-_s3client = boto3.client(
-    "s3",
-    endpoint_url=_config["endpoint"],
-    aws_access_key_id=_config["accesskeyid"],
-    aws_secret_access_key=_config["accesskeysecret"]
-)
+# boto3 is only imported, and the clients only built, once something is uploaded
 
-_s3client_cdn = None
-if _config.getboolean("cdnseperatekey", fallback=False):
-    _s3client_cdn = boto3.client(
+
+def _create_transfer_config():
+    from boto3.s3.transfer import TransferConfig
+    # Files larger than the threshold are uploaded in parts, using up to transferconcurrency threads per file
+    return TransferConfig(
+        multipart_threshold=_config.getint(
+            "multipartthreshold", fallback=16 * 1024 * 1024),
+        multipart_chunksize=_config.getint(
+            "multipartchunksize", fallback=16 * 1024 * 1024),
+        max_concurrency=_config.getint("transferconcurrency", fallback=4))
+
+
+def _create_client(config):
+    import boto3
+    from botocore.config import Config
+    # Enough connections for every upload of the pool to be a multipart upload.
+    # botocore retries a failed request once, persistent throttling is left to the rate limiter
+    client_config = Config(
+        max_pool_connections=_config.getint("uploadconcurrency", fallback=10) *
+        registry.get("s3.transfer_config").max_request_concurrency,
+        retries={"mode": "standard", "total_max_attempts": 2})
+    return boto3.client(
         "s3",
-        endpoint_url=_config_cdn["endpoint"],
-        aws_access_key_id=_config_cdn["accesskeyid"],
-        aws_secret_access_key=_config_cdn["accesskeysecret"]
+        endpoint_url=config["endpoint"],
+        aws_access_key_id=config["accesskeyid"],
+        aws_secret_access_key=config["accesskeysecret"],
+        config=client_config
     )
-else:
-    _s3client_cdn = _s3client
 
-_main_bucket_name = _config["bucketname"]
-_cdn_bucket_name = _config_cdn["bucketname"]
 
+def _create_cdn_client():
+    if _config.getboolean("cdnseperatekey", fallback=False):
+        return _create_client(_config_cdn)
+    return registry.get("s3")
+
+
+registry.register("s3.transfer_config", _create_transfer_config)
+registry.register("s3", lambda: _create_client(_config))
+registry.register("s3.cdn", _create_cdn_client)
+
+
+def _limiter() -> ratelimit.RateLimiter:
+    return ratelimit.limiter("s3", _config.getfloat("ratelimit", fallback=None))
+
+
+def _head_limiter() -> ratelimit.RateLimiter:
+    # HEAD requests are cheap for S3 and do not count against the uploads
+    return ratelimit.limiter("s3-head", _config.getfloat("ratelimit", fallback=None))
+
+
+_pool: "UploadPool" = None
+_pool_lock = threading.Lock()
+
+_stats = {"uploaded": 0, "uploaded_bytes": 0,
+          "skipped": 0, "skipped_bytes": 0}
+_stats_lock = threading.Lock()
+
+
+class UploadPool:
+    """Thread pool for uploads with a cap on the total size of the uploads in flight.
+    Submitting blocks while the cap would be exceeded, an upload larger than the cap
+    is only started once nothing else is in flight.
+    """
+
+    def __init__(self, max_workers: int = 10, max_bytes: int = 64 * 1024 * 1024):
+        """Constructor of the UploadPool class
+
+        Args:
+            max_workers (int, optional): Maximum number of concurrent uploads. Defaults to 10.
+            max_bytes (int, optional): Maximum total size of the uploads in flight. Defaults to 64 MiB.
+        """
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="s3-upload")
+        self._max_bytes = max_bytes
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def submit(self, size: int, func: Callable, *args, **kwargs) -> Future:
+        """Run an upload in the pool once size bytes fit into the budget
+
+        Args:
+            size (int): Number of bytes the upload sends
+            func (Callable): The upload function, called with args and kwargs
+
+        Returns:
+            Future: Result of func
+        """
+        with self._condition:
+            while self._in_flight and self._in_flight + size > self._max_bytes:
+                self._condition.wait()
+            self._in_flight += size
+
+        def release(_):
+            with self._condition:
+                self._in_flight -= size
+                self._condition.notify_all()
+
+        try:
+            future = self._executor.submit(func, *args, **kwargs)
+        except Exception:
+            release(None)
+            raise
+        future.add_done_callback(release)
+        return future
+
+    def shutdown(self) -> None:
+        self._executor.shutdown()
+
+
+def upload_pool() -> UploadPool:
+    """The upload pool shared by all threads, sized by uploadconcurrency and uploadmaxbytes of the S3 config
+
+    Returns:
+        UploadPool: The shared pool, created on first use
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = UploadPool(_config.getint("uploadconcurrency", fallback=10),
+                               _config.getint("uploadmaxbytes", fallback=64 * 1024 * 1024))
+        return _pool
+
+
+def upload_stats() -> dict:
+    """Number and size of the objects uploaded and skipped as unchanged by this process
+
+    Returns:
+        dict: uploaded, uploaded_bytes, skipped and skipped_bytes
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def etag(fileobj) -> str:
+    """The ETag S3 gives an object uploaded by upload_fileobj with the current TransferConfig,
+    the MD5 of the content or for multipart uploads the MD5 of the part MD5s followed by the number of parts.
+    The file object is read from its current position, which is restored afterwards.
+
+    Args:
+        fileobj: Readable and seekable binary file object
+
+    Returns:
+        str: The ETag without quotes
+    """
+    from s3transfer.utils import ChunksizeAdjuster
+    transfer_config = registry.get("s3.transfer_config")
+    start = fileobj.tell()
+    size = fileobj.seek(0, 2) - start
+    fileobj.seek(start)
+    try:
+        if size < transfer_config.multipart_threshold:
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: fileobj.read(1024 * 1024), b""):
+                md5.update(chunk)
+            return md5.hexdigest()
+
+        chunksize = ChunksizeAdjuster().adjust_chunksize(
+            transfer_config.multipart_chunksize, size)
+        digests = [hashlib.md5(part).digest()
+                   for part in iter(lambda: fileobj.read(chunksize), b"")]
+        return "{}-{}".format(hashlib.md5(b"".join(digests)).hexdigest(), len(digests))
+    finally:
+        fileobj.seek(start)
+
+
+def _unchanged(client, bucket: str, key: str, fileobj, content_type: str) -> bool:
+    from botocore.exceptions import ClientError
+    try:
+        head = _head_limiter().call(client.head_object, Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+    return head.get("ContentType") == content_type and head["ETag"].strip('"') == etag(fileobj)
+
+
+class _KeepOpen:
+    """File object wrapper ignoring close, s3transfer closes the file objects it uploads
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+    def close(self) -> None:
+        pass
+
+
+def _upload(client, bucket: str, key: str, fileobj, content_type: str, skip_unchanged: bool = False) -> None:
+    start = fileobj.tell()
+    size = fileobj.seek(0, 2) - start
+    fileobj.seek(start)
+
+    # Check existing objects with head_object and skip uploading identical content,
+    # costs a request per object, so only done where the object may exist already
+    skip_unchanged = skip_unchanged or _config.getboolean(
+        "skipunchanged", fallback=False)
+    if skip_unchanged and _unchanged(client, bucket, key, fileobj, content_type):
+        _logger.info(f"{key} is unchanged, skipping upload")
+        with _stats_lock:
+            _stats["skipped"] += 1
+            _stats["skipped_bytes"] += size
+        return
+
+    def upload():
+        # A retry starts over from the beginning
+        fileobj.seek(start)
+        # upload_fileobj reads the file object in parts instead of copying it into one request body
+        client.upload_fileobj(_KeepOpen(fileobj), bucket, key,
+                              ExtraArgs={"ContentType": content_type},
+                              Config=registry.get("s3.transfer_config"))
+
+    _limiter().call(upload)
+    with _stats_lock:
+        _stats["uploaded"] += 1
+        _stats["uploaded_bytes"] += size
+
+
+def upload_image(key: str, data: Union[Photo, Image.Image], content_type: str = None, skip_unchanged: bool = False):
+    if isinstance(data, Photo) and getattr(data, "filepath", None):
+        # Archive the untouched original, streamed from disk without decoding it
+        _logger.debug(f"Content Type is {data.content_type}")
+        _logger.info('Starting S3 upload for {} from {}'.format(
+            key, data.filepath))
+        with open(data.filepath, "rb") as f:
+            _upload(registry.get("s3"), _config["bucketname"],
+                    key, f, data.content_type, skip_unchanged)
+        return f"s3://{_config['bucketname']}/{key}"
 
-def upload_image(key: str, data: Union[Photo, Image.Image], content_type: str = None):
     if isinstance(data, Image.Image) and content_type is None:
         # TODO convert format to mime type
         content_type = f"image/{(data.format.lower())}"
@@ -47,16 +260,13 @@ def upload_image(key: str, data: Union[Photo, Image.Image], content_type: str =
     _logger.debug(f"Content Type is {content_type}")
 
     _logger.info('Starting S3 upload for {}'.format(key))
-    res = _s3client.put_object(
-        Body=raw_data.getvalue(),
-        Key=key,
-        Bucket=_main_bucket_name,
-        ContentType=content_type
-    )
-    return f"s3://{_main_bucket_name}/{key}"
+    raw_data.seek(0)
+    _upload(registry.get("s3"), _config["bucketname"],
+            key, raw_data, content_type, skip_unchanged)
+    return f"s3://{_config['bucketname']}/{key}"
 
 
-def upload_cdn(key: str, data=Union[Photo, Image.Image, BytesIO], content_type: str = None):
+def upload_cdn(key: str, data=Union[Photo, Image.Image, BytesIO], content_type: str = None, skip_unchanged: bool = False):
     if isinstance(data, Image.Image) and content_type is None:
         content_type = f"image/{data.format.lower()}"
         raw_data = BytesIO()
@@ -71,9 +281,6 @@ def upload_cdn(key: str, data=Union[Photo, Image.Image, BytesIO], content_type:
         content_type = data.content_type
         raw_data = data.save_io()
 
-    res = _s3client_cdn.put_object(
-        Body=raw_data.getvalue(),
-        Key=key,
-        Bucket=_cdn_bucket_name,
-        ContentType=content_type
-    )
+    raw_data.seek(0)
+    _upload(registry.get("s3.cdn"), _config_cdn["bucketname"],
+            key, raw_data, content_type, skip_unchanged)
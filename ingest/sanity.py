@@ -1,11 +1,40 @@
-from io import BytesIO
+import hashlib
 import json
-import requests
-from typing import Union
+import threading
+from typing import BinaryIO, Dict, List, Union
 import logging
+from . import ratelimit
 
 _logger = logging.getLogger(__name__)
 
+_HASH_CHUNK = 1024 * 1024
+# Hashes looked up with one query at most, keeps the GET query string short
+_MAX_HASHES_PER_QUERY = 200
+
+
+def sha1(data: Union[bytes, str, BinaryIO]) -> str:
+    """SHA-1 of an image, the way sanity identifies image assets
+
+    Args:
+        data (Union[bytes, str, BinaryIO]): image data, the path of an image file or a seekable binary file object,
+            hashed from its current position which is restored afterwards
+
+    Returns:
+        str: The hex digest
+    """
+    if isinstance(data, bytes):
+        return hashlib.sha1(data).hexdigest()
+    if isinstance(data, str):
+        with open(data, "rb") as f:
+            return sha1(f)
+
+    digest = hashlib.sha1()
+    start = data.tell()
+    for chunk in iter(lambda: data.read(_HASH_CHUNK), b""):
+        digest.update(chunk)
+    data.seek(start)
+    return digest.hexdigest()
+
 
 class SanityClientException(Exception):
     def __init__(self, *args: object) -> None:
@@ -18,9 +47,23 @@ class SanityUnauthorizedException(SanityClientException):
 
 
 class SanityClient:
-    def __init__(self, project_id: str, token: str, api_version="v2021-06-07", use_cdn=False):
+    def __init__(self, project_id: str, token: str, api_version="v2021-06-07", use_cdn=False, max_rate: float = None, pool_size: int = 10):
         self._auth_token = token
+        # Requests are retried while sanity answers 429, all clients of the process share one limit
+        self._limiter = ratelimit.limiter("sanity", max_rate)
+        # Connections are kept alive and reused by all requests of the client
+        # requests is imported by the first client, not when the module is imported
+        import requests
+        from requests.adapters import HTTPAdapter
+        self._session = requests.Session()
+        self._session.headers.update(
+            {"Authorization": f"Bearer {self._auth_token}"})
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
         self._api_version = api_version
+        # Asset id of each image hash looked up or uploaded by this client, None if not in the dataset
+        self._assets: Dict[str, Union[None, str]] = {}
+        self._assets_lock = threading.Lock()
         self._use_cdn = use_cdn
         if use_cdn:
             self._url = f"https://{project_id}.apicdn.sanity.io/{api_version}"
@@ -28,14 +71,14 @@ class SanityClient:
             self._url = f"https://{project_id}.api.sanity.io/{api_version}"
 
     def query(self, dataset: str, query: str) -> Union[None, list]:
-        res = requests.get(f"{self._url}/data/query/{dataset}",
-                           headers={
-                               "Authorization": f"Bearer {self._auth_token}",
-                               "Content-Type": "application/json"
-                           },
-                           params={
-                               "query": query
-                           })
+        res = self._limiter.call(lambda: ratelimit.check_response(
+            self._session.get(f"{self._url}/data/query/{dataset}",
+                              headers={
+                                  "Content-Type": "application/json"
+                              },
+                              params={
+                                  "query": query
+                              })))
 
         res_json = res.json()
         if len(res_json["result"]) == 0:
@@ -50,51 +93,104 @@ class SanityClient:
             mutations = {"mutations": mutations}
 
         mutatetion_data = json.dumps(mutations)
+        # Repeating a transaction with a plain create after a lost response would create the documents twice
+        idempotent = not any("create" in mutation for mutation in mutations["mutations"])
         _logger.debug(
             "Sending mutation request, using dataset {}".format(dataset))
-        res = requests.post(f"{self._url}/data/mutate/{dataset}",
-                            headers={
-                                "Authorization": f"Bearer {self._auth_token}",
-                                "Content-Type": "application/json"
-                            },
-                            params={
-                                "returnIds": "true" if return_ids else "false",
-                                "returnDocuments": "true" if return_documents else "false",
-                                "visibility": visibility,
-                                "autoGenerateArrayKeys": "true" if auto_generate_array_keys else "false",
-                                "dryRun": "true" if dry_run else "false"
-                            },
-                            data=mutatetion_data)
+        res = self._limiter.call(lambda: ratelimit.check_response(
+            self._session.post(f"{self._url}/data/mutate/{dataset}",
+                               headers={
+                                   "Content-Type": "application/json"
+                               },
+                               params={
+                                   "returnIds": "true" if return_ids else "false",
+                                   "returnDocuments": "true" if return_documents else "false",
+                                   "visibility": visibility,
+                                   "autoGenerateArrayKeys": "true" if auto_generate_array_keys else "false",
+                                   "dryRun": "true" if dry_run else "false"
+                               },
+                               data=mutatetion_data)), idempotent=idempotent)
 
         if res.status_code != 200:
             raise SanityClientException(res.json())
 
         return res.json()
 
-    def upload_image(self, dataset: str, data: BytesIO, mime_type: str) -> str:
-        """Upload an image to the sanity asset api image endpoint
+    def find_images(self, dataset: str, hashes: List[str]) -> Dict[str, str]:
+        """Look up image assets by SHA-1, hashes not looked up before by this client are queried at once.
+        The results are remembered, so upload_image does not ask again
+
+        Args:
+            dataset (str): The dataset of the assets
+            hashes (List[str]): SHA-1 hex digests as returned by sha1
+
+        Returns:
+            Dict[str, str]: The sanity _id of each hash with an existing asset
+        """
+        with self._assets_lock:
+            unknown = list(dict.fromkeys(
+                h for h in hashes if h not in self._assets))
+        for i in range(0, len(unknown), _MAX_HASHES_PER_QUERY):
+            chunk = unknown[i:i + _MAX_HASHES_PER_QUERY]
+            res = self.query(
+                dataset, f'*[_type == "sanity.imageAsset" && sha1hash in {json.dumps(chunk)}]{{_id, sha1hash}}')
+            found = dict(map(lambda e: (e["sha1hash"], e["_id"]), res or []))
+            _logger.debug(
+                f"{len(found)} of {len(chunk)} images already exist in dataset {dataset}")
+            with self._assets_lock:
+                for h in chunk:
+                    self._assets[h] = found.get(h)
+
+        with self._assets_lock:
+            return {h: self._assets[h] for h in hashes if self._assets.get(h)}
+
+    def upload_image(self, dataset: str, data: Union[bytes, str, BinaryIO], mime_type: str, sha1hash: str = None) -> str:
+        """Upload an image to the sanity asset api image endpoint.
+        The image is hashed first, if an asset with the same SHA-1 exists its id is returned without sending the image.
+        Files and file objects are streamed instead of being read into memory.
 
         Args:
             dataset (str): The dataset of the asset
-            data (BytesIO): image data
+            data (Union[bytes, str, BinaryIO]): image data, the path of an image file or a seekable binary file object such as BytesIO, read from its current position
             image_type (str): the image format im mime type format
+            sha1hash (str, optional): SHA-1 of the image if already known, e.g. from a batch passed to find_images. Defaults to None.
 
         Returns:
             str: The sanity _id value
         """
-        # TODO read data from file
-
-        if not isinstance(data, bytes):
-            if isinstance(data, BytesIO):
-                data = data.read()
+        if isinstance(data, str):
+            with open(data, "rb") as f:
+                return self.upload_image(dataset, f, mime_type, sha1hash)
+
+        if sha1hash is None:
+            sha1hash = sha1(data)
+        existing = self.find_images(dataset, [sha1hash]).get(sha1hash)
+        if existing:
+            _logger.debug(f"Image {sha1hash} already exists as {existing}")
+            return existing
+
+        start = data.tell() if not isinstance(data, bytes) else None
+
+        def post():
+            # A retry sends the file object again from the start
+            if start is not None:
+                data.seek(start)
+            return ratelimit.check_response(
+                self._session.post(f"{self._url}/assets/images/{dataset}",
+                                   headers={
+                                       "Content-Type": mime_type
+                                   },
+                                   data=data))
 
         _logger.debug(
             "Uploading image to sanity api asset endpoint, using dataset {}".format(dataset))
-        res = requests.post(f"{self._url}/assets/images/{dataset}",
-                            headers={
-                                "Authorization": f"Bearer {self._auth_token}",
-                                "Content-Type": mime_type
-                            },
-                            data=data).json()
-
-        return res["document"]["_id"]
+        # Asset ids are derived from the SHA-1 of the image, uploading it again returns the same asset
+        res = self._limiter.call(post).json()
+
+        asset_id = res["document"]["_id"]
+        with self._assets_lock:
+            self._assets[sha1hash] = asset_id
+        return asset_id
+
+    def close(self) -> None:
+        self._session.close()
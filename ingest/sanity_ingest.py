@@ -1,26 +1,204 @@
-from .sanity import SanityClient
+from .sanity import SanityClient, sha1
 from .get_config import get_config, ConfigScope
-from typing import List, Dict, Union
+from io import BytesIO
+from typing import List, Dict, Tuple, Union
 from ingest.media.image.photo import Photo
 from ingest.image_compressor import compressor
-from . import util
+from . import util, registry
+import json
 import logging
+import re
+import sys
+import threading
 
 _config = get_config(ConfigScope.SANITY)
-_sanity_client = SanityClient(_config["project_id"], _config["token"])
-_dataset = _config["dataset"]
 _logger = logging.getLogger(__name__)
 
+registry.register("sanity", lambda: SanityClient(_config["project_id"], _config["token"],
+                                                 max_rate=_config.getfloat("ratelimit", fallback=None)))
+
+# Limits of a single mutation request of create_photos, well below the request size limit of sanity
+_MAX_MUTATIONS = 200
+_MAX_MUTATION_BYTES = 1024 * 1024
+
+# Tag ids known to exist, created or checked during this run
+_ensured_tags = set()
+_ensured_tags_lock = threading.Lock()
+
 # Create photo from Photo Object
 
 
-def create_photo_from_object(handle: str, photo: Photo, tags: List[str] = None, artist: str = None, title: str = None):
+def select_variant(compress_results: List[Tuple[BytesIO, dict]]) -> Union[None, Tuple[BytesIO, dict]]:
+    """The CDN version to send to sanity, the widest one up to the imagewidth of the sanity config
+
+    Args:
+        compress_results (List[Tuple[BytesIO, dict]]): The output of compress
+
+    Returns:
+        Union[None, Tuple[BytesIO, dict]]: The CDN version, None if the original should be sent
+    """
+    # Widest CDN version sent to sanity instead of the full resolution image, "original" sends the original file
+    image_width = _config.get("imagewidth", "2000")
+    if not compress_results or image_width == "original":
+        return None
+    max_width = int(image_width)
+    fitting = [result for result in compress_results if result[1]
+               ["width"] <= max_width]
+    if fitting:
+        return max(fitting, key=lambda result: result[1]["width"])
+    return min(compress_results, key=lambda result: result[1]["width"])
+
+
+def variant_options(options: dict = None) -> Union[None, dict]:
+    """Compress options producing only the CDN version select_variant picks,
+    for photos of which all other CDN versions were uploaded by a previous run
+
+    Args:
+        options (dict, optional): Options the CDN versions were created with. Uses default options if None is given
+
+    Returns:
+        Union[None, dict]: The options, None if the original is sent to sanity
+    """
+    image_width = _config.get("imagewidth", "2000")
+    if image_width == "original":
+        return None
+    # All outputs of a fixed width
+    sized = compressor.limit_options(sys.maxsize, options)
+    if not sized["outputs"]:
+        return options
+    fitting = [o for o in sized["outputs"] if o["w"] <= int(image_width)]
+    # Like select_variant, the widest fitting version or else the narrowest one
+    sized["outputs"] = [max(fitting, key=lambda o: o["w"]) if fitting
+                        else min(sized["outputs"], key=lambda o: o["w"])]
+    return sized
+
+
+def _asset_source(photo: Photo, variant: Tuple[BytesIO, dict] = None) -> Union[None, Tuple[Union[BytesIO, str], str]]:
+    if variant:
+        data, info = variant
+        data.seek(0)
+        return data, info["content_type"]
+    if getattr(photo, "filepath", None):
+        return photo.filepath, photo.content_type
+    return None
+
+
+def find_photo_assets(photos: List[Tuple[Photo, Tuple[BytesIO, dict]]]) -> List[Union[None, str]]:
+    """Hash the images of many photos and look them up in sanity with a single query,
+    so upload_photo_asset can reuse existing assets without sending or hashing them again
+
+    Args:
+        photos (List[Tuple[Photo, Tuple[BytesIO, dict]]]): Each photo with the CDN version as selected by select_variant, which may be None
+
+    Returns:
+        List[Union[None, str]]: SHA-1 of the image of each photo, to be passed to upload_photo_asset,
+            None for photos that are encoded at upload
+    """
+    hashes = []
+    for photo, variant in photos:
+        source = _asset_source(photo, variant)
+        hashes.append(sha1(source[0]) if source else None)
+    known = [h for h in hashes if h]
+    if known:
+        registry.get("sanity").find_images(_config["dataset"], known)
+    return hashes
+
+
+def upload_photo_asset(photo: Photo, variant: Tuple[BytesIO, dict] = None, sha1hash: str = None) -> str:
+    """Upload the image of a photo as sanity asset without encoding it again.
+    Sends the given CDN version, or streams the original file. Only photos not opened from a file are encoded.
+    Nothing is sent if an asset of the same image already exists.
+
+    Args:
+        photo (Photo): The photo
+        variant (Tuple[BytesIO, dict], optional): CDN version as selected by select_variant. Defaults to None.
+        sha1hash (str, optional): SHA-1 of the image as returned by find_photo_assets. Defaults to None.
+
+    Returns:
+        str: The asset id
+    """
+    source = _asset_source(photo, variant)
+    if source:
+        return registry.get("sanity").upload_image(_config["dataset"], source[0], source[1], sha1hash)
+
     image_data = compressor.save_io(photo.data)
-    asset_id = _sanity_client.upload_image(
-        _dataset, image_data, util.convert_to_mime(photo.data.format))
+    return registry.get("sanity").upload_image(
+        _config["dataset"], image_data, util.convert_to_mime(photo.data.format))
+
+
+def create_photo_from_object(handle: str, photo: Photo, tags: List[str] = None, artist: str = None, title: str = None, variant: Tuple[BytesIO, dict] = None):
+    asset_id = upload_photo_asset(photo, variant)
     create_photo(handle, asset_id, tags, artist, title)
 
 
+def _photo_id(handle: str) -> str:
+    # Dots in sanity ids mark documents outside the root path, which are not public
+    return "photo_" + re.sub(r"[^a-zA-Z0-9_-]", "-", handle.replace("/", "_"))
+
+
+def _photo_document(handle: str, asset_id: str, tag_ids: List[str] = None, artist: str = None, title: str = None) -> dict:
+    document = {
+        "_id": _photo_id(handle),
+        "_type": "photo",
+        "objectID": handle.split("/")[1],
+        "hdlPrefix": handle.split("/")[0],
+        "photo": {"_type": "image",
+                  "asset": {
+                      "_type": "reference",
+                      "_ref": f"{asset_id}"
+                  }
+                  }
+    }
+    if tag_ids:
+        document["tags"] = list(
+            map(lambda e: {"_type": "reference", "_ref": e}, tag_ids))
+    if title:
+        document["title"] = title
+    if artist:
+        document["artist"] = artist
+    return document
+
+
+def create_photos(photos: List[Tuple[str, str, List[str], str, str]]) -> List[str]:
+    """Create many entries in the Photo table with as few requests as possible.
+    Tags of all photos are ensured at once, skipping tags already ensured during this run,
+    the photos are then created in transactions of up to _MAX_MUTATIONS documents and _MAX_MUTATION_BYTES.
+
+    Args:
+        photos (List[Tuple[str, str, List[str], str, str]]): handle, asset id, list of tag ids, artist and title of each photo,
+            tags, artist and title may be None
+
+    Returns:
+        List[str]: The sanity _id of each created document, in the order of photos
+    """
+    all_tags = []
+    for _, _, tags, _, _ in photos:
+        all_tags += [tag for tag in tags or [] if tag not in all_tags]
+    tag_ids = dict(zip(all_tags, ensure_tags(all_tags))) if all_tags else {}
+
+    # The id of a photo is derived from its handle, so sending the same photo again does not create a second document
+    mutations = list(map(lambda photo: {"createIfNotExists": _photo_document(
+        photo[0], photo[1], [tag_ids[tag] for tag in photo[2] or []], photo[3], photo[4])}, photos))
+
+    ids = []
+    chunk = []
+    chunk_bytes = 0
+    for mutation in mutations + [None]:
+        size = len(json.dumps(mutation)) if mutation else 0
+        if chunk and (mutation is None or len(chunk) >= _MAX_MUTATIONS or chunk_bytes + size > _MAX_MUTATION_BYTES):
+            _logger.info(
+                f"Inserting {len(chunk)} photos to sanity dataset {_config['dataset']}")
+            res = registry.get("sanity").mutate(
+                _config["dataset"], chunk, visibility="async", return_ids=True, auto_generate_array_keys=True)
+            ids += list(map(lambda e: e["id"], res["results"]))
+            chunk = []
+            chunk_bytes = 0
+        if mutation:
+            chunk.append(mutation)
+            chunk_bytes += size
+    return ids
+
+
 def create_photo(handle: str, asset_id: str, tags: List[str] = None, artist: str = None, title: str = None) -> dict:
     """Create an entry in the Photo table
 
@@ -34,35 +212,41 @@ def create_photo(handle: str, asset_id: str, tags: List[str] = None, artist: str
     Returns:
         dict: sanity api response parsed to dict
     """
-    mutate = {
-        "create": {
-            "_type": "photo",
-            "objectID": handle.split("/")[1],
-            "hdlPrefix": handle.split("/")[0],
-            "photo": {"_type": "image",
-                      "asset": {
-                          "_type": "reference",
-                          "_ref": f"{asset_id}"
-                      }
-                      }
-        }
-    }
-
     if tags:
-        tags = create_return_tags(tags)
-        mutate["create"]["tags"] = list(
-            map(lambda e: {"_type": "reference", "_ref": e}, tags))
-    if title:
-        mutate["create"]["title"] = title
-    if artist:
-        mutate["create"]["artist"] = artist
+        tags = ensure_tags(tags)
+    mutate = {"createIfNotExists": _photo_document(
+        handle, asset_id, tags, artist, title)}
 
-    _logger.info(f"Inserting to sanity dataset {_dataset}")
-    res_doc = _sanity_client.mutate(
-        _dataset, mutate, visibility="async", return_ids=True, auto_generate_array_keys=True)
+    _logger.info(f"Inserting to sanity dataset {_config['dataset']}")
+    res_doc = registry.get("sanity").mutate(
+        _config["dataset"], mutate, visibility="async", return_ids=True, auto_generate_array_keys=True)
     return res_doc
 
 
+def _tag_id(tag: str) -> str:
+    return tag if tag[0:4] == "tag_" else "tag_" + tag
+
+
+def ensure_tags(tags: List[str]) -> List[str]:
+    """Make sure tags exist, only tags not yet ensured during this run are sent to sanity
+
+    Args:
+        tags (List[str]): list containing tag ids
+
+    Returns:
+        List[str]: List with tag ids, in the order of tags
+    """
+    ids = list(map(_tag_id, tags))
+    with _ensured_tags_lock:
+        missing = [tag for tag, tag_id in zip(tags, ids)
+                   if tag_id not in _ensured_tags]
+    if missing:
+        created = create_return_tags(missing)
+        with _ensured_tags_lock:
+            _ensured_tags.update(created)
+    return ids
+
+
 def create_return_tags(tags: Union[List[Dict[str, str]], List[str]]) -> List[str]:
     """Create tags and reutrn their id and name, only return the id and name if tag already exist.
     Automaticlly append "tag_" to the start of id when creating if not already given
@@ -94,5 +278,5 @@ def create_return_tags(tags: Union[List[Dict[str, str]], List[str]]) -> List[str
                 "name": tag
             }})
 
-    res = _sanity_client.mutate(_dataset, mutate, return_ids=True)["results"]
+    res = registry.get("sanity").mutate(_config["dataset"], mutate, return_ids=True)["results"]
     return list(map(lambda e: e["id"], res))
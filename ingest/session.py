@@ -0,0 +1,69 @@
+import logging
+import threading
+from .db.db import DB, ConnectionPool
+from .handle.handle import Handle
+from .handle.rest import RestClient
+from .handle.sequence import HandleSequence
+from .get_config import get_config, ConfigScope
+
+_logger = logging.getLogger(__name__)
+_config = get_config(ConfigScope.HANDLE)
+
+
+class Session:
+    """Backends shared by all files and workers of a single run.
+    Holds a pool of database connections, a keep-alive REST client registering the handles
+    and the handle ID sequence, all are created on first use and closed together by close() or when leaving the with block.
+    """
+
+    def __init__(self, db_pool_size: int = 4, handle_pool_size: int = 8):
+        """Constructor of the Session class
+
+        Args:
+            db_pool_size (int, optional): Maximum number of open database connections. Defaults to 4.
+            handle_pool_size (int, optional): Maximum number of kept-alive connections to the handle server. Defaults to 8.
+        """
+        self.db_pool = ConnectionPool(db_pool_size)
+        self._handle_pool_size = handle_pool_size
+        self._rest_client: RestClient = None
+        self.handle_sequence = HandleSequence(
+            _config["prefix"], _config.getint("sequenceblock", fallback=20))
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "Session":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def rest_client(self) -> RestClient:
+        """The keep-alive REST client of the run, created on first use
+        """
+        with self._lock:
+            if self._rest_client is None:
+                self._rest_client = RestClient(
+                    pool_size=self._handle_pool_size)
+            return self._rest_client
+
+    def handle(self, db: DB) -> Handle:
+        """Handle using the shared client
+
+        Args:
+            db (DB): Database connection used by the handle
+
+        Returns:
+            Handle: Handle sharing the REST client and handle sequence of the run,
+            the handle server is only contacted once a handle is registered
+        """
+        return Handle(db, sequence=self.handle_sequence, rest_client=self.rest_client)
+
+    def close(self) -> None:
+        """Close all database and handle server connections of the run
+        """
+        _logger.debug("Closing session")
+        self.db_pool.close()
+        self.handle_sequence.close()
+        if self._rest_client:
+            self._rest_client.close()
+            self._rest_client = None
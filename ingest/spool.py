@@ -0,0 +1,144 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from io import BytesIO
+from typing import List, Tuple
+from PIL import Image
+from .get_config import get_state_path
+from .media.image.photo import Photo, serialize_metadata, deserialize_metadata
+
+_logger = logging.getLogger(__name__)
+
+_MANIFEST = "manifest.json"
+
+
+def default_spool_path() -> str:
+    """The spool is kept in the state directory, see get_state_path
+
+    Returns:
+        str: Path of the spool directory
+    """
+    return get_state_path("spool")
+
+
+class Spool:
+    """Local directory of photos prepared by offline runs, waiting to be published by a sync run.
+    Every photo is an entry directory holding a copy of the original, its encoded CDN versions
+    and a manifest with the metadata, the tags and whether it goes to sanity.
+    The manifest is written last, entries without one are incomplete and ignored.
+    """
+
+    def __init__(self, path: str = None):
+        """Constructor of the Spool class
+
+        Args:
+            path (str, optional): Location of the spool directory, created if missing. Defaults to default_spool_path().
+        """
+        if path is None:
+            path = default_spool_path()
+        self.path = os.path.abspath(path)
+        os.makedirs(self.path, exist_ok=True)
+        _logger.debug(f"Using spool {self.path}")
+
+    def _entry_path(self, entry: str) -> str:
+        return os.path.join(self.path, entry)
+
+    def add(self, path: str, photo: Photo, compress_results: List[Tuple[BytesIO, dict]] = None, tags: list = None, use_sanity: bool = False) -> str:
+        """Spool a prepared photo, replacing an earlier entry of the same file
+
+        Args:
+            path (str): Path of the photo object on the machine
+            photo (Photo): The photo returned by prepare_photo
+            compress_results (List[Tuple[BytesIO, dict]], optional): The CDN versions returned by prepare_photo. Defaults to None.
+            tags (list, optional): tags to associate with the photo. Defaults to None.
+            use_sanity (bool, optional): upload the photo to sanity,io when synced. Defaults to False.
+
+        Returns:
+            str: Name of the entry
+        """
+        path = os.path.abspath(path)
+        entry = hashlib.sha1(path.encode("utf-8")).hexdigest()[:16]
+        entry_path = self._entry_path(entry)
+        if os.path.exists(entry_path):
+            shutil.rmtree(entry_path)
+        os.makedirs(os.path.join(entry_path, "cdn"))
+
+        shutil.copy2(path, os.path.join(entry_path, os.path.basename(path)))
+        cdn = []
+        for i, (data, info) in enumerate(compress_results or []):
+            cdn_file = "cdn/{}.{}".format(i, info["content_type"].split("/")[1])
+            with open(os.path.join(entry_path, cdn_file), "wb") as f:
+                f.write(data.getbuffer())
+            cdn.append({"file": cdn_file, "info": info})
+
+        manifest = {
+            "source": path,
+            "original": os.path.basename(path),
+            "title": photo.title,
+            "metadata": serialize_metadata(photo.metadata()),
+            "cdn": cdn if compress_results is not None else None,
+            "tags": tags,
+            "sanity": use_sanity,
+            "spooled_at": time.time()
+        }
+        with open(os.path.join(entry_path, _MANIFEST + ".tmp"), "w") as f:
+            json.dump(manifest, f)
+        os.replace(os.path.join(entry_path, _MANIFEST + ".tmp"),
+                   os.path.join(entry_path, _MANIFEST))
+
+        _logger.info(f"Spooled {path} as {entry}")
+        return entry
+
+    def entries(self) -> List[Tuple[str, dict]]:
+        """All complete entries, oldest first
+
+        Returns:
+            List[Tuple[str, dict]]: Name and manifest of each entry
+        """
+        entries = []
+        for entry in os.listdir(self.path):
+            manifest_path = os.path.join(self._entry_path(entry), _MANIFEST)
+            if not os.path.isfile(manifest_path):
+                continue
+            with open(manifest_path, "r") as f:
+                entries.append((entry, json.load(f)))
+        entries.sort(key=lambda e: e[1]["spooled_at"])
+        return entries
+
+    def load(self, entry: str, manifest: dict) -> Tuple[Photo, List[Tuple[BytesIO, dict]]]:
+        """Read a spooled photo back, the same way prepare_photo returns it
+
+        Args:
+            entry (str): Name of the entry
+            manifest (dict): Manifest of the entry as returned by entries
+
+        Returns:
+            Tuple[Photo, List[Tuple[BytesIO, dict]]]: The photo opened from the spooled original, with source_path set to
+            the path it was spooled from, and its CDN versions, None if the photo was spooled without CDN versions
+        """
+        entry_path = self._entry_path(entry)
+        photo = Photo.from_metadata(os.path.join(entry_path, manifest["original"]),
+                                    deserialize_metadata(manifest["metadata"]), manifest["title"])
+        photo.data = Image.open(photo.filepath)
+        # The handle date may come from the folder of the original, not the one of the spooled copy
+        photo.source_path = manifest["source"]
+
+        compress_results = None
+        if manifest["cdn"] is not None:
+            compress_results = []
+            for cdn in manifest["cdn"]:
+                with open(os.path.join(entry_path, cdn["file"]), "rb") as f:
+                    compress_results.append((BytesIO(f.read()), cdn["info"]))
+        return photo, compress_results
+
+    def remove(self, entry: str) -> None:
+        """Delete a synced entry
+
+        Args:
+            entry (str): Name of the entry
+        """
+        shutil.rmtree(self._entry_path(entry), ignore_errors=True)
+        _logger.debug(f"Removed {entry} from spool")
@@ -0,0 +1,92 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+from PIL import Image
+
+# Budgets of the median wall time in seconds, including the interpreter start
+HELP_BUDGET = 0.5
+SINGLE_FILE_BUDGET = 1.5
+
+# Modules that are only imported once a backend is used
+_LAZY_MODULES = ["boto3", "botocore", "requests"]
+
+
+def _run(args: List[str], cwd: str = None) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=cwd, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def measure(args: List[str], repeat: int = 5, cwd: str = None) -> float:
+    """Median wall time of a fresh interpreter running args
+
+    Args:
+        args (List[str]): Arguments of python
+        repeat (int, optional): Number of runs. Defaults to 5.
+        cwd (str, optional): Working directory of the runs. Defaults to None.
+
+    Returns:
+        float: Seconds
+    """
+    # The first run only warms the file system cache
+    _run(args, cwd)
+    return statistics.median(_run(args, cwd) for _ in range(repeat))
+
+
+def eager_imports(args: List[str], cwd: str = None) -> List[str]:
+    """Modules of _LAZY_MODULES that were imported while running args
+
+    Args:
+        args (List[str]): Arguments of python
+        cwd (str, optional): Working directory of the run. Defaults to None.
+
+    Returns:
+        List[str]: The imported modules
+    """
+    res = subprocess.run([sys.executable, "-X", "importtime"] + args, cwd=cwd,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imported = set(line.split("|")[-1].strip()
+                   for line in res.stderr.splitlines() if line.startswith("import time:"))
+    return [module for module in _LAZY_MODULES if module in imported]
+
+
+def check(name: str, args: List[str], budget: float, repeat: int, cwd: str = None) -> bool:
+    elapsed = measure(args, repeat, cwd)
+    eager = eager_imports(args, cwd)
+    ok = elapsed <= budget and not eager
+    print(f"{name}: {elapsed:.3f} s, budget {budget:.3f} s"
+          + (f", imports {', '.join(eager)}" if eager else "")
+          + ("" if ok else " OVER BUDGET"))
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the cold start of the ingest command against its budget")
+    parser.add_argument("-n", "--repeat", type=int, default=5,
+                        help="Number of runs of each command, the median is compared to the budget")
+    parser.add_argument("--help-budget", type=float, default=HELP_BUDGET,
+                        help="Budget of python -m ingest.ingest --help in seconds")
+    parser.add_argument("--file-budget", type=float, default=SINGLE_FILE_BUDGET,
+                        help="Budget of an offline run of a single photo in seconds")
+    args = parser.parse_args()
+
+    # Runs use the config of the current user, the package is found from the working directory
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    ok = check("ingest --help", ["-m", "ingest.ingest", "--help"],
+               args.help_budget, args.repeat, package_root)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Offline, so only the startup and the work on the photo are measured, not the backends
+        photo_path = os.path.join(tmp, "startup.jpg")
+        Image.new("RGB", (3000, 2000), (128, 128, 128)).save(photo_path)
+        ok = check("ingest --offline photo", ["-m", "ingest.ingest", "--offline", "photo", photo_path],
+                   args.file_budget, args.repeat, package_root) and ok
+
+    sys.exit(0 if ok else 1)
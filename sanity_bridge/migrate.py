@@ -1,24 +1,29 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
 import pymysql
 import requests
-from pymysql.cursors import Cursor
-from ingest.sanity import SanityClient
-from ingest.sanity_ingest import create_photo
-from ingest.get_config import get_config, ConfigScope
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Set, Tuple
+from pymysql.cursors import SSDictCursor
+from ingest.sanity import SanityClient, sha1
+from ingest.sanity_ingest import create_photos
+from ingest import registry
+from ingest.get_config import get_config, get_state_path, ConfigScope
 
 _db_config = get_config(ConfigScope.DB)
 _sanity_config = get_config(ConfigScope.SANITY)
+_logger = logging.getLogger("sanity_bridge.migrate")
 
-connection = pymysql.connect(host=_db_config["host"],
-                             user=_db_config["username"],
-                             password=_db_config["password"],
-                             db="handle",
-                             charset="utf8mb4",
-                             cursorclass=pymysql.cursors.DictCursor
-                             )
-cursor: Cursor = connection.cursor()
+# Downloads larger than this are buffered on disk instead of in memory
+_SPOOL_BYTES = 4 * 1024 * 1024
 
-
-cursor.execute("""SELECT a.source_handle AS handle,
+_QUERY = """SELECT a.source_handle AS handle,
     a.width,
     a.location
 FROM cdn a
@@ -28,21 +33,217 @@ FROM cdn a
         FROM cdn
         GROUP BY source_handle
     ) b ON a.source_handle = b.source_handle
-    AND a.width = b.width;""")
-photos = cursor.fetchall()
-cursor.close()
+    AND a.width = b.width;"""
+
+
+def default_checkpoint_path() -> str:
+    return get_state_path("migrate-checkpoint.txt")
+
+
+def read_checkpoint(path: str) -> Set[str]:
+    """Handles migrated by previous runs
+
+    Args:
+        path (str): Location of the checkpoint file, one handle per line
+
+    Returns:
+        Set[str]: The handles
+    """
+    if not os.path.isfile(path):
+        return set()
+    with open(path, "r") as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def stream_photos(batch_size: int) -> Iterator[List[dict]]:
+    """The widest CDN version of every photo, streamed from the database with a server-side cursor
+
+    Args:
+        batch_size (int): Number of rows per batch
+
+    Yields:
+        List[dict]: handle, width and location of the photos of a batch
+    """
+    connection = pymysql.connect(host=_db_config["host"],
+                                 user=_db_config["username"],
+                                 password=_db_config["password"],
+                                 db="handle",
+                                 charset="utf8mb4",
+                                 cursorclass=SSDictCursor
+                                 )
+    try:
+        cursor = connection.cursor()
+        # The server waits for the client between batches
+        cursor.execute("SET SESSION net_write_timeout = 3600;")
+        cursor.execute(_QUERY)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+        cursor.close()
+    finally:
+        connection.close()
+
+
+def existing_handles(client: SanityClient, dataset: str, handles: List[str]) -> Set[str]:
+    """Handles of which a photo document already exists in sanity, checked with a single query
+
+    Args:
+        client (SanityClient): Sanity client
+        dataset (str): The dataset
+        handles (List[str]): Handles to check
+
+    Returns:
+        Set[str]: The existing handles
+    """
+    object_ids = json.dumps(list(map(lambda h: h.split("/")[1], handles)))
+    res = client.query(
+        dataset, f'*[_type == "photo" && objectID in {object_ids}]{{hdlPrefix, objectID}}')
+    return set(map(lambda doc: f'{doc["hdlPrefix"]}/{doc["objectID"]}', res or []))
+
+
+class Migration:
+    """Copies the widest CDN version of every photo to sanity and creates its photo document.
+    Each image is downloaded and uploaded by one of a pool of workers sharing kept-alive connections,
+    images already in sanity as asset are found by their SHA-1 and not uploaded again,
+    documents are created per batch. Migrated handles are appended to a checkpoint file,
+    a restarted migration skips them as well as handles already existing in sanity.
+    """
+
+    def __init__(self, checkpoint_path: str, workers: int = 8, batch_size: int = 100, tags: List[str] = None, artist: str = None):
+        self._dataset = _sanity_config["dataset"]
+        self._client = SanityClient(_sanity_config["project_id"], _sanity_config["token"],
+                                    max_rate=_sanity_config.getfloat("ratelimit", fallback=None), pool_size=workers)
+        # create_photos uses the same client, sized for the workers and knowing the looked-up assets
+        registry.override("sanity", self._client)
+        self._http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self._http.mount("http://", adapter)
+        self._http.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        # Enough queued photos to keep every worker busy, without buffering the whole table
+        self._max_in_flight = 2 * workers
+        self._batch_size = batch_size
+        self._tags = tags
+        self._artist = artist
+
+        self._done = read_checkpoint(checkpoint_path)
+        self._checkpoint = open(checkpoint_path, "a")
+        self.migrated = 0
+        self.skipped = 0
+        self.failed: List[str] = []
+
+    def _download(self, item: dict) -> Tuple[BinaryIO, str, str]:
+        # Streamed to a buffer that only stays in memory for small images and can be rewound on retries
+        buffer = tempfile.SpooledTemporaryFile(max_size=_SPOOL_BYTES)
+        try:
+            with self._http.get(item["location"], stream=True) as res:
+                res.raise_for_status()
+                shutil.copyfileobj(res.raw, buffer)
+                buffer.seek(0)
+                return buffer, res.headers["Content-Type"], sha1(buffer)
+        except Exception:
+            buffer.close()
+            raise
+
+    def _migrate_photo(self, item: dict) -> str:
+        # Download and upload run in the same worker, so the upload of a photo starts as soon as its download ends
+        buffer, content_type, sha1hash = self._download(item)
+        with buffer:
+            return self._client.upload_image(self._dataset, buffer, content_type, sha1hash)
+
+    def _record(self, handles: List[str]) -> None:
+        for handle in handles:
+            self._checkpoint.write(handle + "\n")
+        self._checkpoint.flush()
+        self._done.update(handles)
+
+    def _pending(self, rows: List[dict]) -> List[dict]:
+        rows = [row for row in rows if row["handle"] not in self._done]
+        if not rows:
+            return rows
+
+        existing = existing_handles(
+            self._client, self._dataset, list(map(lambda row: row["handle"], rows)))
+        if existing:
+            _logger.info(f"{len(existing)} photos already exist in sanity")
+            self.skipped += len(existing)
+            self._record(list(existing))
+        return [row for row in rows if row["handle"] not in existing]
+
+    def _create(self, uploaded: List[Tuple[str, str]]) -> None:
+        _logger.info(f"Creating {len(uploaded)} photos")
+        create_photos(list(map(lambda u: (u[0], u[1], self._tags, self._artist, None), uploaded)))
+        self._record(list(map(lambda u: u[0], uploaded)))
+        self.migrated += len(uploaded)
+
+    def _collect(self, in_flight: Dict[Future, dict], uploaded: List[Tuple[str, str]], block: bool) -> None:
+        done, _ = wait(in_flight, timeout=None if block else 0,
+                       return_when=FIRST_COMPLETED)
+        for future in done:
+            row = in_flight.pop(future)
+            try:
+                uploaded.append((row["handle"], future.result()))
+            except Exception:
+                _logger.exception(f'Failed to migrate {row["handle"]}')
+                self.failed.append(row["handle"])
+
+    def migrate(self, batches: Iterable[List[dict]]) -> None:
+        """Migrate the photos of all batches. Photos are migrated as a stream, a new one is started whenever one finished,
+        so a slow download only holds up its own worker. Documents are created whenever batch_size photos are uploaded.
+
+        Args:
+            batches (Iterable[List[dict]]): handle, width and location of the photos, e.g. from stream_photos
+        """
+        in_flight: Dict[Future, dict] = {}
+        uploaded: List[Tuple[str, str]] = []
+        for rows in batches:
+            for row in self._pending(rows):
+                while len(in_flight) >= self._max_in_flight:
+                    self._collect(in_flight, uploaded, block=True)
+                in_flight[self._executor.submit(self._migrate_photo, row)] = row
+            self._collect(in_flight, uploaded, block=False)
+            if len(uploaded) >= self._batch_size:
+                self._create(uploaded)
+                uploaded = []
+
+        while in_flight:
+            self._collect(in_flight, uploaded, block=True)
+            if len(uploaded) >= self._batch_size:
+                self._create(uploaded)
+                uploaded = []
+        if uploaded:
+            self._create(uploaded)
 
-sc = SanityClient(_sanity_config["project_id"], _sanity_config["token"])
+    def close(self) -> None:
+        self._executor.shutdown()
+        self._checkpoint.close()
+        self._http.close()
+        self._client.close()
 
-for item in photos:
-    handle = item["handle"]
-    location = item["location"]
 
-    res = requests.get(location)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Copy the photos in the database to sanity")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="Number of concurrent downloads and uploads")
+    parser.add_argument("-n", "--batch-size", type=int, default=100,
+                        help="Number of photos checked and created at once")
+    parser.add_argument("--checkpoint", default=default_checkpoint_path(),
+                        help="File recording the migrated handles, delete it to start over")
+    parser.add_argument("-t", "--tag", action="append", dest="tags",
+                        help="Tag of the created photos")
+    parser.add_argument("--artist", default="OLAF YANG",
+                        help="Artist of the created photos")
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
-    print(f"Uploading image {location} to sanity")
-    asset_id = sc.upload_image(
-        _sanity_config["dataset"], res.content, res.headers["Content-Type"])
+    migration = Migration(args.checkpoint, args.workers, args.batch_size,
+                          args.tags or ["EDI2018YE"], args.artist)
+    try:
+        migration.migrate(stream_photos(args.batch_size))
+    finally:
+        migration.close()
 
-    print(f"Creating Photo {handle}")
-    create_photo(handle, asset_id, ["EDI2018YE"], artist="OLAF YANG")
+    print(f"Migrated {migration.migrated} photos, skipped {migration.skipped} existing, failed {len(migration.failed)}")
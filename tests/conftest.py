@@ -0,0 +1,124 @@
+from configparser import ConfigParser
+import pytest
+from ingest import get_config, ratelimit, registry
+from ingest.db.db import DB
+
+
+@pytest.fixture(autouse=True)
+def config(tmp_path, monkeypatch):
+    """A complete config pointing every backend at an address nothing listens on,
+    state files are kept in the temporary directory of the test
+    """
+    config = ConfigParser()
+    config.read_dict({
+        "HANDLE": {"host": "http://127.0.0.1:9", "username": "300:prefix/admin", "password": "password",
+                   "prefix": "prefix", "httpsverify": "False"},
+        "DB": {"host": "127.0.0.1", "username": "user", "password": "password", "db": "ingest"},
+        "S3": {"endpoint": "http://127.0.0.1:9", "accesskeyid": "id", "accesskeysecret": "secret",
+               "bucketname": "main"},
+        "S3_CDN": {"endpoint": "http://127.0.0.1:9", "accesskeyid": "id", "accesskeysecret": "secret",
+                   "bucketname": "cdn", "cdn_endpoint": "https://cdn.example.com"},
+        "SANITY": {"token": "token", "project_id": "project", "dataset": "test"}
+    })
+    monkeypatch.setattr(get_config, "_config", config)
+    monkeypatch.setattr(get_config, "_config_file_path",
+                        str(tmp_path / "config.ini"))
+    monkeypatch.setattr(ratelimit, "_limiters", {})
+    registry.reset()
+    yield config
+    registry.reset()
+
+
+class FakeDatabase:
+    """In-memory stand-in for the MySQL database, understanding the statements of DB, WriteBuffer and HandleSequence
+
+    Attributes:
+        photos (set): Handles of the rows in photos
+        inserted (dict): Rows inserted with executemany, per table
+        sequences (dict): next_id of the handle_sequences rows, per prefix and date
+        existing_handles (int): Handles counted by DB.count_handle
+        commits (int): Number of commits on all connections
+    """
+
+    def __init__(self):
+        self.photos = set()
+        self.inserted = {}
+        self.sequences = {}
+        self.existing_handles = 0
+        self.commits = 0
+
+    def db(self) -> DB:
+        """A DB on a new connection, with its own LAST_INSERT_ID"""
+        return DB(_FakeConnection(self))
+
+
+class _FakeConnection:
+    def __init__(self, database: FakeDatabase):
+        self.database = database
+        self.last_insert_id = None
+
+    def cursor(self):
+        return _FakeCursor(self)
+
+    def commit(self):
+        self.database.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _FakeCursor:
+    def __init__(self, connection: _FakeConnection):
+        self._connection = connection
+        self._database = connection.database
+        self._result = []
+        self.rowcount = 0
+
+    def execute(self, sql, args=()):
+        sequences = self._database.sequences
+        if sql.startswith("SELECT handle FROM photos"):
+            self._result = [{"handle": handle}
+                            for handle in args if handle in self._database.photos]
+        elif sql.startswith("SELECT count(handle) FROM handles"):
+            self._result = [{"count(handle)": self._database.existing_handles}]
+        elif sql.startswith("UPDATE handle_sequences SET next_id = LAST_INSERT_ID"):
+            size, prefix, day = args
+            self.rowcount = int((prefix, day) in sequences)
+            if self.rowcount:
+                sequences[(prefix, day)] += size
+                self._connection.last_insert_id = sequences[(prefix, day)]
+        elif sql.startswith("INSERT INTO handle_sequences"):
+            prefix, day, end, size = args
+            sequences[(prefix, day)] = sequences[(prefix, day)] + \
+                size if (prefix, day) in sequences else end
+            self._connection.last_insert_id = sequences[(prefix, day)]
+        elif sql.startswith("SELECT LAST_INSERT_ID()"):
+            self._result = [{"end": self._connection.last_insert_id}]
+        elif sql.startswith("UPDATE handle_sequences SET next_id = %s"):
+            next_id, prefix, day, end = args
+            self.rowcount = int(sequences.get((prefix, day)) == end)
+            if self.rowcount:
+                sequences[(prefix, day)] = next_id
+        else:
+            raise AssertionError(sql)
+
+    def executemany(self, sql, rows):
+        table = sql.split("`")[1]
+        self._database.inserted.setdefault(table, []).extend(rows)
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def fetchall(self):
+        return self._result
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def database() -> FakeDatabase:
+    return FakeDatabase()
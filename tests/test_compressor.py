@@ -0,0 +1,36 @@
+import os
+from PIL import Image
+from ingest.image_compressor import compressor
+
+
+def test_open_draft_closes_file(tmp_path):
+    path = str(tmp_path / "photo.jpg")
+    Image.new("RGB", (3000, 2000), (128, 128, 128)).save(path)
+
+    with Image.open(path) as image:
+        open_files = len(os.listdir("/proc/self/fd"))
+        draft = compressor._open_draft(image, (800, 600))
+
+        assert draft is not image
+        assert draft.size == (1500, 1000)
+        assert len(os.listdir("/proc/self/fd")) == open_files
+
+
+def test_source_smaller_than_largest_output(tmp_path):
+    path = str(tmp_path / "photo.jpg")
+    Image.effect_mandelbrot((1500, 1000), (-2, -1, 1, 1), 100).convert(
+        "RGB").save(path)
+
+    with Image.open(path) as image:
+        image.load()
+        out = compressor.compress(image)
+        sizes = list(map(lambda o: (o[1]["width"], o[1]["height"]), out))
+
+        assert sizes == [(250, 166), (500, 333), (750, 500),
+                         (1000, 666), (2000, 1333), (1500, 1000)]
+        # The full size output is the untouched original and no output is derived from the upscaled one
+        assert out[5][0].getvalue() == compressor.save_io(image, "jpg").getvalue()
+        assert out[4][0].getvalue() == compressor.save_io(
+            image.resize((2000, 1333)), "jpg").getvalue()
+        assert out[3][0].getvalue() == compressor.save_io(
+            image.resize((1000, 666)), "jpg").getvalue()
@@ -0,0 +1,30 @@
+from datetime import date
+from ingest.db.db import WriteBuffer
+from ingest.media.image.photo import Photo
+
+
+def _buffer() -> WriteBuffer:
+    buffer = WriteBuffer()
+    for handle in ("prefix/P2020-01-02.I1", "prefix/P2020-01-02.I2"):
+        photo = Photo.from_metadata("a.jpg", {"date_capture": date(2020, 1, 2)})
+        buffer.add_photo(handle, "s3://main/" + handle, photo, ["TAG"],
+                         [{"source_handle": handle, "width": 1000, "location": "https://cdn.example.com/x"}])
+    return buffer
+
+
+def test_replayed_batch_skips_written_photos(database):
+    database.photos.add("prefix/P2020-01-02.I1")
+    _buffer().flush(database.db())
+
+    assert database.commits == 1
+    for table in ("photos", "obj_tag", "cdn"):
+        assert len(database.inserted[table]) == 1, table
+        assert "prefix/P2020-01-02.I2" in database.inserted[table][0]
+
+
+def test_write_tags_leaves_commit_to_caller(database):
+    database.db().write_tags("prefix/P2020-01-02.I1", ["TAG", "OTHER"])
+
+    assert database.commits == 0
+    assert len(database.inserted["tags"]) == 2
+    assert len(database.inserted["obj_tag"]) == 2
@@ -0,0 +1,19 @@
+import os
+from ingest.get_config import get_state_path
+from ingest.journal import default_journal_path
+from ingest.spool import default_spool_path
+
+
+def test_state_is_kept_in_namespaced_directory(tmp_path):
+    state_dir = str(tmp_path / ".ingest")
+
+    assert default_journal_path() == os.path.join(state_dir, "ingest-journal.db")
+    assert default_spool_path() == os.path.join(state_dir, "spool")
+    assert os.path.isdir(state_dir)
+
+
+def test_state_directory_is_configurable(tmp_path, config):
+    config["STATE"] = {"dir": str(tmp_path / "state")}
+
+    assert get_state_path("metadata-cache.db") == str(
+        tmp_path / "state" / "metadata-cache.db")
@@ -0,0 +1,106 @@
+from contextlib import contextmanager
+from datetime import date
+import pytest
+from ingest.handle.fake_server import FakeHandleServer, _FakeSequence
+from ingest.handle.handle import Handle
+from ingest.handle.rest import HandleRegistrationError, RestClient
+from ingest.media.image.photo import Photo
+from ingest.pipeline import Pipeline, PhotoTask
+from ingest.session import Session
+
+
+class _NoDatabasePool:
+    @contextmanager
+    def connection(self):
+        yield None
+
+    def close(self):
+        pass
+
+
+def _task(name: str) -> PhotoTask:
+    task = PhotoTask(name)
+    task.photo = Photo.from_metadata(name, {"date_capture": date(2020, 1, 2)})
+    return task
+
+
+def test_deferred_run_does_not_need_handle_server():
+    # The configured handle server does not exist, a deferred run only reserves handles
+    with Session() as session:
+        session.db_pool = _NoDatabasePool()
+        session.handle_sequence = _FakeSequence()
+        pipeline = Pipeline(session=session, defer_handles=True)
+
+        tasks = [_task("a.jpg"), _task("b.jpg")]
+        registered = pipeline._register(tasks)
+
+    assert registered == tasks
+    assert pipeline.skipped_files == []
+    assert [task.handle for task in tasks] == [
+        "prefix/P2020-01-02.I1", "prefix/P2020-01-02.I2"]
+
+
+@pytest.fixture
+def server():
+    server = FakeHandleServer(latency=0).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def rest_client(server):
+    client = RestClient(server.url, "300:prefix/admin",
+                        "password", "prefix", pool_size=4)
+    yield client
+    client.close()
+
+
+def test_rest_client_registers_handle(server, rest_client):
+    rest_client.register("prefix/P2020-01-02.I1", "https://example.com/a")
+
+    assert rest_client.location(
+        "prefix/P2020-01-02.I1") == "https://example.com/a"
+    assert rest_client.location("prefix/P2020-01-02.I2") is None
+    [url, admin] = server.handles["prefix/P2020-01-02.I1"]
+    assert url["type"] == "URL" and admin["type"] == "HS_ADMIN"
+
+
+def test_rest_client_does_not_overwrite_handle(rest_client):
+    rest_client.register("prefix/P2020-01-02.I1", "https://example.com/a")
+
+    with pytest.raises(HandleRegistrationError) as e:
+        rest_client.register("prefix/P2020-01-02.I1", "https://example.com/b")
+    assert e.value.status_code == 409
+    # Registering again is only accepted if the handle points to the same location
+    rest_client.register("prefix/P2020-01-02.I1",
+                         "https://example.com/a", exists_ok=True)
+    with pytest.raises(HandleRegistrationError):
+        rest_client.register("prefix/P2020-01-02.I1",
+                             "https://example.com/b", exists_ok=True)
+
+
+def test_register_batch(server, rest_client):
+    handle = Handle(None, sequence=_FakeSequence(), rest_client=rest_client)
+    photos = [Photo.from_metadata(f"{i}.jpg", {"date_capture": date(2020, 1, 2)})
+              for i in range(10)]
+
+    results = handle.register_batch(photos, check_duplicates=False, max_workers=4)
+
+    assert all(result.ok for result in results)
+    assert [result.handle for result in results] == [
+        f"prefix/P2020-01-02.I{i}" for i in range(1, 11)]
+    assert sorted(server.handles) == sorted(
+        result.handle for result in results)
+    assert server.connections <= 4
+
+
+def test_register_uses_same_request_as_batch(server, rest_client):
+    handle = Handle(None, sequence=_FakeSequence(), rest_client=rest_client)
+    photo = Photo.from_metadata("a.jpg", {"date_capture": date(2020, 1, 2)})
+
+    single, _ = handle.register(photo, "https://example.com/a", check_duplicates=False)
+    [batch] = handle.register_batch([photo], check_duplicates=False)
+
+    assert batch.ok
+    assert server.handles[single][1] == server.handles[batch.handle][1]
+    assert server.handles[single][0]["data"]["value"] == "https://example.com/a"
@@ -0,0 +1,16 @@
+from PIL import Image
+from ingest.media.image.metadata import read_metadata
+from ingest.media.image.photo import Photo
+
+_XMP = ('<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        '<rdf:Description xmlns:crs="http://ns.adobe.com/camera-raw-settings/1.0/" '
+        'crs:RawFileName="R&amp;D &quot;A&quot; &#39;1&#39;.CR2"/></rdf:RDF></x:xmpmeta>')
+
+
+def test_raw_filename_is_unescaped(tmp_path):
+    path = str(tmp_path / "photo.jpg")
+    Image.new("RGB", (8, 8)).save(path, xmp=_XMP.encode("utf-8"))
+
+    assert read_metadata(path)["raw_filename"] == "R&D \"A\" '1'.CR2"
+    # The duplicate key of the check stage has to match the one stored from the parsed photo
+    assert read_metadata(path)["raw_filename"] == Photo(path).raw_filename
@@ -0,0 +1,40 @@
+import io
+import threading
+from sanity_bridge import migrate
+
+
+def test_uploads_do_not_wait_for_slow_download(tmp_path, monkeypatch):
+    slow = threading.Event()
+    uploaded = []
+    created = []
+
+    def download(self, item):
+        if item["handle"] == "prefix/slow":
+            assert slow.wait(5)
+        return io.BytesIO(b"image"), "image/jpeg", item["handle"]
+
+    def upload_image(dataset, buffer, content_type, sha1hash):
+        uploaded.append(sha1hash)
+        if len(uploaded) == 3:
+            # Every other photo was uploaded while the slow one is still downloading
+            slow.set()
+        return "image-" + sha1hash
+
+    monkeypatch.setattr(migrate.Migration, "_download", download)
+    monkeypatch.setattr(migrate, "existing_handles", lambda *args: set())
+    monkeypatch.setattr(migrate, "create_photos", created.extend)
+    migration = migrate.Migration(
+        str(tmp_path / "checkpoint.txt"), workers=2, batch_size=2)
+    monkeypatch.setattr(migration._client, "upload_image", upload_image)
+    try:
+        migration.migrate([[{"handle": "prefix/slow"}, {"handle": "prefix/a"}],
+                           [{"handle": "prefix/b"}, {"handle": "prefix/c"}]])
+    finally:
+        migration.close()
+
+    assert uploaded[-1] == "prefix/slow"
+    assert sorted(map(lambda photo: photo[0], created)) == [
+        "prefix/a", "prefix/b", "prefix/c", "prefix/slow"]
+    assert migration.migrated == 4
+    assert migrate.read_checkpoint(str(tmp_path / "checkpoint.txt")) == {
+        "prefix/a", "prefix/b", "prefix/c", "prefix/slow"}
@@ -0,0 +1,74 @@
+from PIL import Image
+from ingest import sanity_ingest
+from ingest.media.image.photo import Photo
+from ingest.metadata_cache import MetadataCache
+from ingest.pipeline import Pipeline, PhotoTask, prepare_photo
+
+
+def test_prepare_photo_releases_pixels(tmp_path):
+    path = str(tmp_path / "photo.jpg")
+    Image.new("RGB", (3000, 2000), (128, 128, 128)).save(path)
+
+    photo, compress_results = prepare_photo(path)
+
+    assert len(compress_results) == 6
+    # Opened again but not decoded, the format is still known for the upload of the original
+    assert photo.data.tile
+    assert photo.data.format == "JPEG"
+    photo.data.close()
+
+
+def test_failed_batch_only_skips_failing_file():
+    pipeline = Pipeline()
+    tasks = list(map(PhotoTask, ["a.jpg", "bad.jpg", "c.jpg"]))
+
+    def write(batch):
+        if any(map(lambda task: task.path == "bad.jpg", batch)):
+            raise ValueError("bad file")
+        for task in batch:
+            task.written = True
+        return batch
+
+    assert pipeline._run_batch(write, tasks) == [tasks[0], tasks[2]]
+    assert pipeline.skipped_files == ["bad.jpg"]
+
+
+def test_resume_after_cdn_encodes_only_sanity_variant(tmp_path):
+    path = str(tmp_path / "photo.jpg")
+    Image.new("RGB", (3000, 2000), (128, 128, 128)).save(path)
+    pipeline = Pipeline(use_sanity=True)
+
+    task = PhotoTask(path)
+    task.cdn_complete = True
+    pipeline._decode(task)
+    assert list(map(lambda r: r[1]["width"], task.compress_results)) == [2000]
+    assert sanity_ingest.select_variant(task.compress_results)[1]["width"] == 2000
+
+    task = PhotoTask(path)
+    task.cdn_complete = True
+    task.sanity_done = True
+    pipeline._decode(task)
+    assert task.compress_results is None
+
+
+def test_decode_reuses_cached_metadata(tmp_path, monkeypatch):
+    path = str(tmp_path / "photo.jpg")
+    exif = Image.Exif()
+    exif[0x0110] = "Camera"
+    Image.new("RGB", (300, 200)).save(path, exif=exif)
+    cache = MetadataCache(str(tmp_path / "cache.db"))
+    pipeline = Pipeline(no_compress=True, metadata_cache=cache)
+
+    task = PhotoTask(path)
+    pipeline._read_header(task)
+    assert task.photo.camera_model == "Camera"
+
+    def parse(*args, **kwargs):
+        raise AssertionError("metadata parsed again")
+
+    monkeypatch.setattr(Photo, "__init__", parse)
+    pipeline._decode(task)
+    assert task.photo.camera_model == "Camera"
+    assert task.photo.data.size == (300, 200)
+    task.photo.data.close()
+    cache.close()
@@ -0,0 +1,49 @@
+import time
+import pytest
+import requests
+from ingest.ratelimit import RateLimiter, ThrottledError, is_throttled
+
+
+def test_calls_are_not_paced_until_throttled():
+    limiter = RateLimiter("test")
+    start = time.monotonic()
+    for _ in range(200):
+        limiter.call(lambda: None)
+    assert time.monotonic() - start < 0.5
+    assert limiter.rate is None
+
+
+def test_throttling_starts_pacing():
+    limiter = RateLimiter("test", base_delay=0.01)
+    attempts = []
+
+    def call():
+        attempts.append(None)
+        if len(attempts) == 1:
+            raise ThrottledError(429)
+        return "ok"
+
+    assert limiter.call(call) == "ok"
+    assert len(attempts) == 2
+    assert limiter.rate is not None
+
+
+def test_non_idempotent_calls_are_only_retried_when_refused():
+    assert is_throttled(requests.ReadTimeout())
+    assert not is_throttled(requests.ReadTimeout(), idempotent=False)
+    assert not is_throttled(ThrottledError(504), idempotent=False)
+    assert is_throttled(ThrottledError(429), idempotent=False)
+    assert is_throttled(requests.ConnectTimeout(), idempotent=False)
+
+
+def test_non_idempotent_call_is_not_repeated_after_timeout():
+    limiter = RateLimiter("test", base_delay=0.01)
+    attempts = []
+
+    def call():
+        attempts.append(None)
+        raise requests.ReadTimeout()
+
+    with pytest.raises(requests.ReadTimeout):
+        limiter.call(call, idempotent=False)
+    assert len(attempts) == 1
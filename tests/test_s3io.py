@@ -0,0 +1,29 @@
+from io import BytesIO
+from ingest import s3io
+
+
+class _FakeS3:
+    def __init__(self, objects=None):
+        self.objects = objects or {}
+        self.calls = []
+
+    def head_object(self, Bucket, Key):
+        self.calls.append("head")
+        return self.objects[Key]
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None, Config=None):
+        self.calls.append("put")
+
+
+def test_fresh_upload_does_not_check_existing_object():
+    client = _FakeS3()
+    s3io._upload(client, "main", "key", BytesIO(b"data"), "image/jpeg")
+    assert client.calls == ["put"]
+
+
+def test_resumed_upload_skips_unchanged_object():
+    data = BytesIO(b"data")
+    client = _FakeS3({"key": {"ContentType": "image/jpeg",
+                              "ETag": '"{}"'.format(s3io.etag(data))}})
+    s3io._upload(client, "main", "key", data, "image/jpeg", skip_unchanged=True)
+    assert client.calls == ["head"]
@@ -0,0 +1,34 @@
+from datetime import date
+from ingest.handle.sequence import HandleSequence
+
+
+def _sequence(database) -> HandleSequence:
+    sequence = HandleSequence("prefix", block_size=20)
+    # Every run has a connection of its own
+    sequence._db = database.db()
+    return sequence
+
+
+DAY = date(2020, 1, 2)
+
+
+def test_ids_continue_after_existing_handles_and_unused_ids_are_released(database):
+    database.existing_handles = 5
+    first = _sequence(database)
+    assert [first.next(DAY) for _ in range(3)] == [6, 7, 8]
+    first.close()
+
+    second = _sequence(database)
+    assert second.next(DAY) == 9
+    second.close()
+    assert database.sequences[("prefix", DAY)] == 10
+
+
+def test_interleaved_runs_do_not_share_ids(database):
+    first, second = _sequence(database), _sequence(database)
+    assert first.next(DAY) == 1
+    assert second.next(DAY) == 21
+    # The block of the first run is followed by the one of the second, its unused IDs stay reserved
+    first.close()
+    second.close()
+    assert database.sequences[("prefix", DAY)] == 22
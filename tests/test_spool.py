@@ -0,0 +1,55 @@
+from contextlib import contextmanager
+from PIL import Image
+from ingest.handle.fake_server import _FakeSequence
+from ingest.handle.handle import Handle
+from ingest.media.image.photo import Photo
+from ingest.pipeline import Pipeline, spooled_tasks
+from ingest.spool import Spool
+
+
+def test_synced_photo_keeps_folder_date(tmp_path):
+    folder = tmp_path / "2019-05-06 Concert"
+    folder.mkdir()
+    path = str(folder / "photo.jpg")
+    # No EXIF, the handle date comes from the folder
+    Image.new("RGB", (64, 48)).save(path)
+
+    spool = Spool(str(tmp_path / "spool"))
+    spool.add(path, Photo(path))
+    [(entry, manifest)] = spool.entries()
+    photo, _ = spool.load(entry, manifest)
+
+    handle, _ = Handle(None, sequence=_FakeSequence()).reserve(
+        photo, check_duplicates=False)
+    assert handle == "prefix/P2019-05-06.I1"
+    assert photo.filepath != path
+
+
+class _DuplicateDB:
+    def photos_have_duplicates(self, photos):
+        return [True] * len(photos)
+
+
+class _DuplicatePool:
+    @contextmanager
+    def connection(self):
+        yield _DuplicateDB()
+
+
+class _Session:
+    db_pool = _DuplicatePool()
+
+
+def test_sync_removes_duplicates_from_spool(tmp_path):
+    path = str(tmp_path / "photo.jpg")
+    Image.new("RGB", (64, 48)).save(path)
+    spool = Spool(str(tmp_path / "spool"))
+    spool.add(path, Photo(path))
+
+    pipeline = Pipeline(session=_Session(), spool=spool)
+    tasks = list(spooled_tasks(spool, spool.entries()))
+    tasks[0].photo.data.close()
+
+    assert pipeline._check(tasks) == []
+    assert pipeline.skipped_files == [tasks[0].path]
+    assert spool.entries() == []